@@ -25,13 +25,23 @@
 
 import os
 import csv
-import copy
+import threading
 
 from settings.glancesync_config import GlanceSyncConfig
-from glancesync_region import GlanceSyncRegion
+from glancesync_region import GlanceSyncRegion, RegionImageIndex
 from glancesync_image import GlanceSyncImage
 import glancesync_ami
-from glancesync_serversfacade import ServersFacade
+from glancesync_upload import UploadScheduler, UploadSkippedException
+from glancesync_upload import ami_dependencies, dependency_order,\
+    TransferScheduler
+from glancesync_fanout import FanoutReader
+from glancesync_throttle import Throttle
+from glancesync_cache import BlobCache
+from glancesync_snapshot import MasterSnapshot, fingerprint_images
+from glancesync_plan import SyncPlan
+from glancesync_state import SyncStateStore, image_fingerprint,\
+    target_fingerprint, max_changed_images
+from glancesync_serversfacade import ServersFacade, ServersFacadeV2
 from glancesync_serverfacade_mock import ServersFacade as ServersFacadeMock
 from app.settings.settings import logger_cli
 
@@ -64,24 +74,132 @@ class GlanceSync(object):
         self.master_region = glancesyncconfig.master_region
         self.images_dir = glancesyncconfig.images_dir
         self.targets = glancesyncconfig.targets
-        count = 0
+        self.fanout_stall_timeout = glancesyncconfig.fanout_stall_timeout
+        self.max_transfers = glancesyncconfig.max_transfers
+        self.transfer_policy = glancesyncconfig.transfer_policy
+        self.throttle = Throttle(
+            glancesyncconfig.max_bandwidth,
+            dict((name, (target['max_target_bandwidth'],
+                         target['max_region_bandwidth']))
+                 for (name, target) in self.targets.items()),
+            glancesyncconfig.bandwidth_file)
+        if glancesyncconfig.image_cache_dir:
+            self.image_cache = BlobCache(
+                glancesyncconfig.image_cache_dir,
+                glancesyncconfig.image_cache_size * 1024 * 1024)
+        else:
+            self.image_cache = None
+        # The facades are created (and authenticated) on first use
         for target in self.targets.values():
-            if 'GLANCESYNC_USE_MOCK' in os.environ:
-                target['facade'] = ServersFacadeMock(target)
-            elif 'GLANCESYNC_MOCKPERSISTENT_PATH' in os.environ:
-                target['facade'] = ServersFacadeMock(target)
-                target['facade'].init_persistence(
-                    os.environ['GLANCESYNC_MOCKPERSISTENT_PATH'])
-            else:
-                target['facade'] = ServersFacade(target)
+            target['facade'] = _LazyFacade(self._create_facade, target)
+            target['facade'].images_dir = self.images_dir
+            target['facade'].drop_images_cache = \
+                glancesyncconfig.drop_images_cache
+            target['facade'].master_source = self._download_master
+            target['facade'].image_cache = self.image_cache
+            target['throttle'] = self.throttle
 
         self.preferable_order = glancesyncconfig.preferable_order
         self.max_children = glancesyncconfig.max_children
+        self.master_snapshot = MasterSnapshot(
+            self.master_region, self.targets['master'],
+            glancesyncconfig.master_snapshot_ttl,
+            glancesyncconfig.master_snapshot_dir)
+        self.master_fingerprint = None
+        if glancesyncconfig.state_file:
+            self.sync_state = SyncStateStore(glancesyncconfig.state_file)
+        else:
+            self.sync_state = None
+        self.verify_every = glancesyncconfig.verify_every
+        self.watch_interval = glancesyncconfig.watch_interval
+        self.watch_status_file = glancesyncconfig.watch_status_file
+        self.max_readers = glancesyncconfig.max_readers
+        self.region_timeout = glancesyncconfig.region_timeout
+        # The master region is listed on first use of master_region_dict
+        self._master_region_dict = None
+
+    @property
+    def master_region_dict(self):
+        """dictionary with the images of the master region, indexed by name.
+        It is obtained on first use (see refresh_master)."""
+        if self._master_region_dict is None:
+            self.refresh_master(force=False)
+        return self._master_region_dict
+
+    @master_region_dict.setter
+    def master_region_dict(self, images_dict):
+        self._master_region_dict = images_dict
+
+    @staticmethod
+    def _create_facade(target):
+        """Create the facade of the target (the mock in testing mode)"""
+        if 'GLANCESYNC_USE_MOCK' in os.environ:
+            facade = ServersFacadeMock(target)
+        elif 'GLANCESYNC_MOCKPERSISTENT_PATH' in os.environ:
+            facade = ServersFacadeMock(target)
+            facade.init_persistence(
+                os.environ['GLANCESYNC_MOCKPERSISTENT_PATH'])
+        elif target.get('glance_api_version', '1') == '2':
+            facade = ServersFacadeV2(target)
+        else:
+            facade = ServersFacade(target)
+        return facade
+
+    def _download_master(self, image):
+        """Return the content of a master image, downloaded from the master
+        region (see the option image_source)"""
         master_region = GlanceSyncRegion(self.master_region, self.targets)
-        images = master_region.target['facade'].get_imagelist(master_region)
+        return master_region.target['facade'].download_image(
+            master_region, image.id, image.size)
+
+    def _cache_master(self, image):
+        """Return the path of a master image in the image cache, downloading
+        it from the master region if necessary, or None if it cannot be
+        cached"""
+        try:
+            return self.image_cache.store(
+                image.checksum, lambda: self._download_master(image),
+                image.size)
+        except Exception, e:
+            msg = 'Cannot save the image ' + image.name + ' in the image ' +\
+                'cache. Cause: ' + str(e)
+            self.log.warning(msg)
+            return None
+
+    def refresh_master(self, force=True):
+        """Update master_region_dict with the images of the master region.
+
+        The master images are shared with the other GlanceSync objects
+        through the master snapshot (see glancesync_snapshot): if the snapshot
+        is not expired, it is used without listing the master region. When
+        the master region is listed, but its fingerprint is the same than the
+        snapshot, the already processed snapshot is used too.
+
+        The images of master_region_dict must not be modified.
 
-        self.master_region_dict = self._master_images_to_dict(images)
-        glancesync_ami.clean_ami_ids(self.master_region_dict)
+        :param force: if True, always list the master region.
+        :return: True if the master images have changed.
+        """
+        snapshot = None
+        if not force:
+            snapshot = self.master_snapshot.get()
+        if snapshot:
+            (fingerprint, images_dict) = snapshot
+        else:
+            master_region = GlanceSyncRegion(self.master_region, self.targets)
+            images = master_region.target['facade'].get_imagelist(
+                master_region)
+            fingerprint = fingerprint_images(images)
+            images_dict = self.master_snapshot.get_by_fingerprint(fingerprint)
+            if images_dict is None:
+                images_dict = self._master_images_to_dict(images)
+                glancesync_ami.clean_ami_ids(images_dict)
+                self.master_snapshot.put(fingerprint, images_dict)
+
+        changed = fingerprint != self.master_fingerprint
+        self.master_fingerprint = fingerprint
+        self._master_region_dict = dict(images_dict)
+        return changed
 
     def get_regions(self, omit_master_region=True, target='master'):
         """It returns the list of regions
@@ -130,15 +248,210 @@ class GlanceSync(object):
         :param regionstr: A region specified as 'target:region'. The prefix
          'master:' may be omitted.
         :param dry_run: If true, images are not uploaded nor modified
-        :return: Nothing
+        :return: the number of bytes uploaded to the region
         """
 
+        region_sync = self._prepare_region_sync(regionstr, dry_run)
+        self._upload_region_images(region_sync, dry_run)
+        self._finish_region_sync(region_sync, dry_run)
+        return sum(int(tuple[1].size) for (tuple, msg) in region_sync.uploads)
+
+    def sync_regions_fanout(self, regionstrs, dry_run=False):
+        """sync several regions at the same time, reading each master image
+        only once.
+
+        The synchronisation is the same than the done by sync_region, but
+        the uploads are grouped by image: the image file is read once and its
+        content is uploaded to all the regions that need it at the same time
+        (see glancesync_fanout). Images are processed in ascending size
+        order, but the kernel and ramdisk of an AMI image are always uploaded
+        before the image. Each region uploads its images one after other, at
+        its own pace: the reading of an image starts when the first region
+        needs it, and a region that is not ready yet, or that is too slow,
+        reads the image by itself (see fanout_stall_timeout). When an
+        operation fails in a region, no more operations are done in that
+        region, but the other regions continue.
+
+        :param regionstrs: a list of regions, specified as 'target:region'.
+        :param dry_run: If true, images are not uploaded nor modified
+        :return: a list with the regions that could not be synchronised
+        """
+        (region_syncs, failed) = self._prepare_regions(regionstrs, dry_run)
+        if not dry_run:
+            uploads = dict()
+            for region_sync in region_syncs:
+                for (tuple, msg) in region_sync.uploads:
+                    uploads.setdefault(tuple[1].name, list()).append(
+                        (region_sync, tuple, msg))
+            order = list(image.name for image in dependency_order(list(
+                self.master_region_dict[name] for name in uploads)))
+            fanout = _Fanout(self.__fanout_reader, uploads, failed)
+            scheduler = UploadScheduler(len(region_syncs), stop_on_error=False)
+            for region_sync in region_syncs:
+                if region_sync.uploads and \
+                        region_sync.regionstr not in failed:
+                    scheduler.add_job(region_sync.regionstr,
+                                      self.__fanout_region_job(
+                                          region_sync, order, fanout))
+            errors = scheduler.run()
+            fanout.close()
+            failed.extend(sorted(errors))
+
+        self._finish_regions(region_syncs, failed, dry_run)
+        return failed
+
+    def sync_regions_scheduled(self, regionstrs, dry_run=False):
+        """sync several regions at the same time, scheduling the uploads of
+        all the regions together.
+
+        The synchronisation is the same than the done by sync_region, but
+        each pending upload (a region and an image) is a job of a global
+        TransferScheduler (see glancesync_upload). At most max_transfers
+        uploads run at the same time, max_concurrent_uploads per region and
+        max_target_transfers per target. When a slot is free, the next upload
+        is chosen using transfer_policy. When an operation fails in a region,
+        no more operations are done in that region, but the other regions
+        continue.
+
+        :param regionstrs: a list of regions, specified as 'target:region'.
+        :param dry_run: If true, images are not uploaded nor modified
+        :return: a list with the regions that could not be synchronised
+        """
+        (region_syncs, failed) = self._prepare_regions(regionstrs, dry_run)
+        if not dry_run:
+            scheduler = TransferScheduler(self.max_transfers,
+                                          self.transfer_policy)
+            for region_sync in region_syncs:
+                regionstr = region_sync.regionstr
+                target = region_sync.regionobj.target
+                scheduler.set_region_limit(
+                    regionstr, target.get('max_concurrent_uploads', 1))
+                scheduler.set_target_limit(
+                    target['target_name'],
+                    target.get('max_target_transfers', 0))
+                for (tuple, msg) in region_sync.uploads:
+                    scheduler.add_job(
+                        regionstr, tuple[1].name,
+                        self.__upload_job(tuple, region_sync.dictimages,
+                                          region_sync.regionobj, msg),
+                        tuple[1].size, ami_dependencies(tuple[1]),
+                        target['target_name'])
+            errors = scheduler.run()
+            for (regionstr, name) in sorted(errors):
+                error = errors[(regionstr, name)]
+                if isinstance(error, UploadSkippedException):
+                    self.log.warning(regionstr + ': ' + str(error))
+                if regionstr not in failed:
+                    failed.append(regionstr)
+
+        self._finish_regions(region_syncs, failed, dry_run)
+        return failed
+
+    def _prepare_regions(self, regionstrs, dry_run=False):
+        """Run _prepare_region_sync for each region.
+
+        :param regionstrs: a list of regions, specified as 'target:region'.
+        :param dry_run: If true, images are not modified
+        :return: a tuple with the list of _RegionSync objects and the list of
+          regions that failed.
+        """
+        region_syncs = list()
+        failed = list()
+        for regionstr in regionstrs:
+            try:
+                region_syncs.append(
+                    self._prepare_region_sync(regionstr, dry_run))
+            except Exception:
+                # Error already logged. Try next region.
+                failed.append(regionstr)
+        return (region_syncs, failed)
+
+    def _finish_regions(self, region_syncs, failed, dry_run=False):
+        """Run _finish_region_sync for each region that has not failed. The
+        regions that fail now are added to failed.
+
+        :param region_syncs: a list of _RegionSync objects.
+        :param failed: the list of regions that have failed.
+        :param dry_run: If true, images are not modified
+        :return: nothing
+        """
+        for region_sync in region_syncs:
+            if region_sync.regionstr in failed:
+                continue
+            try:
+                self._finish_region_sync(region_sync, dry_run)
+            except Exception:
+                failed.append(region_sync.regionstr)
+
+    def plan_region(self, regionstr, incremental=False):
+        """Calculate the operations needed to synchronise a region, without
+        doing any of them (see sync_region).
+
+        :param regionstr: A region specified as 'target:region'. The prefix
+         'master:' may be omitted.
+        :param incremental: if True, use the saved state of the region (see
+         _images_to_reconcile): the plan only considers the master images
+         changed since the last synchronisation, and it is empty if nothing
+         has changed.
+        :return: a SyncPlan object
+        """
         regionobj = GlanceSyncRegion(regionstr, self.targets)
-        facade = regionobj.target['facade']
         target = regionobj.target
         only_tenant_images = target['only_tenant_images']
         target['tenant_id'] = target['facade'].get_tenant_id()
-        imagesregion = self.get_images_region(regionstr, only_tenant_images)
+        master_region_dict = self.master_region_dict
+        plan = SyncPlan(regionstr, self.master_fingerprint)
+        if incremental:
+            plan.reconciled = self._images_to_reconcile(regionobj)
+        reconcile = plan.reconciled
+        if reconcile is not None and not reconcile:
+            # Nothing has changed since the last synchronisation
+            return plan
+
+        if reconcile is None:
+            # Only the images with the name of a master image (or of an
+            # obsolete master image) are relevant; the others are discarded
+            # while the list is received. When the images can be reused,
+            # the images with the checksum of a master image are kept too.
+            names = master_region_dict
+            checksums = set()
+            if target.get('reuse_images', False):
+                checksums = set(
+                    image.checksum for image in
+                    regionobj.images_to_sync_dict(names).values())
+            imagesregion = list(
+                image for image in self.iter_images_region(regionstr,
+                                                           only_tenant_images)
+                if image.name and (image.name in names or
+                                   image.name + '_obsolete' in names or
+                                   image.checksum in checksums))
+        elif target.get('reuse_images', False):
+            # The images that can be reused may have any name, so the region
+            # is listed completely, but only the images changed since the
+            # last synchronisation and the images with their checksum are
+            # kept. The images with the name of other master image are not
+            # candidates to reuse: they are synchronised.
+            names = master_region_dict
+            master_region_dict = dict(
+                (name, names[name]) for name in reconcile if name in names)
+            checksums = set(
+                image.checksum for image in
+                regionobj.images_to_sync_dict(master_region_dict).values())
+            imagesregion = list(
+                image for image in self.iter_images_region(regionstr,
+                                                           only_tenant_images)
+                if image.name and (image.name in reconcile or (
+                    image.checksum in checksums and image.name not in names)))
+        else:
+            # Only the images changed since the last synchronisation are
+            # requested to the region, by name.
+            master_region_dict = dict(
+                (name, master_region_dict[name]) for name in reconcile
+                if name in master_region_dict)
+            imagesregion = list()
+            for name in sorted(reconcile):
+                imagesregion.extend(self.iter_images_region(
+                    regionstr, only_tenant_images, filters={'name': name}))
 
         # Get a list of obsolete images in the region
         # they are managed differently that the other images to sync, because:
@@ -146,35 +459,133 @@ class GlanceSync(object):
         # * the name is changed (the _obsolete suffix is added)
         if target['support_obsolete_images']:
             syncprops = target.get('obsolete_syncprops', None)
-            obsolete = regionobj.image_list_to_obsolete(
-                self.master_region_dict, imagesregion, syncprops)
-        else:
-            obsolete = list()
+            plan.obsolete = regionobj.image_list_to_obsolete(
+                master_region_dict, imagesregion, syncprops)
+
+        master_images = regionobj.images_to_sync_dict(master_region_dict)
+        plan.region_images = regionobj.local_images_filtered(master_images,
+                                                             imagesregion)
+        # The obsolete images and the images with the name of a master image
+        # (e.g. an image already obsolete) are not reused: renaming them
+        # would conflict with their own synchronisation.
+        excluded = set(image.id for image in plan.obsolete)
+        excluded.update(image.id for image in imagesregion
+                        if image.name in master_region_dict)
+        reusable = regionobj.images_to_reuse(
+            master_images, RegionImageIndex(imagesregion), plan.region_images,
+            excluded)
+
+        # Important: tuples are sorted by image.size, in ascending order. This
+        # is important because:
+        # with AMI images, kernel/ramdisk must be uploaded before the image
+        # that refers them. They are smaller. When several uploads run at the
+        # same time, this is also guaranteed by the scheduler dependencies.
+        plan.tuples = regionobj.image_list_to_sync(
+            master_images, plan.region_images.values(), reusable)
+        # The reused images are kept with the name of the master image, the
+        # name they will have after the synchronisation.
+        plan.region_images.update(reusable)
+        return plan
+
+    def plan_regions(self, regionstrs, max_workers=1):
+        """Calculate the plans of several regions at the same time (see
+        plan_region), using a pool of max_workers threads.
+
+        :param regionstrs: a list of regions, specified as 'target:region'.
+        :param max_workers: the number of regions planned at the same time.
+        :return: a tuple with a dictionary of SyncPlan objects indexed by
+          region and the list of regions that failed.
+        """
+        # The master images are obtained before starting the threads
+        self.master_region_dict
+        plans = dict()
+        scheduler = UploadScheduler(max_workers, stop_on_error=False)
+        for regionstr in regionstrs:
+            def job(regionstr=regionstr):
+                plans[regionstr] = self.plan_region(regionstr)
+            scheduler.add_job(regionstr, job)
+        errors = scheduler.run()
+        for regionstr in sorted(errors):
+            self.log.error(regionstr + ': Cannot calculate the plan. Cause: ' +
+                           str(errors[regionstr]))
+        return (plans, list(regionstr for regionstr in regionstrs
+                            if regionstr in errors))
+
+    def execute_plan(self, plan, dry_run=False):
+        """Synchronise a region executing a plan returned by plan_region
+        (possibly in other process, see SyncPlan.from_json). The region is
+        not listed again.
+
+        The plan is refused if any of its master images has changed or has
+        been deleted since it was calculated.
+
+        :param plan: a SyncPlan object
+        :param dry_run: If true, images are not uploaded nor modified
+        :return: the number of bytes uploaded to the region
+        """
+        region_sync = self._start_plan(plan, dry_run)
+        self._upload_region_images(region_sync, dry_run)
+        self._finish_region_sync(region_sync, dry_run)
+        return sum(int(tuple[1].size) for (tuple, msg) in region_sync.uploads)
+
+    def _prepare_region_sync(self, regionstr, dry_run=False):
+        """First phase of the synchronisation of a region: get the region
+        images, calculate what is pending, update the obsolete images and the
+        metadata. The uploads are not started.
+
+        :param regionstr: A region specified as 'target:region'.
+        :param dry_run: If true, images are not modified
+        :return: a _RegionSync object, to pass to the following phases.
+        """
+        return self._start_plan(self.plan_region(regionstr, incremental=True),
+                                dry_run)
+
+    def _start_plan(self, plan, dry_run=False):
+        """Update the obsolete images and the metadata of a plan, and select
+        the uploads. The uploads are not started.
+
+        :param plan: a SyncPlan object
+        :param dry_run: If true, images are not modified
+        :return: a _RegionSync object, to pass to the following phases.
+        """
+        regionobj = GlanceSyncRegion(plan.region, self.targets)
+        facade = regionobj.target['facade']
+        # The master images of the plan may come from other process
+        tuples = list()
+        for (status, image) in plan.tuples:
+            master_image = self.master_region_dict.get(image.name, None)
+            if master_image is None or master_image.id != image.id or \
+                    master_image.checksum != image.checksum:
+                msg = '{0}: the plan is outdated: master image {1} has ' \
+                    'changed.'.format(regionobj.fullname, image.name)
+                self.log.error(msg)
+                raise Exception(msg)
+            tuples.append((status, master_image))
+        dictimages = plan.region_images
+        region_sync = _RegionSync(plan.region, regionobj, tuples, dictimages)
+        region_sync.reconciled = plan.reconciled
+        region_sync.master_fingerprint = plan.master_fingerprint
 
         # previous step: manage obsolete images. Obsolete images are not
         # synchronisable.
-        for image in obsolete:
+        for image in plan.obsolete:
             self.log.info(regionobj.fullname +
                           ': updating obsolete image ' + image.name)
             facade.update_metadata(regionobj, image)
 
-        master_images = regionobj.images_to_sync_dict(self.master_region_dict)
-        dictimages = regionobj.local_images_filtered(master_images,
-                                                     imagesregion)
-        imagesregion = dictimages.values()
-
-        # Important: tuples are sorted by image.size, in ascending order. This
-        # is important because:
-        # with AMI images, kernel/ramdisk must be uploaded before the image
-        # that refers them. They are smaller.
-        tuples = regionobj.image_list_to_sync(master_images, imagesregion)
-        totalmbs = 0
-        was_synchronised = True
-
-        # First, update metadata
+        # First, update metadata and rename the reused images
         for tuple in tuples:
-            if tuple[0] == 'pending_metadata':
-                was_synchronised = False
+            if tuple[0] == 'pending_reuse':
+                region_sync.was_synchronised = False
+                region_image = dictimages[tuple[1].name]
+                msg = '{0}: Reusing image {1} (UUID {2}) as {3}'.format(
+                    regionobj.fullname, region_image.name, region_image.id,
+                    tuple[1].name)
+                self.log.info(msg)
+                if not dry_run:
+                    self.__reuse_image(tuple[1], dictimages, regionobj)
+            elif tuple[0] == 'pending_metadata':
+                region_sync.was_synchronised = False
                 if dry_run:
                     self.log.info(regionobj.fullname +
                                   ': Image pending to update the metadata ' +
@@ -185,40 +596,26 @@ class GlanceSync(object):
                                   tuple[1].name)
                     self.__update_meta(tuple[1], dictimages, regionobj)
 
-        # Then, upload, replace, and rename_n_replace
+        # Then, select the images to upload, replace, and rename_n_replace.
         for tuple in tuples:
             uploaded = False
             sizeimage = float(tuple[1].size) / 1024 / 1024
             if tuple[0] == 'pending_upload':
                 uploaded = True
-                if not dry_run:
-                    self.log.info(regionobj.fullname + ': Uploading image ' +
-                                  tuple[1].name + ' (' + str(sizeimage) +
-                                  ' MB)')
-                    self.__upload_image(tuple[1], dictimages, regionobj)
-
+                msg = regionobj.fullname + ': Uploading image ' +\
+                    tuple[1].name + ' (' + str(sizeimage) + ' MB)'
             elif tuple[0] == 'pending_replace':
                 uploaded = True
-                region_image = dictimages[tuple[1].name]
-                self.log.info(regionobj.fullname + ': Replacing image ' +
-                              tuple[1].name + ' (' + str(sizeimage) +
-                              ' MB)')
-                if not dry_run:
-                    self.__upload_image(tuple[1], dictimages, regionobj)
-                    facade.delete_image(regionobj, region_image.id,
-                                        confirm=False)
+                msg = regionobj.fullname + ': Replacing image ' +\
+                    tuple[1].name + ' (' + str(sizeimage) + ' MB)'
+                if dry_run:
+                    self.log.info(msg)
             elif tuple[0] == 'pending_rename':
                 uploaded = True
-                region_image = dictimages[tuple[1].name]
-                self.log.info(
-                    regionobj.fullname + ': Renaming and replacing image ' + tuple[1].name + ' (' + str(sizeimage) +
-                    ' MB)')
-
-                if not dry_run:
-                    self.__upload_image(tuple[1], dictimages, regionobj)
-                    region_image.name += '.old'
-                    region_image.is_public = False
-                    facade.update_metadata(regionobj, region_image)
+                msg = regionobj.fullname + ': Renaming and replacing image ' +\
+                    tuple[1].name + ' (' + str(sizeimage) + ' MB)'
+                if dry_run:
+                    self.log.info(msg)
             elif tuple[0] == 'error_checksum':
                 region_image = dictimages[tuple[1].name]
                 msg =\
@@ -230,21 +627,69 @@ class GlanceSync(object):
                                             regionobj.fullname,
                                             region_image.checksum))
             if uploaded:
-                was_synchronised = False
-                totalmbs += sizeimage
+                region_sync.was_synchronised = False
+                region_sync.totalmbs += sizeimage
                 if dry_run:
                     self.log.info(regionobj.fullname + ': Pending: ' +
                                   tuple[1].name + ' (' + str(sizeimage) +
                                   ' MB)')
                 else:
-                    self.log.info(regionobj.fullname + ': Image uploaded.')
+                    region_sync.uploads.append((tuple, msg))
+        return region_sync
 
-        # Finally, update pending AMI ids
-        for tuple in tuples:
-            if tuple[0] == 'pending_ami':
-                self.__update_meta(tuple[1], dictimages, regionobj)
+    def _upload_region_images(self, region_sync, dry_run=False):
+        """Second phase of the synchronisation of a region: upload the images.
+
+        The uploads are run by a pool of max_concurrent_uploads threads; an
+        AMI image is not uploaded until its kernel and ramdisk are.
 
-        if was_synchronised:
+        :param region_sync: the object returned by _prepare_region_sync
+        :param dry_run: If true, images are not uploaded
+        :return: nothing
+        """
+        regionobj = region_sync.regionobj
+        scheduler = UploadScheduler(
+            regionobj.target.get('max_concurrent_uploads', 1))
+        for (tuple, msg) in region_sync.uploads:
+            scheduler.add_job(
+                tuple[1].name,
+                self.__upload_job(tuple, region_sync.dictimages, regionobj,
+                                  msg),
+                ami_dependencies(tuple[1]))
+
+        failed = scheduler.run()
+        if failed:
+            # The region is not synchronised: the uploads that were not
+            # started are cancelled and the pending AMI ids are not updated.
+            # The errors have been already logged by the facade.
+            errors = list()
+            for name in sorted(failed):
+                if isinstance(failed[name], UploadSkippedException):
+                    self.log.warning(regionobj.fullname + ': ' +
+                                     str(failed[name]))
+                else:
+                    errors.append(failed[name])
+            raise (errors or failed.values())[0]
+
+    def _finish_region_sync(self, region_sync, dry_run=False):
+        """Last phase of the synchronisation of a region: update the pending
+        AMI ids and print the summary.
+
+        :param region_sync: the object returned by _prepare_region_sync
+        :param dry_run: If true, images are not modified
+        :return: nothing
+        """
+        regionobj = region_sync.regionobj
+        for tuple in region_sync.tuples:
+            if tuple[0] == 'pending_ami':
+                self.__update_meta(tuple[1], region_sync.dictimages,
+                                   regionobj)
+
+        totalmbs = region_sync.totalmbs
+        if region_sync.reconciled == set():
+            self.log.info(regionobj.fullname + ': Region is synchronized '
+                          '(no changes since the last synchronisation).')
+        elif region_sync.was_synchronised:
             self.log.info(regionobj.fullname + ': Region is synchronized.')
         else:
             if dry_run:
@@ -254,6 +699,100 @@ class GlanceSync(object):
                 self.log.info(regionobj.fullname +
                               ':   Total uploaded to region: ' +
                               str(int(totalmbs)) + ' (MB) ')
+        if not dry_run:
+            self._save_region_state(region_sync)
+
+    def _images_to_reconcile(self, regionobj):
+        """Decide, using the saved state of the region, which master images
+        must be checked in the region.
+
+        The whole region is checked when there is no saved state, when the
+        target configuration has changed or when the region has not been
+        verified completely in the last verify_every runs. Otherwise, only
+        the master images changed since the last synchronisation are checked
+        (together with the kernel, ramdisk and AMI images related to them).
+
+        :param regionobj: the GlanceSyncRegion object
+        :return: None to check the whole region, or a set with the names of
+          the master images to check (it is empty if nothing has changed).
+        """
+        if self.sync_state is None:
+            return None
+        state = self.sync_state.get_region(regionobj.fullname)
+        if state is None or state.runs + 1 >= self.verify_every or \
+                state.target_fingerprint != \
+                target_fingerprint(regionobj.target):
+            return None
+        master_region_dict = self.master_region_dict
+        if state.master_fingerprint == self.master_fingerprint:
+            return set()
+
+        saved = self.sync_state.get_images(regionobj.fullname)
+        changed = set(name for name in master_region_dict
+                      if name not in saved or saved[name][0] !=
+                      image_fingerprint(master_region_dict[name]))
+        if len(changed) > max_changed_images:
+            return None
+        # Add the kernel and ramdisk of the changed AMI images and the AMI
+        # images that use a changed kernel or ramdisk.
+        pending = list(changed)
+        while pending:
+            name = pending.pop()
+            related = set()
+            if name in master_region_dict:
+                related.update(ami_dependencies(master_region_dict[name]))
+            related.update(
+                image.name for image in master_region_dict.values()
+                if name in ami_dependencies(image))
+            for related_name in related - changed:
+                changed.add(related_name)
+                pending.append(related_name)
+        # The images that have become obsolete are checked with the name
+        # they have in the region.
+        for name in list(changed):
+            if name.endswith('_obsolete'):
+                changed.add(name[:-len('_obsolete')])
+        return changed
+
+    def _save_region_state(self, region_sync):
+        """Save the state of a region that has been synchronised (see
+        _images_to_reconcile). The images with an error are not saved, to
+        check them again in the next run.
+
+        :param region_sync: the object returned by _prepare_region_sync
+        :return: nothing
+        """
+        if self.sync_state is None:
+            return
+        regionobj = region_sync.regionobj
+        master_region_dict = self.master_region_dict
+        if region_sync.master_fingerprint != self.master_fingerprint:
+            # The master images added or changed after calculating the plan
+            # have not been checked in the region.
+            msg = '{0}: the master images have changed since the plan was '\
+                'calculated. The state of the region is not saved.'
+            self.log.warning(msg.format(regionobj.fullname))
+            return
+        reconciled = region_sync.reconciled
+        if reconciled is None:
+            names = set(master_region_dict)
+        else:
+            names = reconciled.intersection(master_region_dict)
+        errors = set(tuple[1].name for tuple in region_sync.tuples
+                     if tuple[0].startswith('error'))
+        names.difference_update(errors)
+        images = dict()
+        for name in names:
+            master_image = master_region_dict[name]
+            region_image = region_sync.dictimages.get(name, None)
+            region_id = region_image.id if region_image else None
+            images[name] = (image_fingerprint(master_image), region_id,
+                            master_image.checksum)
+        self.sync_state.save_region(
+            regionobj.fullname, self.master_fingerprint,
+            target_fingerprint(regionobj.target), images,
+            names=set(master_region_dict) - errors,
+            verified=reconciled is None)
 
     def export_sync_region_status(self, regionstr, stream):
         """export a csv report about the images pending to sync in this region
@@ -267,6 +806,9 @@ class GlanceSync(object):
         the master image, but users specifically has asked don't update this
         image.
         *pending_upload: the image is not synchronised
+        *pending_reuse: the image is not synchronised, but there is an image
+        with the same checksum and other name that will be renamed instead of
+        uploading the image again.
         *pending_metadata: the image is uploaded, but some metadata must be
         updated.
         *pending_replace: the image must be replaced, because the checksum is
@@ -286,13 +828,9 @@ class GlanceSync(object):
         :return: Nothing
         """
         regionobj = GlanceSyncRegion(regionstr, self.targets)
-        target = regionobj.target
-        target['tenant_id'] = target['facade'].get_tenant_id()
-        imagesregion = self.get_images_region(regionstr)
-        path = 'syncstatus_' + regionobj.fullname + '.csv'
         try:
-            tuples = regionobj.image_list_to_sync(self.master_region_dict,
-                                                  imagesregion)
+            plan = self.plan_region(regionstr)
+            tuples = list(plan.tuples)
             tuples.sort(key=lambda tuple: int(tuple[1].size))
             writer = csv.writer(stream)
             for tuple in tuples:
@@ -358,14 +896,19 @@ class GlanceSync(object):
             path = 'backup_' + regionobj.fullname + '.csv'
         else:
             path = os.path.join(path, 'backup_' + regionobj.fullname + '.csv')
-        # Backup using csv
+        # Backup using csv. The images are written while they are received;
+        # the file is renamed at the end, so a failed backup does not leave
+        # an incomplete file.
         try:
-            images = regionobj.target['facade'].get_imagelist(regionobj)
-            with open(path, 'w') as csvfile:
+            images = regionobj.target['facade'].iter_imagelist(regionobj)
+            with open(path + '.tmp', 'w') as csvfile:
                 writer = csv.writer(csvfile)
                 for image in images:
                     writer.writerow(image.to_field_list())
+            os.rename(path + '.tmp', path)
         except Exception, e:
+            if os.path.exists(path + '.tmp'):
+                os.unlink(path + '.tmp')
             msg = '{0}:Error retrieving images from region. Cause {1}'
             msg = msg.format(regionstr, str(e))
             self.log.error(msg)
@@ -383,18 +926,32 @@ class GlanceSync(object):
         the tenant or without owner.
         :return: a list of GlanceSyncImage objects
         """
+        return list(self.iter_images_region(regionstr, only_tenant_images))
+
+    def iter_images_region(self, regionstr, only_tenant_images=False,
+                           filters=None):
+        """It iterates over the tenant's images in that region. The images
+        are requested to the server page by page, while they are consumed.
+
+        :param regionstr: A region specified as 'target:region'. The prefix
+         'master:' may be omitted.
+        :param only_tenant_images: If true, only include the images owned by
+        the tenant or without owner.
+        :param filters: optional dictionary to filter the images in the
+        server (keys: owner, status, is_public and name).
+        :return: a generator of GlanceSyncImage objects
+        """
 
         region = GlanceSyncRegion(regionstr, self.targets)
         facade = region.target['facade']
         region.target['tenant_id'] = facade.get_tenant_id()
-        if only_tenant_images:
-            return list(
-                image for image in facade.get_imagelist(region)
-                if image.name and
-                (not image.owner or image.owner.zfill(32) ==
-                 region.target['tenant_id'].zfill(32) or image.owner == ''))
-        else:
-            return facade.get_imagelist(region)
+        tenant_id = region.target['tenant_id'].zfill(32)
+        for image in facade.iter_imagelist(region, filters=filters):
+            if only_tenant_images and not (
+                    image.name and (not image.owner or
+                                    image.owner.zfill(32) == tenant_id)):
+                continue
+            yield image
 
     @staticmethod
     def init_logs(include_date=False):
@@ -430,29 +987,142 @@ class GlanceSync(object):
         # Just duplicate the assignement of logger_cli to the log variable
         # log = logger_cli
 
-    def __upload_image(self, master_image, images_dict, regionobj):
-        new_image = copy.deepcopy(master_image)
+    def __upload_image(self, master_image, images_dict, regionobj, data=None):
+        # only the properties to upload are copied
+        new_image = master_image.upload_descriptor(
+            regionobj.metadata_projection())
         # update kernel_id & ramdisk_id if necessary.
         glancesync_ami.update_kernelramdisk_id(
             new_image, master_image, images_dict)
-        # filter properties to upload
-        metadata_set = set(regionobj.target['metadata_set'])
-        properties = set(new_image.user_properties.keys())
-        if len(metadata_set) > 0:
-            diff = properties - metadata_set - set(['kernel_id', 'ramdisk_id'])
-            for p in diff:
-                del new_image.user_properties[p]
 
         # upload
-        uuid = regionobj.target['facade'].upload_image(
-            regionobj, new_image)
+        if data is None:
+            uuid = regionobj.target['facade'].upload_image(
+                regionobj, new_image)
+        else:
+            uuid = regionobj.target['facade'].upload_image(
+                regionobj, new_image, data)
 
         # update images_dict with the new image (needed for pending_ami images)
         images_dict[new_image.name] = GlanceSyncImage(
             new_image.name, uuid, regionobj.fullname)
 
+    def __fanout_reader(self, name, uploads, ready):
+        """Prepare the reader of a master image for several regions.
+
+        :param name: the name of the master image
+        :param uploads: a list of tuples (region_sync, tuple, msg)
+        :param ready: the region that is ready to upload the image; the
+          other regions are still uploading other images.
+        :return: a tuple (reader, failed). reader is a started FanoutReader
+          with a stream for each region, or None if each upload must read
+          the image by itself. failed is a list with the regions that cannot
+          upload the image.
+        """
+        image = self.master_region_dict[name]
+        path = os.path.join(self.images_dir, image.id)
+        regionstrs = list(upload[0].regionstr for upload in uploads)
+        if not os.path.exists(path):
+            # Each upload downloads the image from the master region, if the
+            # target allows it (see image_source)
+            local = list(
+                upload[0].regionstr for upload in uploads
+                if upload[0].regionobj.target.get('image_source') != 'master')
+            if local:
+                msg = 'Cannot open the image ' + name + ' to upload. ' +\
+                    'Cause: ' + path + ' does not exist'
+                self.log.error(msg)
+                regionstrs = list(regionstr for regionstr in regionstrs
+                                  if regionstr not in local)
+            # With the image cache, the image is downloaded only once
+            path = None
+            if regionstrs and self.image_cache is not None and \
+                    image.checksum:
+                path = self._cache_master(image)
+            if not path:
+                return (None, local)
+        reader = FanoutReader(path, regionstrs,
+                              stall_timeout=self.fanout_stall_timeout,
+                              ready=[ready])
+        try:
+            reader.start()
+        except IOError, e:
+            if path != os.path.join(self.images_dir, image.id):
+                # the cache entry has been evicted just now
+                return (None, local)
+            msg = 'Cannot open the image ' + name + ' to upload. ' +\
+                'Cause: ' + str(e)
+            self.log.error(msg)
+            return (None, list(upload[0].regionstr for upload in uploads))
+        return (reader, list())
+
+    def __fanout_region_job(self, region_sync, order, fanout):
+        """Return a function that uploads the pending images of a region, in
+        the order of the list order, reading their content from the _Fanout
+        object. It stops at the first error."""
+        pending = dict((tuple[1].name, (tuple, msg))
+                       for (tuple, msg) in region_sync.uploads)
+        regionstr = region_sync.regionstr
+
+        def job():
+            try:
+                for name in (name for name in order if name in pending):
+                    (tuple, msg) = pending[name]
+                    stream = fanout.stream(name, regionstr)
+                    try:
+                        self.__upload_job(
+                            tuple, region_sync.dictimages,
+                            region_sync.regionobj, msg, stream)()
+                    finally:
+                        if stream:
+                            stream.close()
+            except Exception:
+                fanout.abandon(regionstr)
+                raise
+
+        return job
+
+    def __upload_job(self, tuple, images_dict, regionobj, msg, data=None):
+        """Return a function that uploads the image of the tuple, and then
+        deletes or renames the old regional image if the status is
+        pending_replace or pending_rename. msg is logged when starting. If
+        data is provided, the content of the image is read from it."""
+        (status, master_image) = tuple
+        facade = regionobj.target['facade']
+
+        def job():
+            self.log.info(msg)
+            region_image = images_dict.get(master_image.name, None)
+            self.__upload_image(master_image, images_dict, regionobj, data)
+            if status == 'pending_replace':
+                facade.delete_image(regionobj, region_image.id,
+                                    confirm=False)
+            elif status == 'pending_rename':
+                previous = region_image.clone()
+                region_image.name += '.old'
+                region_image.is_public = False
+                facade.update_metadata(regionobj, region_image, previous)
+            self.log.info(regionobj.fullname + ': Image uploaded.')
+
+        return job
+
+    def __reuse_image(self, master_image, images_dict, regionobj):
+        """Rename the region image with the checksum of master_image and
+        copy the metadata of the master image, as if it were uploaded"""
+        image = images_dict[master_image.name]
+        previous = image.clone()
+        image.name = master_image.name
+        image.user_properties = master_image.upload_descriptor(
+            regionobj.metadata_projection()).user_properties
+        glancesync_ami.update_kernelramdisk_id(
+            image, master_image, images_dict)
+        image.is_public = master_image.is_public
+        regionobj.target['facade'].update_metadata(regionobj, image, previous)
+
     def __update_meta(self, master_image, images_dict, regionobj):
         image = images_dict[master_image.name]
+        # only the changes are sent to the region
+        previous = image.clone()
         glancesync_ami.update_kernelramdisk_id(
             image, master_image, images_dict)
         metadata_set = regionobj.target['metadata_set']
@@ -462,13 +1132,13 @@ class GlanceSync(object):
                     # This values are already updated
                     if prop == 'kernel_id' or prop == 'ramdisk_id':
                         continue
-                    image.user_properties[prop] = \
+                    image.modifiable_properties()[prop] = \
                         master_image.user_properties[prop]
                 else:
                     if prop in image.user_properties:
-                        del image.user_properties[prop]
+                        del image.modifiable_properties()[prop]
         image.is_public = master_image.is_public
-        regionobj.target['facade'].update_metadata(regionobj, image)
+        regionobj.target['facade'].update_metadata(regionobj, image, previous)
 
     def _master_images_to_dict(self, images):
         """Convert the list of images to a dictionary. Remove images with a
@@ -500,3 +1170,126 @@ class GlanceSync(object):
                       if image.name not in duplicated)
 
         return images
+
+
+class _RegionSync(object):
+    """The state of the synchronisation of a region, shared between the
+    phases of the synchronisation"""
+
+    def __init__(self, regionstr, regionobj, tuples, dictimages):
+        self.regionstr = regionstr
+        self.regionobj = regionobj
+        self.tuples = tuples
+        self.dictimages = dictimages
+        # list of tuples ((status, master_image), msg) to upload
+        self.uploads = list()
+        self.totalmbs = 0
+        self.was_synchronised = True
+        # names of the images reconciled, or None if all were checked
+        self.reconciled = None
+        # fingerprint of the master images used to calculate the plan
+        self.master_fingerprint = None
+
+
+class _Fanout(object):
+    """The readers of the master images in sync_regions_fanout. The reader
+    of an image is started when the first region reaches it; this way each
+    region uploads its images at its own pace, and a slow region does not
+    delay the start of the next image in the other regions."""
+
+    def __init__(self, open_reader, uploads, abandoned=()):
+        """
+        :param open_reader: a function with the parameters (name, uploads,
+          ready) that returns a tuple (reader, failed); see __fanout_reader.
+        :param uploads: a dictionary with the list of tuples (region_sync,
+          tuple, msg) of each image name.
+        :param abandoned: the regions that do not upload any image.
+        """
+        self._open_reader = open_reader
+        self._uploads = uploads
+        self._readers = dict()
+        self._locks = dict((name, threading.Lock()) for name in uploads)
+        self._lock = threading.Lock()
+        # regions that do not upload more images
+        self._abandoned = set(abandoned)
+
+    def stream(self, name, regionstr):
+        """Return the stream with the content of the image for the region,
+        or None if the upload must read the image by itself. An exception is
+        raised if the region cannot upload the image."""
+        with self._locks[name]:
+            if name not in self._readers:
+                with self._lock:
+                    abandoned = set(self._abandoned)
+                uploads = list(upload for upload in self._uploads[name]
+                               if upload[0].regionstr not in abandoned)
+                (reader, failed) = self._open_reader(name, uploads,
+                                                     regionstr)
+                with self._lock:
+                    self._readers[name] = (reader, failed)
+                    abandoned = set(self._abandoned)
+                if reader:
+                    # regions abandoned while the reader was being opened
+                    for other in abandoned.intersection(reader.streams):
+                        reader.streams[other].close()
+            (reader, failed) = self._readers[name]
+        if regionstr in failed:
+            raise Exception('Cannot open the image ' + name)
+        if reader is None:
+            return None
+        stream = reader.streams[regionstr]
+        stream.ready = True
+        return stream
+
+    def abandon(self, regionstr):
+        """Close the streams of a region that does not upload more images,
+        so the readers do not wait for it"""
+        with self._lock:
+            self._abandoned.add(regionstr)
+            readers = list(self._readers.values())
+        for (reader, failed) in readers:
+            if reader and regionstr in reader.streams:
+                reader.streams[regionstr].close()
+
+    def close(self):
+        """Close all the streams and wait for the readers"""
+        for (reader, failed) in self._readers.values():
+            if reader:
+                for stream in reader.streams.values():
+                    stream.close()
+                reader.join()
+
+
+class _LazyFacade(object):
+    """Proxy of the facade of a target, that creates it on first use. The
+    attributes set before the creation (e.g. images_dir) are passed to the
+    facade when it is created."""
+
+    def __init__(self, factory, target):
+        object.__setattr__(self, '_factory', factory)
+        object.__setattr__(self, '_target', target)
+        object.__setattr__(self, '_facade', None)
+        object.__setattr__(self, '_attributes', dict())
+        object.__setattr__(self, '_lock', threading.Lock())
+
+    def _get_facade(self):
+        """return the facade, creating it if necessary"""
+        with self._lock:
+            if self._facade is None:
+                facade = self._factory(self._target)
+                for (name, value) in self._attributes.items():
+                    setattr(facade, name, value)
+                object.__setattr__(self, '_facade', facade)
+            return self._facade
+
+    def __getattr__(self, name):
+        if self._facade is None and name in self._attributes:
+            return self._attributes[name]
+        return getattr(self._get_facade(), name)
+
+    def __setattr__(self, name, value):
+        with self._lock:
+            if self._facade is None:
+                self._attributes[name] = value
+                return
+        setattr(self._facade, name, value)
@@ -56,17 +56,17 @@ def clean_ami_ids(image_dict):
         if 'kernel_id' in image.user_properties:
             # Prevent curious bug, images with empty values
             if not image.user_properties['kernel_id']:
-                del image.user_properties['kernel_id']
+                del image.modifiable_properties()['kernel_id']
             else:
-                image.user_properties['kernel_id'] = \
+                image.modifiable_properties()['kernel_id'] = \
                     master_region_dictimagesbyid[
                         image.user_properties['kernel_id']].name
 
         if 'ramdisk_id' in image.user_properties:
             if not image.user_properties['ramdisk_id']:
-                del image.user_properties['ramdisk_id']
+                del image.modifiable_properties()['ramdisk_id']
             else:
-                image.user_properties['ramdisk_id'] = \
+                image.modifiable_properties()['ramdisk_id'] = \
                     master_region_dictimagesbyid[image.user_properties[
                         'ramdisk_id']].name
 
@@ -116,7 +116,7 @@ def _update_auximg_id(property_id, image, master_image, images_region):
             result = False
         else:
             # remove property
-            del image.user_properties[property_id]
+            del image.modifiable_properties()[property_id]
             result = True
     else:
         # Get the name of the kernel/ramdisk image
@@ -132,7 +132,8 @@ def _update_auximg_id(property_id, image, master_image, images_region):
                                        property_id, image.name))
             # Put the aux image name; this provides information to the caller
             # about the missing image. Put '__' as prefix.
-            image.user_properties[property_id] = '__' + aux_image_name
+            image.modifiable_properties()[property_id] = \
+                '__' + aux_image_name
             result = True
         else:
             aux_image = images_region[aux_image_name]
@@ -140,7 +141,7 @@ def _update_auximg_id(property_id, image, master_image, images_region):
                     aux_image.id == image.user_properties[property_id]:
                 result = False
             else:
-                image.user_properties[property_id] = aux_image.id
+                image.modifiable_properties()[property_id] = aux_image.id
                 result = True
 
     return result
@@ -0,0 +1,334 @@
+#!/usr/bin/env python
+# -- encoding: utf-8 --
+#
+# Copyright 2015-2016 Telefónica Investigación y Desarrollo, S.A.U
+#
+# This file is part of FI-WARE project.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+#
+# You may obtain a copy of the License at:
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# For those usages not covered by the Apache version 2.0 License please
+# contact with opensource@tid.es
+#
+
+import errno
+import fcntl
+import hashlib
+import os
+import re
+import threading
+
+from app.settings.settings import logger_cli
+
+from glancesync_source import ImageFile, default_block_size
+
+"""This internal module keeps a local cache of the content of the master
+images, when they are downloaded from the master region (see the option
+image_source). This way, uploading an image to several regions costs only
+one download.
+
+The entries are files named with the checksum of the image. An entry is
+filled while the content is uploaded to the first region: it is written to a
+temporary file that is renamed when the whole content has been read and its
+MD5 is the checksum. Only a thread or process fills an entry at a time (the
+others download the content without caching it); this is coordinated with a
+lock file per entry, so several processes may share the directory. The lock
+files are empty and they are kept when their entries are evicted. Other files
+in the directory are ignored: only the files named with a MD5 (that is the
+name of any entry, because the content is checked) are counted and evicted.
+
+The size of the cache is bounded by max_size. When an entry is added, the
+least recently used entries are removed until the cache fits. The
+modification time of the entries is the time of their last use. Removing an
+entry that is being read is safe: the readers keep the file open.
+"""
+
+# The name of an entry: the checksum (MD5) of its content
+_entry_name = re.compile('^[0-9a-f]{32}$')
+
+
+class BlobCache(object):
+    """Cache of the content of the images, indexed by checksum"""
+
+    def __init__(self, directory, max_size):
+        """Create the cache.
+
+        :param directory: the directory of the cache; it is created if it
+          does not exist.
+        :param max_size: the maximum size of the cache, in bytes.
+        """
+        self.log = logger_cli
+        self.directory = directory
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.fills = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        try:
+            os.makedirs(directory)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    def _path(self, checksum):
+        """helper method, to get the path of the entry of checksum"""
+        return os.path.join(self.directory, checksum)
+
+    def _count(self, counter, checksum):
+        """helper method, to increment a counter and log it"""
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+            stats = self.statistics()
+        msg = 'Image cache {0} of {1} (hits: {2}, misses: {3})'
+        self.log.info(msg.format(counter[:-1], checksum, stats['hits'],
+                                 stats['misses']))
+
+    def statistics(self):
+        """Return a dictionary with the number of hits, misses, fills (the
+        entries added) and evictions of this object"""
+        return {'hits': self.hits, 'misses': self.misses,
+                'fills': self.fills, 'evictions': self.evictions}
+
+    def lookup(self, checksum):
+        """Return the path of the entry of checksum, or None if it is not in
+        the cache. The entry becomes the most recently used."""
+        path = self._path(checksum)
+        try:
+            os.utime(path, None)
+        except OSError:
+            self._count('misses', checksum)
+            return None
+        self._count('hits', checksum)
+        return path
+
+    def open(self, checksum, drop_cache=True):
+        """Open the entry of checksum.
+
+        :param checksum: the checksum of the image.
+        :param drop_cache: see glancesync_source.ImageFile.
+        :return: an ImageFile, or None if the entry is not in the cache.
+        """
+        path = self.lookup(checksum)
+        if path is None:
+            return None
+        try:
+            return ImageFile(path, drop_cache=drop_cache)
+        except EnvironmentError:
+            # it has been removed just now
+            return None
+
+    def fill(self, checksum, data, size=None, wait=False):
+        """Return a file-like object that reads data and saves the content
+        in the entry of checksum.
+
+        The entry is added when the end of data is reached, if the MD5 of
+        the content is the checksum. If the content does not fit in the
+        cache or other thread or process is filling the same entry (and wait
+        is False), data itself is returned.
+
+        :param checksum: the checksum of the image.
+        :param data: a file-like object with the content of the image.
+        :param size: the size of the image, if known.
+        :param wait: wait for the other thread or process filling the entry,
+          instead of returning data.
+        :return: a CacheFill object, or data.
+        """
+        if size is not None and size > self.max_size:
+            return data
+        lock = self._acquire(checksum, wait)
+        if lock is None:
+            return data
+        file_obj = self._open_temp(checksum)
+        if file_obj is None:
+            lock.close()
+            return data
+        return CacheFill(self, checksum, data, file_obj, lock)
+
+    def store(self, checksum, download, size=None):
+        """Return the path of the entry of checksum, filling it first if it is
+        not in the cache. If other thread or process is filling the entry,
+        it waits for it.
+
+        :param checksum: the checksum of the image.
+        :param download: a function without parameters that returns a
+          file-like object with the content; it is only invoked on a miss.
+        :param size: the size of the image, if known.
+        :return: the path of the entry, or None if the image does not fit in
+          the cache or the entry could not be filled.
+        """
+        path = self.lookup(checksum)
+        if path is not None:
+            return path
+        if size is not None and size > self.max_size:
+            return None
+        lock = self._acquire(checksum, True)
+        try:
+            if not os.path.exists(self._path(checksum)):
+                data = download()
+                file_obj = self._open_temp(checksum)
+                if file_obj is None:
+                    data.close()
+                    return None
+                fill = CacheFill(self, checksum, data, file_obj, lock)
+                # the lock is released by fill
+                lock = None
+                with fill:
+                    while fill.read(default_block_size):
+                        pass
+        finally:
+            if lock is not None:
+                lock.close()
+        if os.path.exists(self._path(checksum)):
+            return self._path(checksum)
+        return None
+
+    def _acquire(self, checksum, wait):
+        """helper method, to lock the entry of checksum. It returns the open
+        lock file (close it to release the lock), or None if wait is False
+        and the entry is locked by other thread or process."""
+        lock = open(self._path(checksum) + '.lock', 'w')
+        try:
+            if wait:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            else:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            lock.close()
+            return None
+        return lock
+
+    def _open_temp(self, checksum):
+        """helper method, to create the temporary file of an entry. It
+        returns None if it cannot be created."""
+        temp = '{0}.{1}.{2}.tmp'.format(self._path(checksum), os.getpid(),
+                                        threading.current_thread().ident)
+        try:
+            return open(temp, 'wb')
+        except IOError, e:
+            msg = 'Cannot add {0} to the image cache. Cause: {1}'
+            self.log.warning(msg.format(checksum, str(e)))
+            return None
+
+    def _add(self, checksum, temp):
+        """Rename the temporary file of an entry, and evict the least
+        recently used entries if the cache is full. Must be invoked with the
+        lock of the entry acquired."""
+        os.rename(temp, self._path(checksum))
+        self._count('fills', checksum)
+        entries = list()
+        total = 0
+        for name in os.listdir(self.directory):
+            if not _entry_name.match(name):
+                # temporary and lock files, and files not owned by the cache
+                continue
+            try:
+                stat = os.stat(os.path.join(self.directory, name))
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, name, stat.st_size))
+            total += stat.st_size
+        for (mtime, name, size) in sorted(entries):
+            if total <= self.max_size:
+                break
+            if name == checksum:
+                continue
+            try:
+                os.unlink(os.path.join(self.directory, name))
+            except OSError:
+                continue
+            total -= size
+            self._count('evictions', name)
+            # The lock file is never removed: other thread or process may
+            # be waiting for it, and a new lock file would not exclude it.
+
+
+class CacheFill(object):
+    """File-like object that reads other file-like object and writes the
+    content in a temporary file of the cache. It also computes the MD5 of the
+    content."""
+
+    def __init__(self, cache, checksum, data, file_obj, lock):
+        self.md5 = hashlib.md5()
+        self.size = getattr(data, 'size', None)
+        self._cache = cache
+        self._checksum = checksum
+        self._data = data
+        self._file = file_obj
+        self._lock = lock
+
+    def read(self, size=-1):
+        chunk = self._data.read(size)
+        if chunk:
+            self.md5.update(chunk)
+            if self._file:
+                try:
+                    self._file.write(chunk)
+                except IOError, e:
+                    msg = 'Cannot add {0} to the image cache. Cause: {1}'
+                    self._cache.log.warning(msg.format(self._checksum,
+                                                       str(e)))
+                    self._discard()
+        if self._file and (size < 0 or (size != 0 and not chunk)):
+            # read(-1) returns the rest of the content
+            self._finish()
+        return chunk
+
+    def __iter__(self):
+        while True:
+            chunk = self.read(default_block_size)
+            if not chunk:
+                break
+            yield chunk
+
+    def _finish(self):
+        """helper method, to add the entry at the end of the content"""
+        if self.md5.hexdigest() != self._checksum:
+            self._discard()
+            return
+        try:
+            self._file.close()
+            self._cache._add(self._checksum, self._file.name)
+        except EnvironmentError, e:
+            msg = 'Cannot add {0} to the image cache. Cause: {1}'
+            self._cache.log.warning(msg.format(self._checksum, str(e)))
+            self._discard()
+        finally:
+            self._file = None
+            self._lock.close()
+
+    def _discard(self):
+        """helper method, to remove the temporary file"""
+        if self._file:
+            self._file.close()
+            try:
+                os.unlink(self._file.name)
+            except OSError:
+                pass
+            self._file = None
+            self._lock.close()
+
+    def close(self):
+        """Close the object. If the end of the content has not been reached,
+        the entry is not added."""
+        self._discard()
+        if hasattr(self._data, 'close'):
+            self._data.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,283 @@
+#!/usr/bin/env python
+# -- encoding: utf-8 --
+#
+# Copyright 2015-2016 Telefónica Investigación y Desarrollo, S.A.U
+#
+# This file is part of FI-WARE project.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+#
+# You may obtain a copy of the License at:
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# For those usages not covered by the Apache version 2.0 License please
+# contact with opensource@tid.es
+#
+
+import ast
+import re
+
+"""This internal module compiles the metadata_condition of the targets.
+
+A condition is a Python expression, but only a safe subset is accepted:
+boolean operators, comparisons (including in and not in), arithmetic on
+numbers (but not powers), constants, tuples, lists and sets, indexing,
+generator expressions, the names image and metadata_set, the attributes of
+the image, the methods of allowed_methods (e.g. get, startswith or
+intersection), and the functions len, int, float, str, bool, any, all,
+match(pattern, string) and search(pattern, string) (regular expressions).
+For example:
+
+  image.is_public and image.user_properties.get('type') == 'baseimage'
+  search('^base_', image.name) and 'nid' in image.user_properties
+  image.is_public and (not metadata_set or
+                       metadata_set.intersection(image.user_properties))
+  image.size > 1024 * 1024 and any(key.startswith('sdc_') for key in
+                                   image.user_properties)
+
+The expression is checked and compiled once into a function without access
+to the builtins, so evaluating it does not need a new globals dictionary for
+each image. The result is cached per image UUID, with the checksum, the other
+fields and the properties of the image (and metadata_set): when the master
+region is listed again (e.g. with --watch), only the new and changed images
+are evaluated. The synchronisable images of each target are also cached (see
+GlanceSyncRegion.images_to_sync_dict).
+"""
+
+# attributes of GlanceSyncImage that a condition may use
+image_fields = ('name', 'id', 'region', 'owner', 'is_public', 'checksum',
+                'size', 'status', 'user_properties')
+
+# methods that a condition may invoke
+allowed_methods = ('get', 'has_key', 'keys', 'values', 'items', 'startswith',
+                   'endswith', 'lower', 'upper', 'strip', 'intersection',
+                   'issubset', 'issuperset', 'union', 'difference')
+
+# arithmetic operators; their operands must be numbers
+allowed_operators = (ast.Add, ast.Sub, ast.Mult, ast.Div, ast.FloorDiv,
+                     ast.Mod)
+
+allowed_functions = {
+    'len': len, 'int': int, 'float': float, 'str': str, 'bool': bool,
+    'any': any, 'all': all,
+    'match': lambda pattern, string: re.match(pattern, string) is not None,
+    'search': lambda pattern, string: re.search(pattern, string) is not None,
+}
+
+constants = {'True': True, 'False': False, 'None': None}
+
+
+class MetadataCondition(object):
+    """A compiled metadata_condition. The object is invoked with the image
+    and the metadata_set of the target and returns the value of the
+    expression; the value is cached while the image does not change."""
+
+    def __init__(self, source):
+        """Compile the condition.
+
+        A ValueError is raised if the expression is not valid or it uses
+        something not included in the safe subset.
+
+        :param source: the text of the expression
+        """
+        self.source = source
+        try:
+            tree = ast.parse(source.strip(), '<metadata_condition>', 'eval')
+        except SyntaxError, e:
+            raise ValueError('Invalid metadata_condition: ' + str(e))
+        # the syntax tree, to compare conditions regardless of the spaces
+        self.normalized = ast.dump(tree)
+        self._function = self._compile(tree)
+        # tuple (signature, result) by image UUID
+        self._results = dict()
+
+    def __call__(self, image, metadata_set=None):
+        try:
+            signature = (image.checksum, image.name, image.is_public,
+                         image.size, image.status, image.owner, image.region,
+                         frozenset(image.user_properties.items()),
+                         frozenset(metadata_set or ()))
+        except TypeError:
+            # a property with a value that is not hashable: not cached
+            return self._function(image, metadata_set)
+        cached = self._results.get(image.id)
+        if cached is not None and cached[0] == signature:
+            return cached[1]
+        result = self._function(image, metadata_set)
+        self._results[image.id] = (signature, result)
+        return result
+
+    def evaluate_many(self, images, metadata_set=None):
+        """Evaluate the condition for several images.
+
+        :param images: an iterable of images
+        :param metadata_set: the metadata_set of the target
+        :return: a list with the result for each image
+        """
+        return list(self(image, metadata_set) for image in images)
+
+    def __eq__(self, other):
+        return isinstance(other, MetadataCondition) and \
+            self.normalized == other.normalized
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __hash__(self):
+        return hash(self.normalized)
+
+    def __repr__(self):
+        return 'MetadataCondition(' + repr(self.source) + ')'
+
+    def _check(self, node, names=frozenset()):
+        """Check that the node of the syntax tree (and its children) are in
+        the safe subset. A ValueError is raised otherwise.
+
+        :param node: the node to check
+        :param names: the variables of the enclosing generator expressions
+        """
+        if isinstance(node, ast.GeneratorExp):
+            self._check_generator(node, names)
+            return
+        if isinstance(node, ast.BoolOp):
+            children = node.values
+        elif isinstance(node, ast.UnaryOp) and \
+                isinstance(node.op, (ast.Not, ast.USub, ast.UAdd)):
+            children = [node.operand]
+        elif isinstance(node, ast.BinOp) and \
+                isinstance(node.op, allowed_operators):
+            children = [node.left, node.right]
+        elif isinstance(node, ast.Compare):
+            children = [node.left] + node.comparators
+        elif isinstance(node, ast.Name) and node.id != 'image' and (
+                node.id == 'metadata_set' or node.id in constants or
+                node.id in names):
+            children = []
+        elif isinstance(node, (ast.Num, ast.Str)):
+            children = []
+        elif isinstance(node, (ast.Tuple, ast.List, ast.Set)):
+            children = node.elts
+        elif isinstance(node, ast.Attribute) and \
+                isinstance(node.value, ast.Name) and \
+                node.value.id == 'image' and node.attr in image_fields:
+            children = []
+        elif isinstance(node, ast.Subscript) and \
+                isinstance(node.slice, ast.Index):
+            children = [node.value, node.slice.value]
+        elif isinstance(node, ast.Call) and not node.keywords and \
+                node.starargs is None and node.kwargs is None and (
+                    isinstance(node.func, ast.Name) and
+                    node.func.id in allowed_functions):
+            children = node.args
+        elif isinstance(node, ast.Call) and not node.keywords and \
+                node.starargs is None and node.kwargs is None and (
+                    isinstance(node.func, ast.Attribute) and
+                    node.func.attr in allowed_methods):
+            children = [node.func.value] + node.args
+        else:
+            raise ValueError('metadata_condition: expression not allowed: ' +
+                             _describe(node))
+        for child in children:
+            self._check(child, names)
+
+    def _check_generator(self, node, names):
+        """Check a generator expression (e.g. the argument of any). The
+        variables of each for clause must be simple names."""
+        for generator in node.generators:
+            self._check(generator.iter, names)
+            targets = [generator.target]
+            if isinstance(generator.target, ast.Tuple):
+                targets = generator.target.elts
+            for target in targets:
+                if not isinstance(target, ast.Name) or \
+                        target.id in ('image', 'metadata_set') or \
+                        target.id in constants or \
+                        target.id in allowed_functions or \
+                        target.id.startswith('_'):
+                    raise ValueError(
+                        'metadata_condition: expression not allowed: ' +
+                        'for ' + _describe(target))
+            names = names.union(target.id for target in targets)
+            for condition in generator.ifs:
+                self._check(condition, names)
+        self._check(node.elt, names)
+
+    def _compile(self, tree):
+        """Check the syntax tree and convert it in a function (image,
+        metadata_set). The function has no access to the builtins."""
+        self._check(tree.body)
+        _NumberOperands().visit(tree)
+        arguments = ast.arguments(
+            args=[ast.Name('image', ast.Param()),
+                  ast.Name('metadata_set', ast.Param())],
+            vararg=None, kwarg=None, defaults=[])
+        function = ast.Expression(ast.Lambda(arguments, tree.body))
+        ast.fix_missing_locations(function)
+        code = compile(function, '<metadata_condition>', 'eval')
+        globals_dict = {'__builtins__': {}}
+        globals_dict.update(allowed_functions)
+        globals_dict.update(constants)
+        globals_dict['_number'] = _number
+        return eval(code, globals_dict)
+
+
+def compile_condition(source):
+    """Compile a metadata_condition (see MetadataCondition).
+
+    :param source: the text of the expression
+    :return: a MetadataCondition object
+    """
+    return MetadataCondition(source)
+
+
+def _number(value):
+    """Return value if it is a number; otherwise raise a TypeError. It is
+    applied to the operands of the arithmetic operators, so a condition
+    cannot build huge strings or lists."""
+    if not isinstance(value, (int, long, float)):
+        raise TypeError('metadata_condition: arithmetic on a ' +
+                        type(value).__name__)
+    return value
+
+
+class _NumberOperands(ast.NodeTransformer):
+    """Wrap the operands of the arithmetic operators with _number"""
+
+    def visit_BinOp(self, node):
+        self.generic_visit(node)
+        node.left = self._wrap(node.left)
+        node.right = self._wrap(node.right)
+        return node
+
+    def visit_UnaryOp(self, node):
+        self.generic_visit(node)
+        if not isinstance(node.op, ast.Not):
+            node.operand = self._wrap(node.operand)
+        return node
+
+    @staticmethod
+    def _wrap(node):
+        call = ast.Call(ast.Name('_number', ast.Load()), [node], [], None,
+                        None)
+        return ast.copy_location(call, node)
+
+
+def _describe(node):
+    """Return a description of a node, for the error messages"""
+    description = type(node).__name__
+    if isinstance(node, ast.Name):
+        description += ' ' + node.id
+    elif isinstance(node, ast.Attribute):
+        description += ' ' + node.attr
+    elif isinstance(node, ast.Call):
+        description += ' ' + _describe(node.func)
+    return description
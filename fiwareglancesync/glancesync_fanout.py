@@ -0,0 +1,240 @@
+#!/usr/bin/env python
+# -- encoding: utf-8 --
+#
+# Copyright 2015-2016 Telefónica Investigación y Desarrollo, S.A.U
+#
+# This file is part of FI-WARE project.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+#
+# You may obtain a copy of the License at:
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# For those usages not covered by the Apache version 2.0 License please
+# contact with opensource@tid.es
+#
+
+import threading
+import time
+import Queue
+
+from app.settings.settings import logger_cli
+
+"""This internal module reads a master image file once and passes its content
+to several uploads at the same time.
+
+Each destination receives a file-like object. A reader thread reads the file
+chunk by chunk and puts every chunk in the bounded queue of each destination.
+When the queue of a destination is full for more than stall_timeout seconds,
+that destination is detached: the reader does not wait for it anymore and the
+destination continues reading the rest of the file by itself, at its own pace.
+This way a slow region does not stall the fastest ones. A destination that is
+not ready yet (e.g. a region still uploading the previous image) is detached
+as soon as its queue is full, without waiting.
+"""
+
+# Default size of the chunks read from the file (bytes)
+default_chunk_size = 1024 * 1024
+# Default number of chunks buffered for each destination
+default_queue_chunks = 16
+# Default time (seconds) a destination may block the reader
+default_stall_timeout = 60
+
+_eof = None
+
+
+class FanoutReader(object):
+    """Read a file once and stream its content to several destinations"""
+
+    def __init__(self, path, destinations, chunk_size=default_chunk_size,
+                 queue_chunks=default_queue_chunks,
+                 stall_timeout=default_stall_timeout, ready=None):
+        """Create the reader. The file is not read until start is invoked.
+
+        :param path: the path of the file to read.
+        :param destinations: a list with the names of the destinations (e.g.
+          the region names).
+        :param chunk_size: size of each read.
+        :param queue_chunks: maximum number of chunks queued per destination.
+        :param stall_timeout: seconds that the reader waits for a destination
+          with a full queue before detaching it.
+        :param ready: the destinations that are ready to read. By default, all
+          of them. The others may be marked as ready later (see
+          FanoutStream.ready).
+        """
+        self.log = logger_cli
+        self.path = path
+        self.chunk_size = chunk_size
+        self.stall_timeout = stall_timeout
+        self.streams = dict(
+            (name, FanoutStream(name, path, chunk_size, queue_chunks))
+            for name in destinations)
+        if ready is not None:
+            for (name, stream) in self.streams.items():
+                stream.ready = name in ready
+        self.bytes_read = 0
+        self._thread = None
+
+    def start(self):
+        """Open the file and start the reader thread.
+
+        An IOError is raised if the file cannot be opened."""
+        file_obj = open(self.path, 'rb')
+        self._thread = threading.Thread(target=self._read, args=(file_obj,))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def join(self):
+        """wait until the reader thread finishes"""
+        if self._thread:
+            self._thread.join()
+
+    def _read(self, file_obj):
+        """Body of the reader thread"""
+        try:
+            while True:
+                active = list(stream for stream in self.streams.values()
+                              if stream.attached)
+                if not active:
+                    break
+                chunk = file_obj.read(self.chunk_size)
+                if not chunk:
+                    for stream in active:
+                        self._put(stream, _eof)
+                    break
+                self.bytes_read += len(chunk)
+                for stream in active:
+                    self._put(stream, chunk)
+        except Exception, e:
+            msg = 'Error reading {0}: {1}. Pending destinations will read ' \
+                'the file by themselves.'
+            self.log.warning(msg.format(self.path, str(e)))
+            for stream in self.streams.values():
+                stream.detach()
+        finally:
+            file_obj.close()
+
+    def _put(self, stream, chunk):
+        """Put the chunk in the queue of the stream, detaching the stream if
+        it is stalled."""
+        deadline = time.time() + self.stall_timeout
+        while stream.attached:
+            try:
+                if stream.ready:
+                    stream.queue.put(chunk, timeout=min(1, self.stall_timeout))
+                else:
+                    stream.queue.put_nowait(chunk)
+                if chunk is not _eof:
+                    stream.enqueued += len(chunk)
+                return
+            except Queue.Full:
+                if not stream.ready:
+                    msg = '{0}: not ready to upload {1}; it will read the '\
+                        'file by itself.'
+                    self.log.info(msg.format(stream.name, self.path))
+                    stream.detach()
+                elif time.time() >= deadline:
+                    msg = '{0}: upload of {1} is too slow; it will read the '\
+                        'file by itself.'
+                    self.log.warning(msg.format(stream.name, self.path))
+                    stream.detach()
+
+
+class FanoutStream(object):
+    """File-like object with the content of the file, as received from the
+    FanoutReader. If the stream is detached, the rest of the file is read
+    directly."""
+
+    def __init__(self, name, path, chunk_size, queue_chunks):
+        self.name = name
+        self.path = path
+        self.chunk_size = chunk_size
+        self.queue = Queue.Queue(queue_chunks)
+        self.attached = True
+        self.closed = False
+        # False while the destination cannot start reading
+        self.ready = True
+        # bytes put in the queue by the reader
+        self.enqueued = 0
+        self._buffer = ''
+        self._pos = 0
+        self._eof = False
+        self._file = None
+
+    def detach(self):
+        """Do not receive more chunks from the reader"""
+        self.attached = False
+
+    def close(self):
+        """Close the stream. The reader does not send it more chunks."""
+        self.detach()
+        self.closed = True
+        if self._file:
+            self._file.close()
+            self._file = None
+
+    def _next_chunk(self):
+        """Return the next chunk or an empty string at the end of the file"""
+        if self._eof:
+            return ''
+        while not self._file:
+            try:
+                chunk = self.queue.get(timeout=1)
+            except Queue.Empty:
+                if self.attached:
+                    continue
+                # The reader does not put more chunks once detached
+                try:
+                    chunk = self.queue.get_nowait()
+                except Queue.Empty:
+                    # Read the rest directly from the file
+                    self._file = open(self.path, 'rb')
+                    self._file.seek(self.enqueued)
+                    break
+            if chunk is _eof:
+                self._eof = True
+                return ''
+            return chunk
+        chunk = self._file.read(self.chunk_size)
+        if not chunk:
+            self._eof = True
+        return chunk
+
+    def read(self, size=-1):
+        """Read up to size bytes (all the pending content if size < 0)"""
+        if 0 <= size <= len(self._buffer) - self._pos:
+            data = self._buffer[self._pos:self._pos + size]
+            self._pos += size
+            return data
+        parts = [self._buffer[self._pos:]]
+        length = len(parts[0])
+        self._buffer = ''
+        self._pos = 0
+        while size < 0 or length < size:
+            chunk = self._next_chunk()
+            if not chunk:
+                break
+            parts.append(chunk)
+            length += len(chunk)
+        data = ''.join(parts)
+        if 0 <= size < length:
+            self._buffer = data
+            self._pos = size
+            data = data[:size]
+        return data
+
+    def __iter__(self):
+        while True:
+            chunk = self.read(self.chunk_size)
+            if not chunk:
+                break
+            yield chunk
@@ -23,20 +23,52 @@
 # contact with opensource@tid.es
 #
 
-import copy
 import json
 
+# The fields of the glance image (see GlanceSyncImage.raw) that are kept: the
+# ones the facades need to update or to create an image, and updated_at, used
+# by the fingerprint of the master region.
+raw_fields = ('disk_format', 'container_format', 'protected', 'min_ram',
+              'min_disk', 'updated_at')
+
+# Strings up to this length are interned (see _intern)
+_max_interned_length = 64
+_interned = dict()
+
+
+def _intern(value):
+    """Return a shared object equal to value, if it is a short string.
+
+    The same property names and values (and region names, owners, formats,
+    etc.) are repeated in the images of every region; sharing them saves
+    memory with big catalogues. Unlike the builtin intern, unicode strings are
+    supported."""
+    if isinstance(value, basestring) and len(value) <= _max_interned_length:
+        return _interned.setdefault(value, value)
+    return value
+
 
 class GlanceSyncImage(object):
     """This class represent an image within a regional image server.
 
     Its representation is independent of the obtained from the glance server
 
-    The raw field is an opaque object for internal use only. It is the original
-    object obtained from the server and may vary depending of version or the
-    method used to get the object.
+    The raw field is an opaque object for internal use only. It is built from
+    the original object obtained from the server, but only the fields in
+    raw_fields are kept.
+
+    The objects are compact (they have __slots__ and the strings are
+    interned), because there is one for each image of each region. A clone
+    (see clone) shares the user_properties dictionary until it (or the
+    original one) is modified; therefore the properties of an image that may
+    be cloned must be modified only through modifiable_properties (or
+    replaced assigning a new dictionary). copy.deepcopy copies the dictionary
+    at once.
     """
 
+    __slots__ = ('name', 'id', 'region', 'owner', 'is_public', 'checksum',
+                 'size', 'status', 'raw', '_user_properties', '_shared')
+
     def __init__(self, name, id, region, owner=None, is_public=True,
                  checksum=None, size=0, status=None, user_properties=None,
                  raw=None):
@@ -46,17 +78,121 @@ class GlanceSyncImage(object):
         user_properties dictionary is cloned."""
         self.name = name
         self.id = id
-        self.region = region
+        self.region = _intern(region)
         self.is_public = is_public
         self.checksum = checksum
+        if raw is not None:
+            raw = dict((_intern(key), _intern(raw[key]))
+                       for key in raw_fields if key in raw)
         self.raw = raw
-        self.size = int(size)
-        self.status = status
-        self.owner = owner
+        self.size = int(size or 0)
+        self.status = _intern(status)
+        self.owner = _intern(owner)
         if user_properties is not None:
-            self.user_properties = copy.copy(user_properties)
+            self._user_properties = dict(
+                (_intern(key), _intern(value))
+                for (key, value) in user_properties.items())
         else:
-            self.user_properties = dict()
+            self._user_properties = dict()
+        self._shared = False
+
+    @property
+    def user_properties(self):
+        """the dictionary with the metadata of the image. It may be shared
+        with a clone: do not modify it, use modifiable_properties instead"""
+        return self._user_properties
+
+    @user_properties.setter
+    def user_properties(self, value):
+        self._user_properties = value
+        self._shared = False
+
+    def modifiable_properties(self):
+        """Return the user_properties dictionary to modify it. If it is
+        shared with a clone, it is copied first.
+
+        :return: the user_properties dictionary, owned only by this image
+        """
+        if self._shared:
+            self._user_properties = dict(self._user_properties)
+            self._shared = False
+        return self._user_properties
+
+    def clone(self):
+        """Return a copy of the image. The user_properties dictionary is not
+        copied until any of the two images modifies it (copy on write, see
+        modifiable_properties); raw is shared, it is not modified.
+
+        :return: a new GlanceSyncImage object, equal to this one
+        """
+        new = self._copy_fields()
+        new._user_properties = self._user_properties
+        new._shared = self._shared = True
+        return new
+
+    def _copy_fields(self):
+        """Return a new image with the fields of this one, but without
+        user_properties"""
+        new = GlanceSyncImage.__new__(GlanceSyncImage)
+        for slot in GlanceSyncImage.__slots__[:-2]:
+            setattr(new, slot, getattr(self, slot))
+        return new
+
+    def upload_descriptor(self, projection=None):
+        """Return the image to upload to a region: a copy that has only the
+        user properties in projection. Only the new user_properties dictionary
+        is built; raw is shared.
+
+        :param projection: the properties to keep, as returned by
+          GlanceSyncRegion.metadata_projection; if None, all the properties
+          are kept.
+        :return: a new GlanceSyncImage object, with its own user_properties
+        """
+        new = self._copy_fields()
+        if projection is None:
+            new.user_properties = dict(self._user_properties)
+        else:
+            new.user_properties = dict(
+                (key, value) for (key, value) in self._user_properties.items()
+                if key in projection)
+        return new
+
+    def metadata_changes(self, previous):
+        """Compare the metadata of the image with the metadata it had
+        before being modified.
+
+        :param previous: the image before the changes (e.g. a clone made
+          before modifying it)
+        :return: a tuple with three values: a dictionary with the changed
+          fields (name and is_public), a dictionary with the changed or new
+          user properties and a set with the removed user properties.
+        """
+        fields = dict()
+        if self.name != previous.name:
+            fields['name'] = self.name
+        if self.is_public != previous.is_public:
+            fields['is_public'] = self.is_public
+        old = previous._user_properties
+        changed = dict((key, value)
+                       for (key, value) in self._user_properties.items()
+                       if key not in old or old[key] != value)
+        removed = set(old).difference(self._user_properties)
+        return (fields, changed, removed)
+
+    def __copy__(self):
+        return self.clone()
+
+    def __deepcopy__(self, memo):
+        return self.upload_descriptor()
+
+    def __getstate__(self):
+        """state used by pickle (e.g. the persistence of the mock)"""
+        return dict((slot, getattr(self, slot))
+                    for slot in GlanceSyncImage.__slots__)
+
+    def __setstate__(self, state):
+        for (slot, value) in state.items():
+            setattr(self, slot, value)
 
     @staticmethod
     def from_field_list(fieldlist):
@@ -90,7 +226,7 @@ class GlanceSyncImage(object):
         return s.format(
             self.region, self.name, self.id, self.status, self.size,
             self.checksum, self.owner, self.is_public,
-            str(self.user_properties))
+            str(self._user_properties))
 
     def __eq__(self, other):
         """ The images are equals if all the attributes are equals,
@@ -109,7 +245,7 @@ class GlanceSyncImage(object):
             result = False
         elif int(self.size) != int(other.size) or self.raw != other.raw:
             result = False
-        elif self.user_properties != other.user_properties:
+        elif self._user_properties != other._user_properties:
             result = False
         elif self.checksum != other.checksum:
             result = False
@@ -135,12 +271,12 @@ class GlanceSyncImage(object):
                   self.checksum, self.owner, self.is_public]
         if user_properties_list:
             for field in user_properties_list:
-                if field in self.user_properties:
-                    output.append(self.user_properties[field])
+                if field in self._user_properties:
+                    output.append(self._user_properties[field])
                 else:
                     output.append('')
         else:
-            output.append(str(self.user_properties))
+            output.append(str(self._user_properties))
         return output
 
     def csv_userproperties(self, fields):
@@ -152,8 +288,8 @@ class GlanceSyncImage(object):
         sub = list()
         sub.append(self.name)
         for field in fields:
-            if field in self.user_properties:
-                sub.append(str(self.user_properties[field]))
+            if field in self._user_properties:
+                sub.append(str(self._user_properties[field]))
             else:
                 sub.append('')
         return ','.join(sub)
@@ -211,29 +347,30 @@ class GlanceSyncImage(object):
                 # This is a special case: values usually are different
                 if prop == 'kernel_id' or prop == 'ramdisk_id':
                     continue
-                val_m = image_master.user_properties.get(prop, None)
-                val_l = self.user_properties.get(prop, None)
+                val_m = image_master._user_properties.get(prop, None)
+                val_l = self._user_properties.get(prop, None)
 
                 if val_m != val_l:
                     return '#'
             # always check ramdisk_id and kernel id is present/omitted in both
             # images.
-            kernelid_in_region = 'kernel_id' in self.user_properties
-            kernelid_in_master = 'kernel_id' in image_master.user_properties
-            ramdiskid_in_region = 'ramdisk_id' in self.user_properties
-            ramdiskid_in_master = 'ramdisk_id' in image_master.user_properties
+            kernelid_in_region = 'kernel_id' in self._user_properties
+            kernelid_in_master = 'kernel_id' in image_master._user_properties
+            ramdiskid_in_region = 'ramdisk_id' in self._user_properties
+            ramdiskid_in_master = 'ramdisk_id' in image_master._user_properties
             if kernelid_in_region != kernelid_in_master or \
                     ramdiskid_in_region != ramdiskid_in_master:
                 return '#'
         else:
-            if len(self.user_properties) != len(image_master.user_properties):
+            if len(self._user_properties) != \
+                    len(image_master._user_properties):
                 return '#'
-            for prop in self.user_properties:
+            for prop in self._user_properties:
                 # This is a special case: values usually are different
                 if prop == 'kernel_id' or prop == 'ramdisk_id':
                     continue
-                val_m = image_master.user_properties.get(prop, None)
-                val_l = self.user_properties.get(prop, None)
+                val_m = image_master._user_properties.get(prop, None)
+                val_l = self._user_properties.get(prop, None)
 
                 if val_m != val_l:
                     return '#'
@@ -253,6 +390,7 @@ class GlanceSyncImage(object):
         :param metadata_set: list of user properties to consider
         :param forcesync: a list with UUID of images that are always sync.
         :param metadata_condition: expression to evaluate if the image is sync.
+          It may be a compiled MetadataCondition or a code object.
         :return:
         """
         synchronisable = False
@@ -261,6 +399,9 @@ class GlanceSyncImage(object):
             synchronisable = False
         elif self.id in forcesync:
             synchronisable = True
+        elif callable(metadata_condition):
+            # a compiled condition (see glancesync_condition)
+            synchronisable = metadata_condition(self, metadata_set)
         elif metadata_condition:
             image = self
             globals_dict = dict()
@@ -274,7 +415,7 @@ class GlanceSyncImage(object):
         else:
             some_property_in = False
             for prop in metadata_set:
-                if prop in self.user_properties:
+                if prop in self._user_properties:
                     some_property_in = True
                     break
             synchronisable = some_property_in
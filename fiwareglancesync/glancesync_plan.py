@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+# -- encoding: utf-8 --
+#
+# Copyright 2015-2016 Telefónica Investigación y Desarrollo, S.A.U
+#
+# This file is part of FI-WARE project.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+#
+# You may obtain a copy of the License at:
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# For those usages not covered by the Apache version 2.0 License please
+# contact with opensource@tid.es
+#
+
+import json
+import time
+
+from glancesync_image import GlanceSyncImage
+
+"""This internal module contains the plan of the synchronisation of a region:
+the operations needed to synchronise it, calculated without modifying
+anything.
+
+A plan can be saved as JSON, reviewed and executed later (see
+GlanceSync.plan_region and GlanceSync.execute_plan). The plan includes the
+region images involved, so the region is not listed again to execute it.
+"""
+
+# statuses of image_list_to_sync that require uploading the image
+upload_statuses = ('pending_upload', 'pending_replace', 'pending_rename')
+
+
+class SyncPlan(object):
+    """The operations needed to synchronise a region.
+
+    * obsolete: the region images to mark as obsolete (with the metadata
+      already updated).
+    * tuples: the status of each master image to synchronise, as returned by
+      GlanceSyncRegion.image_list_to_sync: pending_metadata images need a
+      metadata update; pending_upload, pending_replace and pending_rename
+      images an upload; pending_reuse images the renaming of a region image
+      with the same checksum; pending_ami images an update of kernel_id and
+      ramdisk_id after the uploads.
+    * region_images: the region images with the name of a master image to
+      synchronise, indexed by name. The region images to reuse are indexed by
+      the name of the master image.
+    """
+
+    def __init__(self, region, master_fingerprint=None, created=None):
+        """Create an empty plan.
+
+        :param region: the region, specified as 'target:region'.
+        :param master_fingerprint: fingerprint of the master images used to
+          calculate the plan.
+        :param created: timestamp of the plan (now by default).
+        """
+        self.region = region
+        self.master_fingerprint = master_fingerprint
+        self.created = created or time.time()
+        self.obsolete = list()
+        self.tuples = list()
+        self.region_images = dict()
+        # names of the master images considered, or None if all of them
+        # were considered (see GlanceSync._images_to_reconcile)
+        self.reconciled = None
+
+    def count(self, status):
+        """Return the number of master images with that status"""
+        return sum(1 for (s, image) in self.tuples if s == status)
+
+    def pending_bytes(self):
+        """Return the bytes to upload"""
+        return sum(int(image.size) for (status, image) in self.tuples
+                   if status in upload_statuses)
+
+    def is_synchronised(self):
+        """Return True if the plan has no operation to do"""
+        return not self.obsolete and all(
+            status.startswith('ok') for (status, image) in self.tuples)
+
+    def summary(self):
+        """Return a dictionary with the number of images of each status and
+        the bytes to upload"""
+        summary = dict()
+        for (status, image) in self.tuples:
+            summary[status] = summary.get(status, 0) + 1
+        summary['obsolete'] = len(self.obsolete)
+        summary['pending_bytes'] = self.pending_bytes()
+        return summary
+
+    def to_dict(self):
+        """Return a dictionary with the plan, serializable as JSON. Only the
+        name, id, checksum and size of the master images are included."""
+        return {
+            'region': self.region,
+            'master_fingerprint': self.master_fingerprint,
+            'created': self.created,
+            'reconciled': sorted(self.reconciled)
+            if self.reconciled is not None else None,
+            'obsolete': list(_image_to_dict(image)
+                             for image in self.obsolete),
+            'tuples': list(
+                {'status': status, 'name': image.name, 'id': image.id,
+                 'checksum': image.checksum, 'size': int(image.size)}
+                for (status, image) in self.tuples),
+            'region_images': dict(
+                (name, _image_to_dict(image))
+                for (name, image) in self.region_images.items()),
+            'summary': self.summary()
+        }
+
+    @staticmethod
+    def from_dict(values):
+        """Build a plan from the dictionary returned by to_dict. The master
+        images of tuples only have the name, id, checksum and size: they
+        must be replaced with the master images before executing the plan.
+
+        :param values: a dictionary returned by to_dict
+        :return: a new SyncPlan
+        """
+        values = _encode(values)
+        plan = SyncPlan(values['region'], values['master_fingerprint'],
+                        values['created'])
+        if values['reconciled'] is not None:
+            plan.reconciled = set(values['reconciled'])
+        plan.obsolete = list(_image_from_dict(image)
+                             for image in values['obsolete'])
+        plan.tuples = list(
+            (t['status'], GlanceSyncImage(t['name'], t['id'], None,
+                                          checksum=t['checksum'],
+                                          size=t['size']))
+            for t in values['tuples'])
+        plan.region_images = dict(
+            (name, _image_from_dict(image))
+            for (name, image) in values['region_images'].items())
+        return plan
+
+    def to_json(self):
+        """Return the plan as a JSON string"""
+        return json.dumps(self.to_dict(), indent=2, sort_keys=True)
+
+    @staticmethod
+    def from_json(data):
+        """Build a plan from a JSON string returned by to_json"""
+        return SyncPlan.from_dict(json.loads(data))
+
+
+def _encode(value):
+    """Convert the unicode strings loaded from JSON to UTF-8 strings, as
+    the rest of the images"""
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    elif isinstance(value, list):
+        return list(_encode(item) for item in value)
+    elif isinstance(value, dict):
+        return dict((_encode(key), _encode(item))
+                    for (key, item) in value.items())
+    return value
+
+
+def _image_to_dict(image):
+    """Return a dictionary with the fields of a region image"""
+    return {'name': image.name, 'id': image.id, 'region': image.region,
+            'owner': image.owner, 'is_public': image.is_public,
+            'checksum': image.checksum, 'size': int(image.size),
+            'status': image.status, 'user_properties': image.user_properties,
+            'raw': image.raw}
+
+
+def _image_from_dict(values):
+    """Build a region image from the dictionary returned by _image_to_dict"""
+    return GlanceSyncImage(
+        values['name'], values['id'], values['region'], values['owner'],
+        values['is_public'], values['checksum'], values['size'],
+        values['status'], values['user_properties'], values['raw'])
@@ -70,16 +70,51 @@ class GlanceSyncRegion(object):
         Returns a dictionary of images to be synchronised to this region,
         that is, take the master region dictionary and filter it according the
         target criteria.
+
+        The result only depends on the target, so the last one is kept in the
+        target and shared by all its regions while the same master dictionary
+        (and the same target options) are used. It must not be modified.
         :param images_master_region: a dict with the images on master region
         :return: a dictionary of images indexed by name
         """
         t = self.target
+        options = (frozenset(t['metadata_set']), frozenset(t['forcesyncs']),
+                   t.get('metadata_condition', None))
+        cache = t.get('synchronisable_cache', None)
+        if cache and cache[1] == options and (
+                cache[0] is images_master_region or
+                cache[2] is images_master_region):
+            # filtering the result again does not change it
+            return cache[2]
         filtered_master_dict = dict(
             (image.name, image) for image in images_master_region.values()
             if image.is_synchronisable(t['metadata_set'], t['forcesyncs'],
                                        t.get('metadata_condition', None)))
+        t['synchronisable_cache'] = (images_master_region, options,
+                                     filtered_master_dict)
         return filtered_master_dict
 
+    def metadata_projection(self):
+        """
+        Returns the user properties copied from a master image to a new image
+        of this region: the properties of metadata_set and also kernel_id and
+        ramdisk_id (they are always needed by the AMI images).
+
+        The result is kept in the target while metadata_set does not change.
+        :return: a frozenset, or None to copy all the properties
+        """
+        t = self.target
+        cache = t.get('metadata_projection', None)
+        if cache is None or cache[0] != t['metadata_set']:
+            if t['metadata_set']:
+                projection = frozenset(t['metadata_set']).union(
+                    ('kernel_id', 'ramdisk_id'))
+            else:
+                projection = None
+            cache = (frozenset(t['metadata_set']), projection)
+            t['metadata_projection'] = cache
+        return cache[1]
+
     def local_images_filtered(self, filtered_master_dict, images_region):
         """
         Returns a dictionary of images on the region, indexed by name, with
@@ -88,7 +123,7 @@ class GlanceSyncRegion(object):
          different metadata or checksum.
 
         :param filtered_master_dict: images to sync to this target
-        :param images_region: list of images on this region
+        :param images_region: list (or any iterable) of images on this region
         :return: a dictionary of images indexed by name
         """
         filtered_images_region = dict()
@@ -129,7 +164,52 @@ class GlanceSyncRegion(object):
             filtered_images_region[image.name] = image
         return filtered_images_region
 
-    def image_list_to_sync(self, images_master_region, images_region):
+    def images_to_reuse(self, filtered_master_dict, index, present,
+                        excluded=None):
+        """
+        Returns a dictionary with the region images that can be reused,
+        instead of uploading again a master image that is not in the region:
+        an active image owned by the tenant, with the same checksum that the
+        master image and whose name is not the name of an image to be
+        synchronised. The image is reused renaming it and copying the
+        metadata of the master image (see the pending_reuse status).
+
+        Each region image is reused only once. Nothing is reused if the
+        target option reuse_images is not True.
+
+        :param filtered_master_dict: images to sync to this target
+        :param index: a RegionImageIndex with the images of the region
+        :param present: the names of the master images that already have an
+         image with the same name in the region; they are not considered.
+        :param excluded: optional set with the UUIDs of the region images that
+         cannot be reused, because they are managed otherwise (e.g. the images
+         that are marked as obsolete).
+        :return: a dictionary of region images indexed by the name of the
+         master image they replace
+        """
+        reuse = dict()
+        if not self.target.get('reuse_images', False):
+            return reuse
+        tenant_id = self.target['tenant_id'].zfill(32)
+        used = set(excluded or ())
+        images_master = sorted(filtered_master_dict.values(),
+                               key=lambda image: int(image.size))
+        for image in images_master:
+            if image.name in present or not image.checksum:
+                continue
+            for candidate in index.by_checksum.get(image.checksum, ()):
+                if candidate.id in used or candidate.status != 'active' or \
+                        candidate.name in filtered_master_dict or \
+                        not candidate.owner or \
+                        candidate.owner.zfill(32) != tenant_id:
+                    continue
+                used.add(candidate.id)
+                reuse[image.name] = candidate
+                break
+        return reuse
+
+    def image_list_to_sync(self, images_master_region, images_region,
+                           reusable=None):
         """
         Returns a list of images to be synchronised to this region with its
         synchronisation status. The list is a tuple of two values:
@@ -140,6 +220,9 @@ class GlanceSyncRegion(object):
         'pending_metadata': there is an image with the right content, but
          metadata must be updated (this may include ramdisk_id and kernel_id)
         'pending_upload': the image is not synchronised; it must be upload
+        'pending_reuse': the image is not synchronised, but there is a region
+         image with the same checksum and other name (see images_to_reuse). It
+         will be renamed and its metadata updated, instead of uploading it.
         'pending_replace': there is an image, but with different checksum. The
          image will be replaced
         'pending_rename': there is an image, but with different checksum. The
@@ -152,7 +235,9 @@ class GlanceSyncRegion(object):
         list of images to sync.
 
         :param images_master_region: a dict with the images on master region
-        :param images_region: a list with the images on the region
+        :param images_region: a list (or any iterable) with the images on the
+         region; it is traversed only once.
+        :param reusable: the dictionary returned by images_to_reuse, if any.
         :return: a list of tuples (state, image).
         """
 
@@ -237,6 +322,10 @@ class GlanceSyncRegion(object):
                         images_list.append(('error_ami', image))
                     continue
 
+            elif reusable and image.name in reusable:
+                images_list.append(('pending_reuse', image))
+                # AMI images wait until the image is renamed
+                images_pending_upload.add(image.name)
             else:
                 images_list.append(('pending_upload', image))
                 images_pending_upload.add(image.name)
@@ -262,7 +351,7 @@ class GlanceSyncRegion(object):
                 value_m = image_master.user_properties[prop]
                 if prop not in image.user_properties or \
                         image.user_properties[prop] != value_m:
-                    image.user_properties[prop] = value_m
+                    image.modifiable_properties()[prop] = value_m
                     need_update = True
 
         if image_master.is_public != image.is_public:
@@ -303,13 +392,12 @@ class GlanceSyncRegion(object):
         # is removed if '<name>' image exists ant it is synchronisable.
 
         filtered = dict()
+        synchronisable = self.images_to_sync_dict(images_master_region)
         for image in images_master_region.values():
             if image.name.endswith('_obsolete') and image.name[0:-9] in \
                     images_master_region:
-                t = self.target
                 img = images_master_region[image.name[0:-9]]
-                if img.is_synchronisable(t['metadata_set'], t['forcesyncs'],
-                                         t.get('metadata_condition', None)):
+                if img.name in synchronisable:
                     m = 'Ignore obsolete master image {0} because {1} exists '\
                         'and it is synchronisable.'
                     self.log.warning(m.format(image.name, img.name))
@@ -344,3 +432,27 @@ class GlanceSyncRegion(object):
                     images_to_obsolete.append(image)
 
         return images_to_obsolete
+
+
+class RegionImageIndex(object):
+    """The images of a region indexed by name, by checksum and by id. The
+    index is built traversing the images only once.
+
+    The values of by_name and by_checksum are lists, because both the names
+    and the checksums may be duplicated in a region."""
+
+    def __init__(self, images_region):
+        """Create the index.
+
+        :param images_region: a list (or any iterable) with the images on the
+         region.
+        """
+        self.by_name = dict()
+        self.by_checksum = dict()
+        self.by_id = dict()
+        for image in images_region:
+            self.by_name.setdefault(image.name, list()).append(image)
+            if image.checksum:
+                self.by_checksum.setdefault(image.checksum, list()).append(
+                    image)
+            self.by_id[image.id] = image
@@ -33,6 +33,7 @@ import tempfile
 import sys
 
 from glancesync_image import GlanceSyncImage
+from glancesync_source import StreamReader
 
 """This module contains all the code that interacts directly with the glance
 implementation. It isolates the main code from the glance interaction.
@@ -49,6 +50,11 @@ import logging
 class ServersFacade(object):
     images_dir = '/var/lib/glance/images'
     images = dict()
+    # content of the images uploaded or added to the mock, by a tuple
+    # (region, id). It is not persisted.
+    contents = dict()
+    # function to download a master image (see GlanceSync._download_master)
+    master_source = None
     # Put this property to False to use this file as a mock in a unittest
     # when use_persistence is true, image information is preserved in disk.
     use_persistence = False
@@ -84,36 +90,85 @@ class ServersFacade(object):
         :param regionobj: The GlanceSyncRegion object of the region to list
         :return: a list of GlanceSyncImage objects
         """
-        # clone the object: otherwise modifying the returned object
-        # modify the object in the images.
-        return copy.deepcopy(ServersFacade.images[regionobj.fullname].values())
+        return list(self.iter_imagelist(regionobj))
 
-    def update_metadata(self, regionobj, image):
+    def iter_imagelist(self, regionobj, page_size=None, filters=None):
+        """iterate over the images of the glance of the specified region
+
+        :param regionobj: The GlanceSyncRegion object of the region to list
+        :param page_size: ignored in the mock.
+        :param filters: optional dictionary to filter the images. Supported
+          keys: owner, status, is_public and name.
+        :return: a generator of GlanceSyncImage objects
+        """
+        filters = filters or dict()
+        for image in ServersFacade.images[regionobj.fullname].values():
+            if any(getattr(image, key) != value
+                   for (key, value) in filters.items()):
+                continue
+            # copy the object: otherwise modifying the returned object
+            # modify the object in the images.
+            yield copy.deepcopy(image)
+
+    def update_metadata(self, regionobj, image, previous=None):
         """ update the metadata of the image in the specified region
         See GlanceSync.update_metadata_image for more details.
 
         :param regionobj: region where it is the image to update
         :param image: the image with the metadata to update
+        :param previous: optional; the image as it is in the region. If
+          provided, only the changes are applied, as the real facade does.
         :return: this function doesn't return anything.
         """
         images = ServersFacade.images[regionobj.fullname]
         updatedimage = images[image.id]
-        updatedimage.is_public = image.is_public
-        updatedimage.name = image.name
-        # updatedimage.owner = image.owner
-        updatedimage.user_properties = dict(image.user_properties)
+        if previous is None:
+            updatedimage.is_public = image.is_public
+            updatedimage.name = image.name
+            # updatedimage.owner = image.owner
+            updatedimage.user_properties = dict(image.user_properties)
+        else:
+            (fields, changed, removed) = image.metadata_changes(previous)
+            if not (fields or changed or removed):
+                return
+            for (field, value) in fields.items():
+                setattr(updatedimage, field, value)
+            updatedimage.user_properties.update(changed)
+            for prop in removed:
+                updatedimage.user_properties.pop(prop, None)
         if ServersFacade.use_persistence:
             images[image.id] = updatedimage
             images.sync()
 
-    def upload_image(self, regionobj, image):
+    def upload_image(self, regionobj, image, data=None):
         """Upload the image to the glance server on the specified region.
 
         :param regionobj: GlanceSyncRegion object; the region where the image
           will be upload.
         :param image: GlanceSyncImage object; the image to be uploaded.
+        :param data: optional file-like object with the content of the image.
+          It is read until the end, and the content is kept (see
+          download_image). If it is not provided, the image_source of the
+          target is master and the file of the image is not in images_dir,
+          the content is downloaded from the master region, like the real
+          facade does.
         :return: The UUID of the new image.
         """
+        content = None
+        source = None
+        if data is None and self.master_source is not None and \
+                regionobj.target.get('image_source', 'local') == 'master' and \
+                not os.path.exists(os.path.join(self.images_dir, image.id)):
+            source = data = self.master_source(image)
+        if data is not None:
+            parts = list()
+            chunk = data.read(65536)
+            while chunk:
+                parts.append(chunk)
+                chunk = data.read(65536)
+            content = ''.join(parts)
+        if source is not None:
+            source.close()
         count = 1
         if regionobj.fullname not in ServersFacade.images:
             ServersFacade.images[regionobj.fullname] = dict()
@@ -130,9 +185,26 @@ class ServersFacade(object):
         ServersFacade.images[regionobj.fullname][imageid] = new_image
         if ServersFacade.use_persistence:
             ServersFacade.images[regionobj.fullname].sync()
+        if content is not None:
+            ServersFacade.contents[(regionobj.fullname, imageid)] = content
 
         return imageid
 
+    def download_image(self, regionobj, id, size=None):
+        """Return the content of an image of the region: the content sent to
+        upload_image or passed to add_image_to_mock (empty if unknown).
+
+        :param regionobj: the GlanceSyncRegion object
+        :param id: the UUID of the image
+        :param size: the size of the image, if it is known
+        :return: a glancesync_source.StreamReader
+        """
+        if id not in ServersFacade.images.get(regionobj.fullname, {}):
+            raise Exception(regionobj.fullname + ': Download of image ' + id +
+                            ' Failed. Cause: it does not exist')
+        content = ServersFacade.contents.get((regionobj.fullname, id), '')
+        return StreamReader([content], size)
+
     def delete_image(self, regionobj, id, confirm=True):
         """delete a image on the specified region.
 
@@ -191,9 +263,10 @@ class ServersFacade(object):
             os.mkdir(ServersFacade.dir_persist)
 
     @staticmethod
-    def add_image_to_mock(image):
+    def add_image_to_mock(image, content=None):
         """Add the image to the mock
         :param image: The image to add. If can be a GlanceSyncImage or a list
+        :param content: optional content of the image (see download_image)
         :return: This method does not return nothing.
         """
         if type(image) == list:
@@ -211,6 +284,8 @@ class ServersFacade(object):
         ServersFacade.images[image.region][image.id] = image
         if ServersFacade.use_persistence:
             ServersFacade.images[image.region].sync()
+        if content is not None:
+            ServersFacade.contents[(image.region, image.id)] = content
 
     @staticmethod
     def add_emptyregion_to_mock(region):
@@ -228,6 +303,7 @@ class ServersFacade(object):
     def clear_mock():
         """clear all the non-persistent content of the mock"""
         ServersFacade.images = dict()
+        ServersFacade.contents = dict()
         # if using persintence, deleting _persist_ file is responsability of
         # the caller.
 
@@ -23,11 +23,19 @@
 # contact with opensource@tid.es
 #
 
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+
 from app.settings.settings import logger_cli
 from utils.osclients import OpenStackClients
-from multiprocessing import Pool, TimeoutError
 
 from glancesync_image import GlanceSyncImage
+from glancesync_source import ImageFile, StreamReader
+from glancesync_cache import CacheFill
 
 """This module contains all the code that interacts directly with the glance
 implementation. It isolates the main code from the glance interaction.
@@ -41,9 +49,21 @@ Formerly, it used to interact using a CLI wrapper.
 
 # Default timeout to get image list (seconds)
 _default_timeout = 30
+# Default number of images requested in each page of the image list
+_default_page_size = 100
+# Default number of times a failed upload is retried
+_default_upload_retries = 2
+# Default delay before the first retry of an upload (seconds); it is doubled
+# in each retry
+_default_upload_retry_delay = 5
 
 
 class ServersFacade(object):
+    """Facade using the version 1 of the glance API (see ServersFacadeV2)"""
+
+    # version of the glance API used by the facade
+    glance_api_version = '1'
+
     def __init__(self, target):
         """Create a new Facade for the specified target (a target is shared
         between regions using the same credential)"""
@@ -58,14 +78,52 @@ class ServersFacade(object):
         self.session = self.osclients.get_session()
 
         self.target = target
-        # This is a default value
+        # These are default values
         self.images_dir = '/var/lib/glance/images'
+        self.drop_images_cache = True
+        # function to download a master image (see _open_source)
+        self.master_source = None
+        # glancesync_cache.BlobCache with the downloaded master images
+        self.image_cache = None
         self.logger = logger_cli
-
-    def _get_glanceclient(self, region):
-        """helper method, to get a glanceclient for the region"""
-        self.osclients.set_region(region)
-        return self.osclients.get_glanceclient()
+        # glance clients by (region, timeout): a tuple (token, client)
+        self._glanceclients = dict()
+        self._glanceclients_pid = os.getpid()
+        self._glanceclients_lock = threading.Lock()
+
+    def _get_glanceclient(self, region, timeout=None):
+        """helper method, to get a glanceclient for the region.
+
+        The clients are cached by region, so the endpoint is only searched in
+        the catalog once and the HTTP connections of the client are reused
+        (keep-alive) between calls. A client is created again when the token
+        of the session changes (e.g. it was renewed because it expired) and
+        after a fork, because the connections cannot be shared with the
+        child.
+
+        If timeout is provided, the client uses it for the socket
+        operations; it is a different client than the default one, because
+        the uploads must not use a short timeout."""
+        token = self.osclients.get_session().get_token()
+        key = (region, timeout)
+        with self._glanceclients_lock:
+            if self._glanceclients_pid != os.getpid():
+                self._glanceclients = dict()
+                self._glanceclients_pid = os.getpid()
+            cached = self._glanceclients.get(key)
+            if cached and cached[0] == token:
+                return cached[1]
+            # set_region and get_glanceclient must be invoked together,
+            # other thread may be using osclients
+            self.osclients.set_region(region)
+            kwargs = dict()
+            if timeout is not None:
+                kwargs['timeout'] = timeout
+            if self.glance_api_version != '1':
+                kwargs['version'] = self.glance_api_version
+            client = self.osclients.get_glanceclient(**kwargs)
+            self._glanceclients[key] = (token, client)
+            return client
 
     def get_regions(self):
         """It returns the list of regions on the specified target.
@@ -79,28 +137,48 @@ class ServersFacade(object):
         :param regionobj: The GlanceSyncRegion object of the region to list
         :return: a list of GlanceSyncImage objects
         """
-        client = self._get_glanceclient(regionobj.region)
+        return list(self.iter_imagelist(regionobj))
+
+    def iter_imagelist(self, regionobj, page_size=None, filters=None):
+        """iterate over the images of the glance of the specified region.
+
+        The images are requested page by page, when they are consumed.
+        list_images_timeout is used both as the timeout of each socket
+        operation and as the deadline of the whole listing (only the time
+        waiting for the server is counted, not the time of the consumer).
+
+        :param regionobj: The GlanceSyncRegion object of the region to list
+        :param page_size: number of images of each request. By default,
+          list_images_page_size of the target.
+        :param filters: optional dictionary to filter the images in the
+          server. Supported keys: owner, status, is_public and name.
+        :return: a generator of GlanceSyncImage objects
+        """
+        target = regionobj.target
+        if 'list_images_timeout' in target:
+            timeout = target['list_images_timeout']
+        else:
+            timeout = _default_timeout
+        if page_size is None:
+            page_size = target.get('list_images_page_size',
+                                   _default_page_size)
+        kwargs = self._list_kwargs(page_size, filters)
+        elapsed = 0
         try:
-            target = regionobj.target
-            # We need a Pool to implement a timeout. Unfortunately
-            # setting client.images.client.timeout does nothing.
-            if 'list_images_timeout' in target:
-                timeout = target['list_images_timeout']
-            else:
-                timeout = _default_timeout
-            pool = Pool(1)
-            result = pool.apply_async(_getrawimagelist, (client,))
-            images = result.get(timeout=timeout)
-            image_list = list()
-            for image in images:
-                i = GlanceSyncImage(
-                    image['name'], image['id'], regionobj.fullname,
-                    image['owner'], image['is_public'], image['checksum'],
-                    image['size'], image['status'], image['properties'], image)
-
-                image_list.append(i)
-
-        except TimeoutError:
+            client = self._get_glanceclient(regionobj.region, timeout)
+            images = iter(client.images.list(**kwargs))
+            while True:
+                start = time.time()
+                try:
+                    image = next(images)
+                except StopIteration:
+                    break
+                elapsed += time.time() - start
+                if elapsed > timeout:
+                    raise _ListTimeoutException()
+                yield self._to_image(image, regionobj)
+
+        except _ListTimeoutException:
             msg = regionobj.fullname + \
                 ': Timeout while retrieving image list.'
             self.logger.error(msg)
@@ -114,65 +192,243 @@ class ServersFacade(object):
             self.logger.error(msg)
             raise GlanceFacadeException(msg)
 
-        return image_list
-
-    def update_metadata(self, regionobj, image):
+    def _list_kwargs(self, page_size, filters):
+        """helper method, to build the parameters of images.list"""
+        kwargs = {'page_size': page_size}
+        if filters:
+            filters = dict(filters)
+            if 'owner' in filters:
+                kwargs['owner'] = filters.pop('owner')
+            if filters:
+                kwargs['filters'] = filters
+        return kwargs
+
+    def _to_image(self, image, regionobj):
+        """helper method, to build a GlanceSyncImage from an image returned
+        by glanceclient"""
+        image = image.to_dict()
+        return GlanceSyncImage(
+            image['name'], image['id'], regionobj.fullname,
+            image['owner'], image['is_public'], image['checksum'],
+            image['size'], image['status'], image['properties'], image)
+
+    def update_metadata(self, regionobj, image, previous=None):
         """ update the metadata of the image in the specified region
         See GlanceSync.update_metadata_image for more details.
 
+        The image is updated with only one request (it is not requested
+        first). If previous is provided, only the changes are sent, and
+        nothing at all if there are no changes; however, when a property has
+        been removed all the properties must be sent, because the glance API
+        only removes properties replacing the whole set.
+
         :param regionobj: region where it is the image to update
         :param image: the image with the metadata to update
+        :param previous: optional; the image as it is in the region (e.g. a
+          clone of the listed image done before modifying it).
         :return: this function doesn't return anything.
         """
+        if previous is None:
+            changes = dict(
+                is_public=image.is_public, name=image.name,
+                disk_format=image.raw['disk_format'],
+                protected=image.raw['protected'],
+                container_format=image.raw['container_format'],
+                purge_props=True, properties=image.user_properties)
+        else:
+            (changes, changed, removed) = image.metadata_changes(previous)
+            if removed:
+                changes['purge_props'] = True
+                changes['properties'] = image.user_properties
+            elif changed:
+                changes['purge_props'] = False
+                changes['properties'] = changed
+            elif not changes:
+                return
         client = self._get_glanceclient(regionobj.region)
         try:
-            # get image
-            glance_obj = client.images.get(image.id)
-
-            # update image
-            glance_obj.update(is_public=image.is_public, name=image.name,
-                              disk_format=image.raw['disk_format'],
-                              protected=image.raw['protected'],
-                              container_format=image.raw['container_format'],
-                              purge_props=True,
-                              properties=image.user_properties)
+            client.images.update(image.id, **changes)
         except Exception, e:
             msg = regionobj.fullname + ': Update of ' + image.name +\
                 ' failed. Cause: ' + str(e)
             self.logger.error(msg)
             raise GlanceFacadeException(msg)
 
-    def upload_image(self, regionobj, image):
+    def upload_image(self, regionobj, image, data=None):
         """Upload the image to the glance server on the specified region.
 
+        If the upload fails, the image created by the attempt (in status
+        queued or saving) is deleted and the upload is tried again up to
+        upload_retries times (an option of the target), after an exponential
+        delay with jitter. If the token has expired, it is renewed before retrying.
+        Glance cannot resume an upload, so the content is sent again from the
+        beginning: data is rewound if it is seekable, otherwise it is closed
+        and the content is opened again as if data were not provided.
+
+        The MD5 of the content is computed while it is sent and, if the
+        checksum of the image is known, they are compared.
+
         :param regionobj: GlanceSyncRegion object; the region where the image
           will be upload.
         :param image: GlanceSyncImage object; the image to be uploaded.
+        :param data: optional file-like object with the content of the image.
+          By default, the file with the image UUID in images_dir is read (see
+          glancesync_source.ImageFile) or, if it does not exist and the
+          image_source of the target is master, it is downloaded from the
+          master region.
         :return: The UUID of the new image.
         """
-        client = self._get_glanceclient(regionobj.region)
+        target = regionobj.target
+        retries = target.get('upload_retries', _default_upload_retries)
+        delay = target.get('upload_retry_delay', _default_upload_retry_delay)
+        attempt = 0
+        while True:
+            try:
+                return self._upload(regionobj, image, data)
+            except _UploadException, e:
+                if not e.retry or attempt >= retries:
+                    self.logger.error(str(e))
+                    raise GlanceFacadeException(str(e))
+                attempt += 1
+                wait = delay * 2 ** (attempt - 1) * random.uniform(0.5, 1.5)
+                msg = '{0}. Retrying ({1}/{2}) in {3:.1f} seconds.'
+                self.logger.warning(msg.format(str(e), attempt, retries,
+                                               wait))
+                if data is not None and not _rewind(data):
+                    # Close it before waiting: a stream of a FanoutReader is
+                    # detached, so the reader does not wait for it.
+                    if hasattr(data, 'close'):
+                        data.close()
+                    data = None
+                time.sleep(wait)
+
+    def _upload(self, regionobj, image, data):
+        """helper method, to do an attempt of upload_image. It raises
+        _UploadException after deleting the image left by the attempt"""
+        if data is None:
+            source = self._open_source(regionobj, image)
+            with source:
+                uuid = self._upload(regionobj, image, source)
+            if isinstance(source, ImageFile):
+                msg = '{0}: {1} sent ({2:.1f} MB at {3:.1f} MB/s)'
+                self.logger.info(msg.format(
+                    regionobj.fullname, image.name,
+                    source.bytes_read / 1048576.0, source.rate / 1048576.0))
+            return uuid
+
+        # ImageFile and CacheFill compute the MD5 by themselves
+        if isinstance(data, (ImageFile, CacheFill)):
+            reader = data
+        else:
+            reader = _ChecksumReader(data)
+        throttle = regionobj.target.get('throttle')
+        if throttle is not None:
+            data = throttle.reader(reader, regionobj.fullname,
+                                   regionobj.target['target_name'])
+        else:
+            data = reader
+        created = list()
         try:
-            with open(self.images_dir + '/' + image.id, 'r') as file_obj:
-                try:
-                    new_image = client.images.create(
-                        container_format=image.raw['container_format'],
-                        disk_format=image.raw['disk_format'],
-                        name=image.name, is_public=image.is_public,
-                        protected=image.raw['protected'],
-                        min_ram=image.raw['min_ram'],
-                        min_disk=image.raw['min_disk'],
-                        properties=image.user_properties, data=file_obj)
-                    return new_image.id
-                except Exception, e:
-                    msg = regionobj.fullname + ': Upload of ' + image.name +\
-                        ' Failed. Cause: ' + str(e)
-                    self.logger.error(msg)
-                    raise GlanceFacadeException(msg)
-        except IOError, e:
+            client = self._get_glanceclient(regionobj.region)
+            uuid = self._create_image(client, image, data, created)
+        except Exception, e:
+            if _is_unauthorized(e):
+                # the next client is created with a new token
+                self.osclients.get_session().invalidate()
+            self._cleanup(regionobj, created)
+            msg = regionobj.fullname + ': Upload of ' + image.name +\
+                ' Failed. Cause: ' + str(e)
+            raise _UploadException(msg)
+
+        md5 = reader.md5.hexdigest()
+        if image.checksum and md5 != image.checksum:
+            self._cleanup(regionobj, [uuid])
+            msg = regionobj.fullname + ': Upload of ' + image.name +\
+                ' Failed. Cause: the MD5 of the content sent (' + md5 +\
+                ') is not the checksum of the image (' + image.checksum + ')'
+            raise _UploadException(msg, retry=False)
+        return uuid
+
+    def _open_source(self, regionobj, image):
+        """helper method, to open the content of the image to upload: the
+        file in images_dir or, when it does not exist and the image_source
+        of the target is master, a download from the master region (see
+        master_source). The downloads are read from image_cache, or saved
+        in it, if it is set. It raises _UploadException on error."""
+        path = self.images_dir + '/' + image.id
+        if regionobj.target.get('image_source', 'local') == 'master' and \
+                self.master_source is not None and not os.path.exists(path):
+            cache = self.image_cache
+            if cache is not None and image.checksum:
+                source = cache.open(image.checksum, self.drop_images_cache)
+                if source is not None:
+                    return source
+            try:
+                source = self.master_source(image)
+            except Exception, e:
+                msg = regionobj.fullname + ': Cannot download the image ' +\
+                    image.name + ' from the master region. Cause: ' + str(e)
+                raise _UploadException(msg)
+            if cache is not None and image.checksum:
+                source = cache.fill(image.checksum, source, image.size)
+            return source
+        try:
+            return ImageFile(path, drop_cache=self.drop_images_cache)
+        except EnvironmentError, e:
             msg = regionobj.fullname + ': Cannot open the image ' +\
                 image.name + ' to upload. Cause: ' + str(e)
+            raise _UploadException(msg, retry=False)
+
+    def _create_image(self, client, image, data, created):
+        """helper method, to create the image and then upload its content
+        from data. The UUID of the image is appended to created before its
+        content is sent, so that a failed upload can be deleted."""
+        new_image = client.images.create(
+            container_format=image.raw['container_format'],
+            disk_format=image.raw['disk_format'],
+            name=image.name, is_public=image.is_public,
+            protected=image.raw['protected'],
+            min_ram=image.raw['min_ram'],
+            min_disk=image.raw['min_disk'],
+            properties=image.user_properties)
+        created.append(new_image.id)
+        client.images.update(new_image.id, data=data)
+        return new_image.id
+
+    def _cleanup(self, regionobj, created):
+        """helper method, to delete the images created by a failed upload
+        (only those: other images of the tenant with the same name may be
+        uploads in progress of other processes). The errors are only
+        logged."""
+        for id in created:
+            try:
+                self._delete(self._get_glanceclient(regionobj.region), id)
+            except Exception, e:
+                msg = regionobj.fullname + ': Cannot delete the image ' +\
+                    id + ' of a failed upload. Cause: ' + str(e)
+                self.logger.warning(msg)
+
+    def download_image(self, regionobj, id, size=None):
+        """Return the content of an image of the region. It is streamed from
+        the glance server while it is read, not saved.
+
+        :param regionobj: the GlanceSyncRegion object
+        :param id: the UUID of the image
+        :param size: the size of the image, if it is known
+        :return: a glancesync_source.StreamReader
+        """
+        try:
+            client = self._get_glanceclient(regionobj.region)
+            body = client.images.data(id, do_checksum=False)
+        except Exception, e:
+            msg = regionobj.fullname + ': Download of image ' + id +\
+                ' Failed. Cause: ' + str(e)
             self.logger.error(msg)
             raise GlanceFacadeException(msg)
+        if body is None:
+            # the version 2 of the API returns None when there is no content
+            body = ()
+        return StreamReader(body, size)
 
     def delete_image(self, regionobj, id, confirm=True):
         """delete a image on the specified region.
@@ -194,7 +450,7 @@ class ServersFacade(object):
                 return False
 
         try:
-            client.images.get(id).delete()
+            self._delete(client, id)
         except Exception, e:
             msg = regionobj.fullname + ': Deletion of image ' + id \
                 + ' Failed. Cause: ' + str(e)
@@ -203,6 +459,10 @@ class ServersFacade(object):
 
         return True
 
+    def _delete(self, client, id):
+        """helper method, to delete the image"""
+        client.images.get(id).delete()
+
     def get_tenant_id(self):
         """It returns the tenant id corresponding to the target. It is
         necessary to use the tenant_id instead of the tenant_name because the
@@ -213,16 +473,189 @@ class ServersFacade(object):
         return self.osclients.get_tenant_id()
 
 
-def _getrawimagelist(glance_client):
-    """Helper function that returns objects as dictionary.
-    We need this function because we use Pool to implement a timeout and
-    the original results is not pickable.
+class ServersFacadeV2(ServersFacade):
+    """Facade using the version 2 of the glance API.
+
+    The differences with the version 1 are:
 
-    :param glance_client: the glance client
-    :return: a list of images (every image is a dictionary)
+    * the user properties are attributes of the image, and is_public is the
+      visibility of the image ('public' or 'private').
+    * the images are listed page by page using a marker (the next link
+      returned by the server), with the filters applied by the server.
+    * an image is created first, and then its content is uploaded with a
+      chunked PUT.
+    * the metadata is updated with a JSON-patch with only the changes, sent
+      directly (without requesting the image before and after).
     """
-    images = glance_client.images.list()
-    return list(image.to_dict() for image in images)
+
+    glance_api_version = '2'
+
+    # attributes of the images that are not user properties
+    base_attributes = frozenset((
+        'id', 'name', 'status', 'visibility', 'owner', 'checksum', 'size',
+        'virtual_size', 'disk_format', 'container_format', 'protected',
+        'min_ram', 'min_disk', 'created_at', 'updated_at', 'tags', 'self',
+        'file', 'schema', 'locations', 'direct_url', 'os_hidden',
+        'os_hash_algo', 'os_hash_value'))
+
+    def _list_kwargs(self, page_size, filters):
+        """helper method, to build the parameters of images.list"""
+        kwargs = {'page_size': page_size}
+        if filters:
+            filters = dict(filters)
+            if 'is_public' in filters:
+                if filters.pop('is_public'):
+                    filters['visibility'] = 'public'
+                else:
+                    filters['visibility'] = 'private'
+            kwargs['filters'] = filters
+        return kwargs
+
+    def _to_image(self, image, regionobj):
+        """helper method, to build a GlanceSyncImage from an image returned
+        by glanceclient"""
+        image = dict(image)
+        properties = dict(
+            (key, value) for (key, value) in image.items()
+            if key not in self.base_attributes)
+        return GlanceSyncImage(
+            image['name'], image['id'], regionobj.fullname,
+            image.get('owner'), image.get('visibility') == 'public',
+            image.get('checksum'), image.get('size') or 0, image['status'],
+            properties, image)
+
+    def update_metadata(self, regionobj, image, previous=None):
+        """ update the metadata of the image in the specified region
+        See GlanceSync.update_metadata_image for more details.
+
+        The changes are sent as a JSON-patch. If previous is not provided,
+        the image is requested to calculate the changes.
+
+        :param regionobj: region where it is the image to update
+        :param image: the image with the metadata to update
+        :param previous: optional; the image as it is in the region.
+        :return: this function doesn't return anything.
+        """
+        client = self._get_glanceclient(regionobj.region)
+        try:
+            if previous is None:
+                previous = self._to_image(client.images.get(image.id),
+                                          regionobj)
+            (fields, changed, removed) = image.metadata_changes(previous)
+            patch = list()
+            if 'name' in fields:
+                patch.append({'op': 'replace', 'path': '/name',
+                              'value': image.name})
+            if 'is_public' in fields:
+                patch.append({'op': 'replace', 'path': '/visibility',
+                              'value': _visibility(image.is_public)})
+            for key in sorted(changed):
+                patch.append({'op': 'add', 'path': '/' + key,
+                              'value': _property_value(changed[key])})
+            for key in sorted(removed):
+                patch.append({'op': 'remove', 'path': '/' + key})
+            if not patch:
+                return
+            client.http_client.patch(
+                '/v2/images/' + image.id, data=json.dumps(patch),
+                headers={'Content-Type':
+                         'application/openstack-images-v2.1-json-patch'})
+        except Exception, e:
+            msg = regionobj.fullname + ': Update of ' + image.name +\
+                ' failed. Cause: ' + str(e)
+            self.logger.error(msg)
+            raise GlanceFacadeException(msg)
+
+    def _create_image(self, client, image, data, created):
+        """helper method, to create the image and then upload its content
+        from data"""
+        properties = dict((key, _property_value(value)) for (key, value)
+                          in image.user_properties.items()
+                          if key not in self.base_attributes)
+        new_image = client.images.create(
+            container_format=image.raw['container_format'],
+            disk_format=image.raw['disk_format'],
+            name=image.name, visibility=_visibility(image.is_public),
+            protected=image.raw['protected'],
+            min_ram=int(image.raw['min_ram']),
+            min_disk=int(image.raw['min_disk']), **properties)
+        created.append(new_image['id'])
+        client.images.upload(new_image['id'], data, image.size)
+        return new_image['id']
+
+    def _delete(self, client, id):
+        """helper method, to delete the image"""
+        client.images.delete(id)
+
+
+def _visibility(is_public):
+    """Return the visibility of the version 2 of the API"""
+    if is_public:
+        return 'public'
+    return 'private'
+
+
+def _property_value(value):
+    """The version 2 of the API only supports strings as values of the user
+    properties"""
+    if isinstance(value, basestring):
+        return value
+    return str(value)
+
+
+def _rewind(data):
+    """Seek data to the beginning, to read it again. Return False if it is
+    not possible."""
+    try:
+        data.seek(0)
+        return True
+    except Exception:
+        return False
+
+
+def _is_unauthorized(error):
+    """Check if the error is the HTTP error 401 (e.g. the token expired)"""
+    for attribute in ('code', 'http_status', 'status_code'):
+        if getattr(error, attribute, None) == 401:
+            return True
+    return False
+
+
+class _ChecksumReader(object):
+    """File-like object that computes the MD5 of the content read from other
+    file-like object. The rest of the attributes (e.g. seek and tell, used to
+    obtain the size) are the ones of the wrapped object."""
+
+    def __init__(self, data):
+        self._data = data
+        self.md5 = hashlib.md5()
+
+    def read(self, size=-1):
+        chunk = self._data.read(size)
+        self.md5.update(chunk)
+        return chunk
+
+    def __iter__(self):
+        while True:
+            chunk = self.read(65536)
+            if not chunk:
+                break
+            yield chunk
+
+    def __getattr__(self, name):
+        return getattr(self._data, name)
+
+
+class _UploadException(Exception):
+    """exception used when an attempt of upload fails"""
+    def __init__(self, message, retry=True):
+        Exception.__init__(self, message)
+        self.retry = retry
+
+
+class _ListTimeoutException(Exception):
+    """exception used when the deadline of the image list expires"""
+    pass
 
 
 class GlanceFacadeException(Exception):
@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+# -- encoding: utf-8 --
+#
+# Copyright 2015-2016 Telefónica Investigación y Desarrollo, S.A.U
+#
+# This file is part of FI-WARE project.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+#
+# You may obtain a copy of the License at:
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# For those usages not covered by the Apache version 2.0 License please
+# contact with opensource@tid.es
+#
+
+import cPickle as pickle
+import hashlib
+import os
+import tempfile
+import threading
+import time
+
+from app.settings.settings import logger_cli
+
+"""This internal module keeps a snapshot of the images of the master region,
+to be reused by the GlanceSync objects created later (e.g. in each request to
+the API server) instead of listing and processing the master region again.
+
+The snapshot is kept in memory (shared by the objects of the same process and
+inherited by the forked children) and optionally in a directory (shared by
+different processes). A snapshot is valid during ttl seconds. After that, the
+master region is listed again, but if the fingerprint of the list has not
+changed, the processed snapshot is reused.
+"""
+
+# snapshots in memory, indexed by key: a tuple (timestamp, fingerprint, dict)
+_memory = dict()
+_lock = threading.Lock()
+
+
+def fingerprint_images(images):
+    """Return a fingerprint of a list of images. It changes when an image is
+    added, deleted or updated.
+
+    The fingerprint uses the id, checksum and updated_at of each image.
+    When updated_at is not available (e.g. the mock), the rest of the
+    metadata is used instead.
+
+    :param images: a list of GlanceSyncImage
+    :return: a string
+    """
+    entries = list()
+    for image in images:
+        updated_at = (image.raw or dict()).get('updated_at')
+        if updated_at:
+            entries.append((image.id, image.checksum, updated_at))
+        else:
+            entries.append((image.id, image.checksum, image.name,
+                            image.status, image.is_public, image.owner,
+                            sorted(image.user_properties.items())))
+    entries.sort()
+    return hashlib.sha1(repr(entries)).hexdigest()
+
+
+class MasterSnapshot(object):
+    """The snapshot of the master region of a target"""
+
+    def __init__(self, region, target, ttl=0, directory=None):
+        """Create the object; it does not load anything.
+
+        :param region: the name of the master region.
+        :param target: the target of the master region (its keystone_url and
+          tenant are part of the key of the snapshot).
+        :param ttl: seconds during the snapshot is used without checking
+          the master region. 0 disables the snapshot: the master region is
+          always listed and processed.
+        :param directory: optional directory to save the snapshot.
+        """
+        self.log = logger_cli
+        self.ttl = ttl
+        self.directory = directory
+        key = '\n'.join((region, str(target.get('keystone_url')),
+                         str(target.get('tenant'))))
+        self.key = key
+        self.path = None
+        if directory:
+            self.path = os.path.join(
+                directory, 'master_' + hashlib.sha1(key).hexdigest()[:16] +
+                '.pickle')
+
+    def get(self):
+        """Return the snapshot if it is not expired.
+
+        :return: a tuple (fingerprint, images dictionary) or None
+        """
+        if self.ttl <= 0:
+            return None
+        entry = self._load()
+        if entry and time.time() - entry[0] < self.ttl:
+            return (entry[1], entry[2])
+        return None
+
+    def get_by_fingerprint(self, fingerprint):
+        """Return the images of the snapshot, even if it is expired, when it
+        has the same fingerprint. The snapshot is renewed.
+
+        :param fingerprint: the fingerprint of the current master images.
+        :return: the images dictionary or None
+        """
+        if self.ttl <= 0:
+            return None
+        entry = self._load()
+        if entry and entry[1] == fingerprint:
+            self.put(fingerprint, entry[2])
+            return entry[2]
+        return None
+
+    def put(self, fingerprint, images):
+        """Save a new snapshot.
+
+        :param fingerprint: the fingerprint of the master images.
+        :param images: the dictionary of master images, already processed.
+        :return: nothing
+        """
+        if self.ttl <= 0:
+            return
+        entry = (time.time(), fingerprint, images)
+        with _lock:
+            _memory[self.key] = entry
+        if self.path:
+            try:
+                self._save(entry)
+            except Exception, e:
+                msg = 'Cannot save the master snapshot {0}. Cause: {1}'
+                self.log.warning(msg.format(self.path, str(e)))
+
+    def invalidate(self):
+        """Discard the snapshot (in memory and in disk)"""
+        with _lock:
+            _memory.pop(self.key, None)
+        if self.path and os.path.exists(self.path):
+            os.unlink(self.path)
+
+    def _load(self):
+        """Return the most recent entry, from memory or disk"""
+        with _lock:
+            entry = _memory.get(self.key)
+        if self.path and os.path.exists(self.path):
+            if entry and os.path.getmtime(self.path) <= entry[0]:
+                return entry
+            try:
+                with open(self.path, 'rb') as f:
+                    disk_entry = pickle.load(f)
+            except Exception, e:
+                msg = 'Ignoring the master snapshot {0}. Cause: {1}'
+                self.log.warning(msg.format(self.path, str(e)))
+                return entry
+            if not entry or disk_entry[0] > entry[0]:
+                entry = disk_entry
+                with _lock:
+                    _memory[self.key] = entry
+        return entry
+
+    def _save(self, entry):
+        """Write the entry in the file, atomically"""
+        (fd, tmp_path) = tempfile.mkstemp(dir=self.directory,
+                                          prefix='.master_')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump(entry, f, pickle.HIGHEST_PROTOCOL)
+            os.rename(tmp_path, self.path)
+        except Exception:
+            os.unlink(tmp_path)
+            raise
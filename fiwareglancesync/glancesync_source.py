@@ -0,0 +1,292 @@
+#!/usr/bin/env python
+# -- encoding: utf-8 --
+#
+# Copyright 2015-2016 Telefónica Investigación y Desarrollo, S.A.U
+#
+# This file is part of FI-WARE project.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+#
+# You may obtain a copy of the License at:
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# For those usages not covered by the Apache version 2.0 License please
+# contact with opensource@tid.es
+#
+
+import ctypes
+import ctypes.util
+import hashlib
+import mmap
+import os
+import sys
+import time
+
+"""This internal module reads the content of a master image to upload it.
+
+The glance client reads the content in small chunks (64 KB). ImageFile reads
+the file with large reads aligned to the page size and serves the chunks from
+memory, computing the MD5 of the content in the same pass. The kernel is told
+that the file is read sequentially (so it reads ahead more) and, optionally,
+that the pages already read are not needed anymore: a multi-GB image would
+otherwise evict the rest of the page cache.
+
+posix_fadvise is invoked through ctypes, because the os module of python 2
+does not include it. If it is not available, the hints are not given.
+
+When the file is not available (glancesync does not run in the master glance
+node), the content is downloaded from the master region and passed to the
+upload through a StreamReader, chunk by chunk, without saving it.
+"""
+
+# Default size of the reads from the file (bytes)
+default_block_size = 1024 * 1024
+
+# Bytes read that are kept in the page cache when drop_cache is True. The
+# kernel does not drop the pages just read (they are still in the LRU lists of
+# the CPU), so they are dropped later.
+_drop_lag = 8 * 1024 * 1024
+
+# Advice values of Linux
+_POSIX_FADV_SEQUENTIAL = 2
+_POSIX_FADV_DONTNEED = 4
+
+
+def _load_fadvise():
+    """Return the posix_fadvise function of the libc, or None"""
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        function = libc.posix_fadvise
+    except (OSError, AttributeError):
+        return None
+    function.argtypes = [ctypes.c_int, ctypes.c_int64, ctypes.c_int64,
+                         ctypes.c_int]
+    return function
+
+_posix_fadvise = _load_fadvise()
+
+
+def fadvise(fd, offset, length, advice):
+    """Give an advice about the use of a file to the kernel. It does nothing
+    if posix_fadvise is not available.
+
+    :return: True if the advice has been given.
+    """
+    if _posix_fadvise is None:
+        return False
+    return _posix_fadvise(fd, offset, length, advice) == 0
+
+
+class ImageFile(object):
+    """File-like object with the content of a master image.
+
+    Besides read, it supports seek and tell, so the glance client can obtain
+    the size and the upload can be retried from the beginning. md5 is the
+    MD5 of the content read since the last seek to the beginning of the file.
+    """
+
+    def __init__(self, path, block_size=default_block_size, drop_cache=True):
+        """Open the file.
+
+        :param path: the path of the file.
+        :param block_size: the size of each read; it is rounded up to a
+          multiple of the page size.
+        :param drop_cache: if True, the pages read are removed from the page
+          cache.
+        """
+        self.name = path
+        self.block_size = -(-block_size // mmap.PAGESIZE) * mmap.PAGESIZE
+        self.drop_cache = drop_cache
+        self._fd = os.open(path, os.O_RDONLY)
+        self.size = os.fstat(self._fd).st_size
+        fadvise(self._fd, 0, 0, _POSIX_FADV_SEQUENTIAL)
+        self.closed = False
+        self._reset(0)
+
+    def _reset(self, offset):
+        """helper method, to start reading at offset"""
+        self.md5 = hashlib.md5()
+        self.bytes_read = 0
+        self._dropped = 0
+        self.start_time = None
+        self.end_time = None
+        self._buffer = ''
+        self._pos = 0
+        # offset of the file after the data in _buffer
+        self._offset = offset
+
+    def _next_block(self):
+        """Return the next block of the file, or an empty string at the end
+        """
+        block = os.read(self._fd, self.block_size)
+        self._offset += len(block)
+        if self.drop_cache and self._offset - self._dropped > _drop_lag * 2:
+            offset = self._offset - _drop_lag
+            fadvise(self._fd, self._dropped, offset - self._dropped,
+                    _POSIX_FADV_DONTNEED)
+            self._dropped = offset
+        return block
+
+    def read(self, size=-1):
+        """Read up to size bytes (all the pending content if size < 0)"""
+        if self.start_time is None:
+            self.start_time = time.time()
+        if size < 0:
+            parts = [self._buffer[self._pos:]]
+            while True:
+                block = self._next_block()
+                if not block:
+                    break
+                parts.append(block)
+            data = ''.join(parts)
+            self._buffer = ''
+            self._pos = 0
+        else:
+            while len(self._buffer) - self._pos < size:
+                block = self._next_block()
+                if not block:
+                    break
+                if self._pos == len(self._buffer):
+                    # usual case: the chunks are aligned with the blocks
+                    self._buffer = block
+                else:
+                    self._buffer = self._buffer[self._pos:] + block
+                self._pos = 0
+            data = self._buffer[self._pos:self._pos + size]
+            self._pos += len(data)
+        if data:
+            self.md5.update(data)
+            self.bytes_read += len(data)
+        elif size != 0 and self.end_time is None:
+            self.end_time = time.time()
+        return data
+
+    def __iter__(self):
+        while True:
+            chunk = self.read(self.block_size)
+            if not chunk:
+                break
+            yield chunk
+
+    def tell(self):
+        """Return the position of the next byte to read"""
+        return self._offset - (len(self._buffer) - self._pos)
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        """Change the position. The MD5 and the statistics start again."""
+        if whence == os.SEEK_CUR:
+            offset += self.tell()
+        elif whence == os.SEEK_END:
+            offset += self.size
+        if offset < 0:
+            raise IOError('Invalid offset: ' + str(offset))
+        os.lseek(self._fd, offset, os.SEEK_SET)
+        self._reset(offset)
+
+    @property
+    def elapsed(self):
+        """seconds since the first read until the end of the file (or until
+        now, if the end has not been reached)"""
+        if self.start_time is None:
+            return 0
+        return (self.end_time or time.time()) - self.start_time
+
+    @property
+    def rate(self):
+        """bytes read per second"""
+        elapsed = self.elapsed
+        if not elapsed:
+            return 0
+        return self.bytes_read / elapsed
+
+    def close(self):
+        """Close the file"""
+        if not self.closed:
+            if self.drop_cache:
+                fadvise(self._fd, 0, 0, _POSIX_FADV_DONTNEED)
+            os.close(self._fd)
+            self.closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class StreamReader(object):
+    """File-like object with the content returned by an iterator of chunks
+    (e.g. the body of a download). It cannot seek."""
+
+    def __init__(self, chunks, size=None):
+        """Create the reader.
+
+        :param chunks: an iterable of strings.
+        :param size: the size of the content, if known.
+        """
+        self.size = size
+        self.bytes_read = 0
+        self.closed = False
+        self._body = chunks
+        self._chunks = iter(chunks)
+        self._buffer = ''
+        self._pos = 0
+
+    def _next_chunk(self):
+        """Return the next non-empty chunk, or an empty string at the end"""
+        for chunk in self._chunks:
+            if chunk:
+                return chunk
+        return ''
+
+    def read(self, size=-1):
+        """Read up to size bytes (all the pending content if size < 0)"""
+        parts = [self._buffer[self._pos:]]
+        length = len(parts[0])
+        while size < 0 or length < size:
+            chunk = self._next_chunk()
+            if not chunk:
+                break
+            parts.append(chunk)
+            length += len(chunk)
+        data = ''.join(parts)
+        if 0 <= size < length:
+            self._buffer = data
+            self._pos = size
+            data = data[:size]
+        else:
+            self._buffer = ''
+            self._pos = 0
+        self.bytes_read += len(data)
+        return data
+
+    def __iter__(self):
+        while True:
+            chunk = self.read(default_block_size)
+            if not chunk:
+                break
+            yield chunk
+
+    def close(self):
+        """Close the reader and the iterable, if it can be closed"""
+        if not self.closed:
+            self.closed = True
+            if hasattr(self._body, 'close'):
+                self._body.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
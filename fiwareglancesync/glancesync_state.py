@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+# -- encoding: utf-8 --
+#
+# Copyright 2015-2016 Telefónica Investigación y Desarrollo, S.A.U
+#
+# This file is part of FI-WARE project.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+#
+# You may obtain a copy of the License at:
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# For those usages not covered by the Apache version 2.0 License please
+# contact with opensource@tid.es
+#
+
+import hashlib
+import marshal
+import os
+import sqlite3
+import threading
+import time
+
+from glancesync_snapshot import fingerprint_images
+
+"""This internal module saves the state of the regions after each successful
+synchronisation, to do incremental synchronisations.
+
+For each region, it saves the fingerprint of the master region and of the
+target configuration, and for each master image the fingerprint of the image
+and the UUID and checksum of the image in the region (if any). When the
+master region has not changed since the last synchronisation of a region,
+the region may be skipped; when only some images have changed, only these
+images are checked in the region.
+
+Because the changes done directly in the regions are not detected this way,
+the state is only trusted for a number of runs: then the region is verified
+completely.
+"""
+
+_schema = """
+CREATE TABLE IF NOT EXISTS regions (
+    region TEXT PRIMARY KEY,
+    master_fingerprint TEXT,
+    target_fingerprint TEXT,
+    runs INTEGER,
+    updated REAL
+);
+CREATE TABLE IF NOT EXISTS images (
+    region TEXT,
+    name TEXT,
+    master_fingerprint TEXT,
+    region_id TEXT,
+    checksum TEXT,
+    PRIMARY KEY (region, name)
+);
+"""
+
+# when more master images have changed, the whole region is checked
+max_changed_images = 20
+
+# options of the target that determine the images to synchronise
+_target_options = ('metadata_set', 'forcesyncs', 'replace', 'rename',
+                   'dontupdate', 'only_tenant_images',
+                   'support_obsolete_images', 'obsolete_syncprops',
+                   'reuse_images')
+
+
+def image_fingerprint(image):
+    """Return the fingerprint of an image (see
+    glancesync_snapshot.fingerprint_images)"""
+    return fingerprint_images([image])
+
+
+def target_fingerprint(target):
+    """Return a fingerprint of the options of a target that determine which
+    images are synchronised and how.
+
+    :param target: the target dictionary
+    :return: a string
+    """
+    values = list()
+    for option in _target_options:
+        value = target.get(option)
+        if isinstance(value, set):
+            value = sorted(value)
+        values.append((option, value))
+    condition = target.get('metadata_condition')
+    if hasattr(condition, 'normalized'):
+        condition = condition.normalized
+    elif condition is not None:
+        condition = hashlib.sha1(marshal.dumps(condition)).hexdigest()
+    values.append(('metadata_condition', condition))
+    return hashlib.sha1(repr(values)).hexdigest()
+
+
+class RegionState(object):
+    """The saved state of a region"""
+
+    def __init__(self, region, master_fingerprint, target_fingerprint, runs,
+                 updated):
+        self.region = region
+        self.master_fingerprint = master_fingerprint
+        self.target_fingerprint = target_fingerprint
+        # number of runs since the last complete verification
+        self.runs = runs
+        self.updated = updated
+
+
+class SyncStateStore(object):
+    """SQLite database with the state of the regions"""
+
+    def __init__(self, path):
+        """Create the object. The database is created on first use.
+
+        :param path: the path of the SQLite file.
+        """
+        self.path = path
+        self._connection = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        """Return the connection of this process, creating it if necessary.
+        A connection is not shared with the forked children."""
+        if self._connection is None or self._pid != os.getpid():
+            self._connection = sqlite3.connect(
+                self.path, timeout=30, check_same_thread=False)
+            self._connection.executescript(_schema)
+            self._pid = os.getpid()
+        return self._connection
+
+    def get_region(self, region):
+        """Return the RegionState of the region, or None if it is unknown"""
+        with self._lock:
+            row = self._connect().execute(
+                'SELECT master_fingerprint, target_fingerprint, runs, updated '
+                'FROM regions WHERE region = ?', (region,)).fetchone()
+        if row is None:
+            return None
+        return RegionState(region, *row)
+
+    def get_images(self, region):
+        """Return the saved images of the region.
+
+        :param region: the region name
+        :return: a dictionary indexed by image name. The values are tuples
+          (master fingerprint, UUID in the region, checksum)
+        """
+        with self._lock:
+            rows = self._connect().execute(
+                'SELECT name, master_fingerprint, region_id, checksum '
+                'FROM images WHERE region = ?', (region,)).fetchall()
+        return dict((row[0], tuple(row[1:])) for row in rows)
+
+    def save_region(self, region, master_fingerprint, target_fingerprint,
+                    images, names=None, verified=True):
+        """Save the state of a region after a successful synchronisation.
+
+        :param region: the region name
+        :param master_fingerprint: the fingerprint of the master region
+        :param target_fingerprint: the fingerprint of the target options
+        :param images: a dictionary with the confirmed images, indexed by
+          name. The values are tuples (master fingerprint, UUID in the region,
+          checksum)
+        :param names: the names of all the master images. The saved images
+          not included are removed. If None, the keys of images.
+        :param verified: True if the region was verified completely; then the
+          counter of runs is reset. Otherwise it is incremented.
+        :return: nothing
+        """
+        if names is None:
+            names = set(images)
+        with self._lock:
+            connection = self._connect()
+            with connection:
+                row = connection.execute(
+                    'SELECT runs FROM regions WHERE region = ?',
+                    (region,)).fetchone()
+                runs = 0
+                if row is not None and not verified:
+                    runs = row[0] + 1
+                connection.execute(
+                    'INSERT OR REPLACE INTO regions VALUES (?, ?, ?, ?, ?)',
+                    (region, master_fingerprint, target_fingerprint, runs,
+                     time.time()))
+                saved = set(row[0] for row in connection.execute(
+                    'SELECT name FROM images WHERE region = ?', (region,)))
+                for name in saved - set(names):
+                    connection.execute(
+                        'DELETE FROM images WHERE region = ? AND name = ?',
+                        (region, name))
+                for (name, value) in images.items():
+                    connection.execute(
+                        'INSERT OR REPLACE INTO images VALUES (?, ?, ?, ?, ?)',
+                        (region, name) + tuple(value))
+
+    def forget_region(self, region):
+        """Delete the state of a region: it will be verified in the next
+        synchronisation"""
+        with self._lock:
+            connection = self._connect()
+            with connection:
+                connection.execute('DELETE FROM regions WHERE region = ?',
+                                   (region,))
+                connection.execute('DELETE FROM images WHERE region = ?',
+                                   (region,))
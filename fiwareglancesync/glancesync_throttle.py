@@ -0,0 +1,270 @@
+#!/usr/bin/env python
+# -- encoding: utf-8 --
+#
+# Copyright 2015-2016 Telefónica Investigación y Desarrollo, S.A.U
+#
+# This file is part of FI-WARE project.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+#
+# You may obtain a copy of the License at:
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# For those usages not covered by the Apache version 2.0 License please
+# contact with opensource@tid.es
+#
+
+import ConfigParser
+import os
+import threading
+import time
+
+from app.settings.settings import logger_cli
+
+"""This internal module limits the bandwidth used by the uploads.
+
+There is a token bucket for all the uploads (max_bandwidth, in the main
+section), one shared by the regions of each target (max_target_bandwidth)
+and one for each region (max_region_bandwidth, set in the section of its
+target). The content of each upload is read through a ThrottledReader, that
+takes from the three buckets the bytes it returns, waiting when there are not
+enough tokens.
+
+The limits are in kilobytes per second; 0 means no limit. They can be changed
+at runtime with bandwidth_file, a file with the same format as the
+configuration file but only with these options. The file is read again when
+it is modified (it is checked every check_interval seconds while uploading)
+and when reload is requested (e.g. with SIGHUP).
+"""
+
+# Seconds between two checks of the modification time of bandwidth_file
+check_interval = 5
+# Size of the chunks read when iterating over a ThrottledReader
+_chunk_size = 64 * 1024
+
+
+class TokenBucket(object):
+    """Thread-safe token bucket, where a token is a byte. The bucket is
+    refilled at rate tokens per second, up to the tokens of one second."""
+
+    def __init__(self, rate=0):
+        """Create the bucket.
+
+        :param rate: bytes per second; 0 means no limit.
+        """
+        self._lock = threading.Lock()
+        self._tokens = 0.0
+        self._last = time.time()
+        self.rate = 0
+        self.set_rate(rate)
+
+    def set_rate(self, rate):
+        """Change the rate (bytes per second; 0 means no limit)"""
+        with self._lock:
+            self.rate = max(0, rate)
+            self._tokens = min(self._tokens, self.rate)
+            self._last = time.time()
+
+    def take(self, amount):
+        """Take amount tokens. The bucket may be left in debt, so a request
+        bigger than the bucket is possible.
+
+        :param amount: the number of bytes.
+        :return: the seconds to wait until the bucket is not in debt.
+        """
+        with self._lock:
+            if not self.rate:
+                return 0
+            now = time.time()
+            # the clock may go backwards
+            elapsed = max(0, now - self._last)
+            self._tokens = min(self.rate, self._tokens + elapsed * self.rate)
+            self._last = now
+            self._tokens -= amount
+            return max(0, -self._tokens / self.rate)
+
+    def consume(self, amount):
+        """Take amount tokens, waiting until they are available"""
+        wait = self.take(amount)
+        if wait > 0:
+            time.sleep(wait)
+
+
+class Throttle(object):
+    """The bandwidth limits of the uploads: global, per target and per region.
+    """
+
+    def __init__(self, max_bandwidth=0, target_limits=None, path=None):
+        """Create the object.
+
+        :param max_bandwidth: the global limit (KB/s).
+        :param target_limits: a dictionary with a tuple
+          (max_target_bandwidth, max_region_bandwidth) for each target name.
+        :param path: optional bandwidth_file, that overrides the limits.
+        """
+        self.log = logger_cli
+        self.path = path
+        self._configured = (max_bandwidth, dict(target_limits or {}))
+        self._lock = threading.Lock()
+        self._global = TokenBucket()
+        # bucket by target name
+        self._targets = dict()
+        # tuple (target name, bucket) by region
+        self._regions = dict()
+        self._share = 1
+        self._mtime = None
+        self._next_check = 0
+        self.max_bandwidth = 0
+        self.target_limits = dict()
+        self._apply(*self._configured)
+        if path:
+            self.reload()
+
+    def set_share(self, share):
+        """Divide the global and target limits between share processes (e.g.
+        the workers of parallel_sync, that cannot share the buckets). The
+        region limits are not divided: each region is synchronised by only
+        one process."""
+        with self._lock:
+            self._share = max(1, int(share))
+        self._apply(self.max_bandwidth, self.target_limits)
+
+    def _rate(self, kbytes, shared=True):
+        """helper method, to convert a limit in KB/s to a rate of this
+        process, in bytes per second. If shared is False, the limit is not
+        divided between the processes."""
+        if not shared:
+            return kbytes * 1024.0
+        return kbytes * 1024.0 / self._share
+
+    def _apply(self, max_bandwidth, target_limits):
+        """helper method, to set the limits and update the buckets"""
+        with self._lock:
+            self.max_bandwidth = max_bandwidth
+            self.target_limits = target_limits
+            self._global.set_rate(self._rate(max_bandwidth))
+            for (name, bucket) in self._targets.items():
+                limit = target_limits.get(name, (0, 0))[0]
+                bucket.set_rate(self._rate(limit))
+            for (name, bucket) in self._regions.values():
+                limit = target_limits.get(name, (0, 0))[1]
+                bucket.set_rate(self._rate(limit, shared=False))
+
+    def reload(self):
+        """Read bandwidth_file. The limits that are not in the file (or all
+        of them, if the file does not exist) take the value of the
+        configuration. If the file cannot be parsed, the limits do not
+        change.
+
+        :return: True if the limits have been updated.
+        """
+        if not self.path:
+            return False
+        (max_bandwidth, target_limits) = self._configured
+        target_limits = dict(target_limits)
+        mtime = None
+        if os.path.exists(self.path):
+            try:
+                mtime = os.path.getmtime(self.path)
+                parser = ConfigParser.SafeConfigParser()
+                with open(self.path) as file_obj:
+                    parser.readfp(file_obj)
+                if parser.has_option('main', 'max_bandwidth'):
+                    max_bandwidth = parser.getint('main', 'max_bandwidth')
+                for section in parser.sections():
+                    if section == 'main':
+                        continue
+                    limits = list(target_limits.get(section, (0, 0)))
+                    for (index, option) in enumerate(
+                            ('max_target_bandwidth', 'max_region_bandwidth')):
+                        if parser.has_option(section, option):
+                            limits[index] = parser.getint(section, option)
+                    target_limits[section] = tuple(limits)
+            except (EnvironmentError, ConfigParser.Error, ValueError), e:
+                msg = 'Cannot read the bandwidth limits from {0}: {1}'
+                self.log.warning(msg.format(self.path, str(e)))
+                return False
+        self._mtime = mtime
+        self._apply(max_bandwidth, target_limits)
+        self.log.info('Bandwidth limits loaded from ' + self.path)
+        return True
+
+    def request_reload(self):
+        """Read bandwidth_file again on the next read of an upload. It is
+        safe to invoke it from a signal handler."""
+        self._next_check = 0
+        self._mtime = -1
+
+    def check(self):
+        """Read bandwidth_file again if it has been modified since it was
+        read. The file is only checked every check_interval seconds."""
+        if not self.path or time.time() < self._next_check:
+            return
+        self._next_check = time.time() + check_interval
+        if os.path.exists(self.path):
+            mtime = os.path.getmtime(self.path)
+        else:
+            mtime = None
+        if mtime != self._mtime:
+            self.reload()
+
+    def reader(self, data, region, target_name):
+        """Return a file-like object that reads data within the limits of the
+        region.
+
+        :param data: the file-like object with the content of the image.
+        :param region: the full name of the region (see GlanceSyncRegion).
+        :param target_name: the name of the target of the region.
+        :return: a ThrottledReader.
+        """
+        with self._lock:
+            if target_name not in self._targets:
+                limit = self.target_limits.get(target_name, (0, 0))[0]
+                self._targets[target_name] = TokenBucket(self._rate(limit))
+            if region not in self._regions:
+                limit = self.target_limits.get(target_name, (0, 0))[1]
+                self._regions[region] = (
+                    target_name, TokenBucket(self._rate(limit, shared=False)))
+            buckets = (self._global, self._targets[target_name],
+                       self._regions[region][1])
+        return ThrottledReader(data, self, buckets)
+
+
+class ThrottledReader(object):
+    """File-like object that reads other file-like object, taking the bytes
+    read from several token buckets. The rest of the attributes (e.g. seek
+    and tell, used to obtain the size) are the ones of the wrapped object."""
+
+    def __init__(self, data, throttle, buckets):
+        self._data = data
+        self._throttle = throttle
+        self._buckets = buckets
+
+    def read(self, size=-1):
+        chunk = self._data.read(size)
+        if chunk:
+            self._throttle.check()
+            # the buckets are taken at the same time: wait for the slowest
+            wait = max(bucket.take(len(chunk)) for bucket in self._buckets)
+            if wait > 0:
+                time.sleep(wait)
+        return chunk
+
+    def __iter__(self):
+        while True:
+            chunk = self.read(_chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+    def __getattr__(self, name):
+        return getattr(self._data, name)
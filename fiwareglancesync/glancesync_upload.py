@@ -0,0 +1,413 @@
+#!/usr/bin/env python
+# -- encoding: utf-8 --
+#
+# Copyright 2015-2016 Telefónica Investigación y Desarrollo, S.A.U
+#
+# This file is part of FI-WARE project.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+#
+# You may obtain a copy of the License at:
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# For those usages not covered by the Apache version 2.0 License please
+# contact with opensource@tid.es
+#
+
+import threading
+
+from app.settings.settings import logger_cli
+
+"""This internal module runs the uploads of a region, or of several regions,
+concurrently.
+
+Uploads are not fully independent: an AMI image refers to its kernel and its
+ramdisk, and the UUID of these images in the region is only known after they
+are uploaded. The scheduler receives the dependencies between jobs explicitly
+and does not start a job until all the jobs it depends on have finished.
+"""
+
+
+class UploadScheduler(object):
+    """Run jobs with a bounded pool of threads, honouring the dependencies
+    between them.
+
+    Jobs are started in the same order they were added, unless they are
+    waiting for a dependency. When max_workers is 1, the jobs are run in the
+    calling thread, in order.
+    """
+
+    def __init__(self, max_workers=1, stop_on_error=True):
+        """Create a new scheduler.
+
+        :param max_workers: maximum number of jobs running at the same time.
+        :param stop_on_error: if True, no more jobs are started after a
+          failure (the running ones are waited for).
+        """
+        self.log = logger_cli
+        self.max_workers = max(1, int(max_workers))
+        self.stop_on_error = stop_on_error
+        self._jobs = list()
+        self._names = set()
+        self._condition = threading.Condition()
+        self._done = set()
+        self._failed = dict()
+        self._running = 0
+        self._stopped = False
+
+    def add_job(self, name, function, depends_on=None):
+        """Add a job to the scheduler.
+
+        :param name: the name of the job; it must be unique (e.g. the name of
+          the image to upload).
+        :param function: a callable without parameters.
+        :param depends_on: names of the jobs that must be finished before
+          starting this job. Names not added to the scheduler are ignored
+          (e.g. a kernel image that is already in the region).
+        :return: nothing
+        """
+        if name in self._names:
+            raise ValueError('Duplicated job: ' + name)
+        self._names.add(name)
+        self._jobs.append((name, function, set(depends_on or ())))
+
+    def run(self):
+        """Run all the jobs and wait until they are finished.
+
+        :return: a dictionary with the failed jobs. The key is the name of the
+          job and the value the exception. A job is also failed when a job
+          it depends on has failed, or when it was not started because
+          another job failed and stop_on_error is True.
+        """
+        for job in self._jobs:
+            # only the dependencies inside this scheduler matter
+            job[2].intersection_update(self._names)
+        if self.max_workers == 1 or len(self._jobs) < 2:
+            self._work()
+        else:
+            workers = list()
+            for i in range(min(self.max_workers, len(self._jobs))):
+                worker = threading.Thread(target=self._work)
+                worker.daemon = True
+                worker.start()
+                workers.append(worker)
+            for worker in workers:
+                worker.join()
+        return self._failed
+
+    def _next_job(self):
+        """Return the first job ready to run, or None if all the jobs have
+        been processed. It waits when there are jobs blocked by a dependency
+        that is still running. Must be invoked with the lock acquired.
+        """
+        while True:
+            if self._stopped:
+                for (name, function, depends_on) in self._jobs:
+                    self._failed[name] = UploadSkippedException(
+                        name, 'cancelled after a previous error')
+                del self._jobs[:]
+                return None
+            for job in self._jobs:
+                (name, function, depends_on) = job
+                failed_deps = depends_on.intersection(self._failed)
+                if failed_deps:
+                    self._jobs.remove(job)
+                    self._failed[name] = UploadSkippedException(
+                        name, 'dependency failed: ' +
+                        ', '.join(sorted(failed_deps)))
+                    self._condition.notify_all()
+                    break
+                if depends_on.issubset(self._done):
+                    self._jobs.remove(job)
+                    self._running += 1
+                    return job
+            else:
+                if not self._jobs:
+                    return None
+                if self._running == 0:
+                    # Nothing can unblock the remaining jobs.
+                    for (name, function, depends_on) in self._jobs:
+                        self._failed[name] = UploadSkippedException(
+                            name, 'unresolvable dependency')
+                    del self._jobs[:]
+                    return None
+                self._condition.wait()
+
+    def _work(self):
+        """Loop of each worker: take jobs until there are none left"""
+        while True:
+            with self._condition:
+                job = self._next_job()
+            if job is None:
+                return
+            (name, function, depends_on) = job
+            error = None
+            try:
+                function()
+            except Exception, e:
+                error = e
+            with self._condition:
+                self._running -= 1
+                if error is None:
+                    self._done.add(name)
+                else:
+                    self._failed[name] = error
+                    if self.stop_on_error:
+                        self._stopped = True
+                self._condition.notify_all()
+
+
+class TransferScheduler(object):
+    """Run the uploads of several regions with a bounded pool of threads.
+
+    Each job is the transfer of an image to a region. Besides the global
+    limit of concurrent transfers, there is a limit per region and a limit
+    per target (i.e. per keystone server). When several jobs are ready, the
+    next one is chosen according to the policy:
+
+    * smallest: the smallest image first.
+    * largest: the largest image first.
+    * most_waiting: the image pending in more regions first (the smallest
+      image in case of a tie).
+
+    A job only depends on jobs of the same region. When a job of a region
+    fails, the pending jobs of that region are cancelled, but the other
+    regions continue.
+    """
+
+    policies = ('smallest', 'largest', 'most_waiting')
+
+    def __init__(self, max_transfers=1, policy='smallest'):
+        """Create a new scheduler.
+
+        :param max_transfers: maximum number of transfers at the same time.
+        :param policy: how to choose the next job, see the class docstring.
+        """
+        if policy not in self.policies:
+            raise ValueError('Unknown transfer policy: ' + policy)
+        self.log = logger_cli
+        self.max_transfers = max(1, int(max_transfers))
+        self.policy = policy
+        self._jobs = list()
+        self._keys = set()
+        self._condition = threading.Condition()
+        self._region_limits = dict()
+        self._target_limits = dict()
+        self._running_region = dict()
+        self._running_target = dict()
+        self._running = 0
+        self._done = set()
+        self._failed = dict()
+        self._failed_regions = set()
+
+    def set_region_limit(self, region, limit):
+        """Set the maximum number of transfers at the same time to a region.
+        By default there is no limit but the global one."""
+        self._region_limits[region] = max(1, int(limit))
+
+    def set_target_limit(self, target, limit):
+        """Set the maximum number of transfers at the same time to the
+        regions of a target. A limit of 0 means no limit."""
+        if int(limit) > 0:
+            self._target_limits[target] = int(limit)
+
+    def add_job(self, region, name, function, size=0, depends_on=None,
+                target=None):
+        """Add a job to the scheduler.
+
+        :param region: the region where the image is transferred.
+        :param name: the name of the image; it must be unique in the region.
+        :param function: a callable without parameters.
+        :param size: the size of the image, used by the policies.
+        :param depends_on: names of the images of the same region that must
+          be transferred before. Names not added to the scheduler are ignored.
+        :param target: the target of the region, for the target limit.
+        :return: nothing
+        """
+        key = (region, name)
+        if key in self._keys:
+            raise ValueError('Duplicated job: ' + region + ' ' + name)
+        self._keys.add(key)
+        depends_on = set((region, dep) for dep in depends_on or ())
+        self._jobs.append(
+            _TransferJob(region, name, function, int(size), depends_on,
+                         target))
+
+    def run(self):
+        """Run all the jobs and wait until they are finished.
+
+        :return: a dictionary with the failed jobs. The key is the tuple
+          (region, name) and the value the exception. The jobs cancelled
+          because another job of the region failed are included.
+        """
+        for job in self._jobs:
+            # only the dependencies inside this scheduler matter
+            job.depends_on.intersection_update(self._keys)
+        if self.max_transfers == 1 or len(self._jobs) < 2:
+            self._work()
+        else:
+            workers = list()
+            for i in range(min(self.max_transfers, len(self._jobs))):
+                worker = threading.Thread(target=self._work)
+                worker.daemon = True
+                worker.start()
+                workers.append(worker)
+            for worker in workers:
+                worker.join()
+        return self._failed
+
+    def _sort_key(self, job, waiting):
+        """key to choose the next job according to the policy"""
+        if self.policy == 'largest':
+            return -job.size
+        elif self.policy == 'most_waiting':
+            return (-waiting[job.name], job.size)
+        else:
+            return job.size
+
+    def _can_start(self, job):
+        """Check the limits and the dependencies of the job"""
+        if not job.depends_on.issubset(self._done):
+            return False
+        limit = self._region_limits.get(job.region)
+        if limit and self._running_region.get(job.region, 0) >= limit:
+            return False
+        limit = self._target_limits.get(job.target)
+        if limit and self._running_target.get(job.target, 0) >= limit:
+            return False
+        return True
+
+    def _next_job(self):
+        """Return the next job to run, or None if all the jobs have been
+        processed. It waits when all the pending jobs are blocked by a limit
+        or a dependency. Must be invoked with the lock acquired.
+        """
+        while True:
+            for job in list(self._jobs):
+                if job.region in self._failed_regions:
+                    self._jobs.remove(job)
+                    self._failed[job.key] = UploadSkippedException(
+                        job.name, 'cancelled after a previous error in ' +
+                        job.region)
+            if not self._jobs:
+                return None
+            waiting = dict()
+            if self.policy == 'most_waiting':
+                for job in self._jobs:
+                    waiting[job.name] = waiting.get(job.name, 0) + 1
+            candidates = list(job for job in self._jobs
+                              if self._can_start(job))
+            if candidates:
+                # min is stable: on a tie, the first job added is chosen
+                job = min(candidates,
+                          key=lambda job: self._sort_key(job, waiting))
+                self._jobs.remove(job)
+                self._running += 1
+                self._running_region[job.region] = \
+                    self._running_region.get(job.region, 0) + 1
+                self._running_target[job.target] = \
+                    self._running_target.get(job.target, 0) + 1
+                return job
+            if self._running == 0:
+                # Nothing can unblock the remaining jobs.
+                for job in self._jobs:
+                    self._failed[job.key] = UploadSkippedException(
+                        job.name, 'unresolvable dependency')
+                del self._jobs[:]
+                return None
+            self._condition.wait()
+
+    def _work(self):
+        """Loop of each worker: take jobs until there are none left"""
+        while True:
+            with self._condition:
+                job = self._next_job()
+            if job is None:
+                return
+            error = None
+            try:
+                job.function()
+            except Exception, e:
+                error = e
+            with self._condition:
+                self._running -= 1
+                self._running_region[job.region] -= 1
+                self._running_target[job.target] -= 1
+                if error is None:
+                    self._done.add(job.key)
+                else:
+                    self._failed[job.key] = error
+                    self._failed_regions.add(job.region)
+                self._condition.notify_all()
+
+
+class _TransferJob(object):
+    """A job of the TransferScheduler"""
+
+    def __init__(self, region, name, function, size, depends_on, target):
+        self.region = region
+        self.name = name
+        self.key = (region, name)
+        self.function = function
+        self.size = size
+        self.depends_on = depends_on
+        self.target = target
+
+
+def ami_dependencies(image):
+    """Return the names of the images an AMI image depends on.
+
+    The master images passed to glancesync_ami.clean_ami_ids have the name
+    of the kernel and ramdisk images in kernel_id and ramdisk_id, instead of
+    the UUID.
+
+    :param image: a master image
+    :return: a set with the names of the kernel and ramdisk images
+    """
+    dependencies = set()
+    for prop in ('kernel_id', 'ramdisk_id'):
+        value = image.user_properties.get(prop, None)
+        if value:
+            dependencies.add(value)
+    return dependencies
+
+
+def dependency_order(images):
+    """Sort the images so that the kernel and ramdisk of an AMI image are
+    always before the image. Otherwise, the images are sorted by size.
+
+    :param images: a list of master images
+    :return: a new sorted list
+    """
+    by_name = dict((image.name, image) for image in images)
+    result = list()
+    added = set()
+
+    def add(image, visiting):
+        if image.name in added or image.name in visiting:
+            return
+        visiting.add(image.name)
+        for name in sorted(ami_dependencies(image)):
+            if name in by_name:
+                add(by_name[name], visiting)
+        added.add(image.name)
+        result.append(image)
+
+    for image in sorted(images, key=lambda image: int(image.size)):
+        add(image, set())
+    return result
+
+
+class UploadSkippedException(Exception):
+    """exception used for the jobs that have not been run"""
+    def __init__(self, name, cause):
+        Exception.__init__(self, 'Upload of ' + name + ' skipped: ' + cause)
@@ -26,6 +26,7 @@ import ConfigParser
 import os
 import base64
 from fiwareglancesync.app.settings.settings import logger_cli
+from fiwareglancesync.glancesync_condition import compile_condition
 
 __version__ = '1.7.0'
 
@@ -107,7 +108,16 @@ class GlanceSyncConfig(object):
 
         defaults = {'use_keystone_v3': 'False',
                     'support_obsolete_images': 'True',
-                    'only_tenant_images': 'True', 'list_images_timeout': '30'}
+                    'reuse_images': 'False',
+                    'only_tenant_images': 'True', 'list_images_timeout': '30',
+                    'list_images_page_size': '100',
+                    'max_concurrent_uploads': '1',
+                    'max_target_transfers': '0',
+                    'glance_api_version': '1',
+                    'upload_retries': '2', 'upload_retry_delay': '5',
+                    'max_target_bandwidth': '0',
+                    'max_region_bandwidth': '0',
+                    'image_source': 'local'}
 
         if not stream:
             if 'GLANCESYNC_CONFIG' in os.environ:
@@ -120,6 +130,22 @@ class GlanceSyncConfig(object):
         self.preferable_order = None
         self.max_children = 1
         self.images_dir = '/var/lib/glance/images'
+        self.drop_images_cache = True
+        self.fanout_stall_timeout = 60
+        self.max_transfers = 1
+        self.transfer_policy = 'smallest'
+        self.master_snapshot_ttl = 0
+        self.master_snapshot_dir = None
+        self.state_file = None
+        self.verify_every = 1
+        self.watch_interval = 60
+        self.watch_status_file = None
+        self.max_readers = 8
+        self.region_timeout = 600
+        self.max_bandwidth = 0
+        self.bandwidth_file = None
+        self.image_cache_dir = None
+        self.image_cache_size = 10240
 
         # Read configuration if it exists
         if configuration_path is not None or stream is not None:
@@ -156,6 +182,60 @@ class GlanceSyncConfig(object):
                                                             'max_children')
             if configparser.has_option('main', 'images_dir'):
                     self.images_dir = configparser.get('main', 'images_dir')
+            if configparser.has_option('main', 'drop_images_cache'):
+                self.drop_images_cache = configparser.getboolean(
+                    'main', 'drop_images_cache')
+            if configparser.has_option('main', 'fanout_stall_timeout'):
+                self.fanout_stall_timeout = configparser.getint(
+                    'main', 'fanout_stall_timeout')
+            if configparser.has_option('main', 'max_transfers'):
+                self.max_transfers = configparser.getint(
+                    'main', 'max_transfers')
+            if configparser.has_option('main', 'transfer_policy'):
+                self.transfer_policy = configparser.get(
+                    'main', 'transfer_policy').strip()
+                if self.transfer_policy not in (
+                        'smallest', 'largest', 'most_waiting'):
+                    msg = 'Error in section main: transfer_policy must be '\
+                        'smallest, largest or most_waiting'
+                    self.logger.error(msg)
+                    raise Exception(msg)
+            if configparser.has_option('main', 'master_snapshot_ttl'):
+                self.master_snapshot_ttl = configparser.getint(
+                    'main', 'master_snapshot_ttl')
+            if configparser.has_option('main', 'master_snapshot_dir'):
+                self.master_snapshot_dir = configparser.get(
+                    'main', 'master_snapshot_dir').strip() or None
+            if configparser.has_option('main', 'state_file'):
+                self.state_file = configparser.get(
+                    'main', 'state_file').strip() or None
+            if configparser.has_option('main', 'verify_every'):
+                self.verify_every = configparser.getint(
+                    'main', 'verify_every')
+            if configparser.has_option('main', 'watch_interval'):
+                self.watch_interval = configparser.getint(
+                    'main', 'watch_interval')
+            if configparser.has_option('main', 'watch_status_file'):
+                self.watch_status_file = configparser.get(
+                    'main', 'watch_status_file').strip() or None
+            if configparser.has_option('main', 'max_readers'):
+                self.max_readers = configparser.getint(
+                    'main', 'max_readers')
+            if configparser.has_option('main', 'region_timeout'):
+                self.region_timeout = configparser.getint(
+                    'main', 'region_timeout')
+            if configparser.has_option('main', 'max_bandwidth'):
+                self.max_bandwidth = configparser.getint(
+                    'main', 'max_bandwidth')
+            if configparser.has_option('main', 'bandwidth_file'):
+                self.bandwidth_file = configparser.get(
+                    'main', 'bandwidth_file').strip() or None
+            if configparser.has_option('main', 'image_cache_dir'):
+                self.image_cache_dir = configparser.get(
+                    'main', 'image_cache_dir').strip() or None
+            if configparser.has_option('main', 'image_cache_size'):
+                self.image_cache_size = configparser.getint(
+                    'main', 'image_cache_size')
 
             for section in configparser.sections():
                 if section == 'main' or section == 'DEFAULTS':
@@ -199,8 +279,14 @@ class GlanceSyncConfig(object):
                 if configparser.has_option(section, 'metadata_condition'):
                     cond = configparser.get(section, 'metadata_condition')
                     if len(cond.strip()):
-                        target['metadata_condition'] = compile(
-                            cond, 'metadata_condition', 'eval')
+                        try:
+                            target['metadata_condition'] = \
+                                compile_condition(cond)
+                        except ValueError, e:
+                            msg = 'Error in section {0}: {1}'.format(
+                                section, str(e))
+                            self.logger.error(msg)
+                            raise Exception(msg)
 
                 target['metadata_set'] = configparser.getset(
                     section, 'metadata_set')
@@ -218,12 +304,52 @@ class GlanceSyncConfig(object):
                 target['support_obsolete_images'] = configparser.getboolean(
                         section, 'support_obsolete_images')
 
+                target['reuse_images'] = configparser.getboolean(
+                        section, 'reuse_images')
+
                 target['list_images_timeout'] = configparser.getint(
                         section, 'list_images_timeout')
 
+                target['list_images_page_size'] = configparser.getint(
+                        section, 'list_images_page_size')
+
                 target['use_keystone_v3'] = configparser.getboolean(
                     section, 'use_keystone_v3')
 
+                target['max_concurrent_uploads'] = configparser.getint(
+                    section, 'max_concurrent_uploads')
+
+                target['max_target_transfers'] = configparser.getint(
+                    section, 'max_target_transfers')
+
+                target['glance_api_version'] = configparser.get(
+                    section, 'glance_api_version').strip()
+                if target['glance_api_version'] not in ('1', '2'):
+                    msg = 'Error in section {0}: glance_api_version must be '\
+                        '1 or 2'.format(section)
+                    self.logger.error(msg)
+                    raise Exception(msg)
+
+                target['upload_retries'] = configparser.getint(
+                    section, 'upload_retries')
+
+                target['upload_retry_delay'] = configparser.getint(
+                    section, 'upload_retry_delay')
+
+                target['max_target_bandwidth'] = configparser.getint(
+                    section, 'max_target_bandwidth')
+
+                target['max_region_bandwidth'] = configparser.getint(
+                    section, 'max_region_bandwidth')
+
+                target['image_source'] = configparser.get(
+                    section, 'image_source').strip()
+                if target['image_source'] not in ('local', 'master'):
+                    msg = 'Error in section {0}: image_source must be local '\
+                        'or master'.format(section)
+                    self.logger.error(msg)
+                    raise Exception(msg)
+
         # Default configuration if it is not present
         if self.master_region is None:
             if 'OS_REGION_NAME' in os.environ:
@@ -246,6 +372,15 @@ class GlanceSyncConfig(object):
             self.targets['master']['ignore_regions'] = set()
             self.targets['master']['metadata_set'] = set()
             self.targets['master']['only_tenant_images'] = True
+            self.targets['master']['reuse_images'] = False
+            self.targets['master']['max_concurrent_uploads'] = 1
+            self.targets['master']['max_target_transfers'] = 0
+            self.targets['master']['glance_api_version'] = '1'
+            self.targets['master']['upload_retries'] = 2
+            self.targets['master']['upload_retry_delay'] = 5
+            self.targets['master']['max_target_bandwidth'] = 0
+            self.targets['master']['max_region_bandwidth'] = 0
+            self.targets['master']['image_source'] = 'local'
 
         if 'user' not in self.targets['master']:
             if 'OS_USERNAME' in os.environ:
@@ -30,8 +30,16 @@ import os.path
 import datetime
 import argparse
 import logging
+import signal
+import time
+import json
+import threading
+from multiprocessing import Pool
 
 from fiwareglancesync.glancesync import GlanceSync
+from fiwareglancesync import glancesync_plan
+from fiwareglancesync.glancesync_plan import SyncPlan
+from fiwareglancesync.glancesync_state import SyncStateStore
 
 
 class Sync(object):
@@ -65,24 +73,47 @@ class Sync(object):
 
             regions.extend(regions_unsorted)
         self.regions = regions
+        self._stop_event = threading.Event()
 
     def report_status(self):
-        """Report the synchronisation status of the regions"""
-        for region in self.regions:
-            try:
-                stream = StringIO.StringIO()
-                self.glancesync.export_sync_region_status(region, stream)
-                print(stream.getvalue())
-            except Exception:
-                # Don't do anything. Message has been already printed
-                # try next region
-                continue
+        """Report the synchronisation status of the regions. The regions are
+        evaluated concurrently (see _run_regions), but the reports are
+        printed in the order of the regions."""
+        def report(region):
+            stream = StringIO.StringIO()
+            self.glancesync.export_sync_region_status(region, stream)
+            return stream.getvalue()
+
+        # The master images are obtained before starting the threads
+        self.glancesync.master_region_dict
+        for (region, result, error) in self._run_regions(report,
+                                                         self.regions):
+            if error is None:
+                print(result)
+            # Otherwise, don't do anything. Message has been already printed
 
     def parallel_sync(self):
         """Run the synchronisation in several regions in parallel. The
         synchronisation inside the region is sequential (i.e. several
         regions are synchronised simultaneously, but only one image at time
-        is uploaded for each region)"""
+        is uploaded for each region, unless max_concurrent_uploads is set)
+
+        The regions are distributed between a pool of max_children worker
+        processes. The workers are created once and reused: the regions
+        synchronised by the same worker share the authenticated sessions
+        of the GlanceSync object. The log of each region is written to
+        a file in the directory sync_<date> and the result of each region is
+        printed as soon as it has finished.
+
+        The global and target bandwidth limits (see glancesync_throttle) are
+        divided between the workers, because each one has its own token
+        buckets.
+
+        :return: a list with the result of each region, in the order they
+          finished. Each result is a dictionary with the keys region, status
+          ('ok' or 'error'), bytes (uploaded), duration (seconds) and errors
+          (a list with the error messages).
+        """
         max_children = self.glancesync.max_children
         now = datetime.datetime.now()
         datestr = str(now.year) + str(now.month).zfill(2) + \
@@ -93,41 +124,29 @@ class Sync(object):
         print(msg)
         sys.stdout.flush()
         os.mkdir('sync_' + datestr)
-        children = dict()
 
-        for region in self.regions:
-            try:
-                if len(children) >= max_children:
-                    self._wait_child(children)
-
-                pid = os.fork()
-                if pid > 0:
-                    children[pid] = region
-                    continue
-                else:
-                    path = os.path.join('sync_' + datestr, region + '.txt')
-                    handler = logging.FileHandler(path)
-                    handler.setFormatter(logging.Formatter('%(message)s'))
-
-                    logger = self.glancesync.log
-                    # Remove old handlers
-                    for h in logger.handlers:
-                        logger.removeHandler(h)
-
-                    logger.addHandler(handler)
-                    logger.setLevel(logging.INFO)
-                    logger.propagate = 0
-
-                    self.glancesync.sync_region(region)
-                    # After a fork, os_exit() and not sys.exit() must be used.
-                    os._exit(0)
-            except Exception:
-                raise
-                sys.stderr.flush()
-                sys.exit(-1)
-        while len(children) > 0:
-            self._wait_child(children)
+        # The master images are obtained before creating the workers, so they
+        # inherit them instead of listing the master region each one.
+        self.glancesync.master_region_dict
+        tasks = list(
+            (region, os.path.join('sync_' + datestr, region + '.txt'))
+            for region in self.regions)
+        results = list()
+        pool = Pool(max_children, _init_worker,
+                    (self.glancesync, min(max_children, len(tasks))))
+        try:
+            for result in pool.imap_unordered(_sync_region_worker, tasks):
+                self._print_result(result)
+                results.append(result)
+        except BaseException:
+            pool.terminate()
+            raise
+        else:
+            pool.close()
+        finally:
+            pool.join()
         print('All is done.')
+        return results
 
     def sequential_sync(self, dry_run=False):
         """Run the synchronisation sequentially (that is, do not start the
@@ -150,28 +169,239 @@ class Sync(object):
                 # try next region
                 continue
 
-    def _wait_child(self, children):
-        """ Wait until one of the regions ends its synchronisation and then
-        print the result
+    def fanout_sync(self, dry_run=False):
+        """Run the synchronisation of all the regions at the same time, but
+        reading each master image only once: its content is sent to all the
+        regions that need it simultaneously.
+
+        :param dry_run: if true, do not synchronise images actually
+        """
+        msg = '======Master is ' + self.glancesync.master_region
+        print(msg)
+        sys.stdout.flush()
+        failed = self.glancesync.sync_regions_fanout(self.regions,
+                                                     dry_run=dry_run)
+        self._print_finished(failed)
+
+    def scheduled_sync(self, dry_run=False):
+        """Run the synchronisation of all the regions at the same time,
+        scheduling all the uploads together (see
+        GlanceSync.sync_regions_scheduled).
 
-        :param children:
-        :return: a dictionary or regions, indexed by the pid of the process
+        :param dry_run: if true, do not synchronise images actually
         """
-        finish_direct_child = False
-        while not finish_direct_child:
-            (pid, status) = os.wait()
-            if pid not in children:
-                continue
+        msg = '======Master is ' + self.glancesync.master_region
+        print(msg)
+        sys.stdout.flush()
+        failed = self.glancesync.sync_regions_scheduled(self.regions,
+                                                        dry_run=dry_run)
+        self._print_finished(failed)
+
+    def make_plans(self, path):
+        """Calculate the plan of each region, without synchronising it, and
+        save the plans in a JSON file. The regions are planned concurrently
+        (see _run_regions). A summary of each plan is printed.
+
+        :param path: the file where the plans are saved
+        :return: the list of regions that could not be planned
+        """
+        plans = dict()
+        failed = list()
+        # The master images are obtained before starting the threads
+        self.glancesync.master_region_dict
+        for (region, plan, error) in self._run_regions(
+                self.glancesync.plan_region, self.regions):
+            if error is None:
+                plans[region] = plan
             else:
-                finish_direct_child = True
-                if status == 0:
-                    msg = 'Region {0} has finished'.format(children[pid])
-                    print(msg)
-                else:
-                    msg = 'Region {0} has finished with errors'
-                    print(msg.format(children[pid]))
-                del children[pid]
+                failed.append(region)
+        with open(path, 'w') as f:
+            json.dump(list(plans[region].to_dict() for region in self.regions
+                           if region in plans), f, indent=2, sort_keys=True)
+        for region in self.regions:
+            if region in failed:
+                print('Region {0} could not be planned'.format(region))
+                continue
+            plan = plans[region]
+            msg = 'Region {0}: {1} uploads ({2} MB), {3} reused images, ' \
+                '{4} metadata updates, {5} obsolete updates, {6} errors'
+            print(msg.format(
+                region, len(list(t for t in plan.tuples
+                                 if t[0] in glancesync_plan.upload_statuses)),
+                plan.pending_bytes() / 1024 / 1024,
+                plan.count('pending_reuse'),
+                plan.count('pending_metadata'), len(plan.obsolete),
+                len(list(t for t in plan.tuples if t[0].startswith('error')))))
+        return failed
+
+    def execute_plans(self, path, dry_run=False):
+        """Synchronise the regions executing the plans saved by make_plans,
+        one region after the other. The regions are not listed again.
+
+        :param path: the file with the plans
+        :param dry_run: if true, do not synchronise images actually
+        """
+        with open(path) as f:
+            plans = list(SyncPlan.from_dict(values) for values in json.load(f))
+        msg = '======Master is ' + self.glancesync.master_region
+        print(msg)
+        for plan in plans:
+            try:
+                print('======' + plan.region)
                 sys.stdout.flush()
+                self.glancesync.execute_plan(plan, dry_run=dry_run)
+            except Exception:
+                # Don't do anything. Message has been already printed
+                # try next region
+                continue
+
+    def watch(self, iterations=None):
+        """Synchronise the regions continuously, until stop is invoked.
+
+        Every watch_interval seconds the master region is listed again; when
+        its fingerprint changes, the regions that are not synchronised with
+        the new master images are synchronised together (see
+        GlanceSync.sync_regions_scheduled). The regions that fail are retried
+        in the following polls. The GlanceSync object, with its authenticated
+        sessions, is reused all the time.
+
+        When there is no state_file, the state of the regions is kept in
+        memory, so with verify_every > 1 only the changed images are checked
+        in the regions (see GlanceSync._images_to_reconcile).
+
+        If watch_status_file is set, it is rewritten after each poll with a
+        JSON document with the health of the process and the lag of each
+        region (seconds since the master changed and the region has not been
+        synchronised yet).
+
+        :param iterations: maximum number of polls (no limit by default)
+        :return: the last status (a dictionary)
+        """
+        glancesync = self.glancesync
+        if glancesync.sync_state is None:
+            glancesync.sync_state = SyncStateStore(':memory:')
+        msg = '======Master is ' + glancesync.master_region
+        print(msg)
+        sys.stdout.flush()
+
+        regions = dict(
+            (region, {'status': 'pending', 'fingerprint': None,
+                      'last_sync': None, 'behind_since': time.time()})
+            for region in self.regions)
+        status = {'regions': regions, 'master_changed': None,
+                  'master_fingerprint': None, 'master_error': None}
+        self._stop_event.clear()
+        count = 0
+        while not self._stop_event.is_set() and \
+                (iterations is None or count < iterations):
+            count += 1
+            start = time.time()
+            status['last_poll'] = start
+            try:
+                if glancesync.refresh_master() or \
+                        status['master_changed'] is None:
+                    status['master_changed'] = start
+                    status['master_fingerprint'] = \
+                        glancesync.master_fingerprint
+                status['master_error'] = None
+            except Exception, e:
+                status['master_error'] = str(e) or repr(e)
+                glancesync.log.error('Error listing the master region: ' +
+                                     status['master_error'])
+            else:
+                pending = list(
+                    region for region in self.regions
+                    if regions[region]['fingerprint'] !=
+                    glancesync.master_fingerprint)
+                for region in pending:
+                    if regions[region]['behind_since'] is None:
+                        regions[region]['behind_since'] = start
+                if pending:
+                    print('======Synchronising ' + ' '.join(pending))
+                    sys.stdout.flush()
+                    failed = glancesync.sync_regions_scheduled(pending)
+                    self._update_watch_status(status, pending, failed)
+            self._write_watch_status(status)
+            self._stop_event.wait(
+                max(0, start + glancesync.watch_interval - time.time()))
+        return status
+
+    def stop(self):
+        """Stop the watch loop after the current poll"""
+        self._stop_event.set()
+
+    def _update_watch_status(self, status, regions, failed):
+        """update the status of the regions synchronised by watch
+
+        :param status: the status dictionary of watch
+        :param regions: the regions that have been synchronised
+        :param failed: the regions that have failed
+        """
+        now = time.time()
+        for region in regions:
+            region_status = status['regions'][region]
+            if region in failed:
+                print('Region {0} has finished with errors'.format(region))
+                region_status['status'] = 'error'
+            else:
+                print('Region {0} has finished'.format(region))
+                region_status['status'] = 'ok'
+                region_status['fingerprint'] = \
+                    self.glancesync.master_fingerprint
+                region_status['last_sync'] = now
+                region_status['behind_since'] = None
+        sys.stdout.flush()
+
+    def _write_watch_status(self, status):
+        """write the status of watch to watch_status_file (if it is set).
+        The file is replaced atomically, so a reader never finds it
+        incomplete.
+
+        :param status: the status dictionary of watch
+        """
+        now = time.time()
+        status['healthy'] = status['master_error'] is None and not any(
+            region['status'] == 'error'
+            for region in status['regions'].values())
+        for region in status['regions'].values():
+            if region['behind_since'] is None:
+                region['lag'] = 0
+            else:
+                region['lag'] = now - region['behind_since']
+        path = self.glancesync.watch_status_file
+        if not path:
+            return
+        with open(path + '.tmp', 'w') as f:
+            json.dump(status, f, indent=2, sort_keys=True)
+        os.rename(path + '.tmp', path)
+
+    def _print_finished(self, failed):
+        """print the end of the synchronisation of each region
+
+        :param failed: a list with the regions finished with errors
+        """
+        for region in self.regions:
+            if region in failed:
+                print('Region {0} has finished with errors'.format(region))
+            else:
+                print('Region {0} has finished'.format(region))
+        print('All is done.')
+
+    def _print_result(self, result):
+        """print the result of a region synchronised by parallel_sync
+
+        :param result: the dictionary returned by the worker
+        """
+        if result['status'] == 'ok':
+            msg = 'Region {0} has finished ({1} MB in {2:.1f} s)'
+            print(msg.format(result['region'], result['bytes'] / 1024 / 1024,
+                             result['duration']))
+        else:
+            msg = 'Region {0} has finished with errors'
+            print(msg.format(result['region']))
+            for error in result['errors']:
+                print('  ' + error)
+        sys.stdout.flush()
 
     def show_regions(self):
         """print a full list of the regions available (excluding the
@@ -200,18 +430,171 @@ class Sync(object):
         directory = 'backup_glance_' + now
         os.mkdir(directory)
 
-        regions = set(self.regions)
-        regions.add(self.glancesync.master_region)
-        for region in regions:
-            try:
-                self.glancesync.backup_glancemetadata_region(region, directory)
-            except Exception:
-                # do nothing. Already logged.
-                continue
+        regions = list(self.regions)
+        if self.glancesync.master_region not in regions:
+            regions.insert(0, self.glancesync.master_region)
 
+        def backup(region):
+            return self.glancesync.backup_glancemetadata_region(
+                region, directory)
 
-if __name__ == '__main__':
-    # Parse cmdline
+        for (region, result, error) in self._run_regions(backup, regions):
+            # do nothing with the errors. Already logged.
+            continue
+
+    def _run_regions(self, function, regions):
+        """Run function(region) for each region, with up to max_readers
+        regions at the same time. Only for read-only operations.
+
+        The results are returned in the same order as the regions. If a
+        region has not finished region_timeout seconds after starting, an
+        error is logged and it is returned as failed; its thread is
+        abandoned (it does not count in max_readers anymore).
+
+        :param function: the function to invoke with each region
+        :param regions: a list of regions
+        :return: a generator of tuples (region, result, exception). The
+          exception is None if the function succeeded.
+        """
+        timeout = self.glancesync.region_timeout
+        slots = threading.Semaphore(max(1, self.glancesync.max_readers))
+        tasks = list(_RegionTask(region) for region in regions)
+
+        def start_tasks():
+            for task in tasks:
+                slots.acquire()
+                task.start(function, slots)
+
+        starter = threading.Thread(target=start_tasks)
+        starter.daemon = True
+        starter.start()
+        for task in tasks:
+            task.started.wait()
+            remaining = None
+            if timeout > 0:
+                remaining = max(0, task.start_time + timeout - time.time())
+            task.finished.wait(remaining)
+            if task.release():
+                msg = '{0}: timeout after {1} seconds'.format(
+                    task.region, timeout)
+                self.glancesync.log.error(msg)
+                yield (task.region, None, Exception(msg))
+            else:
+                yield (task.region, task.result, task.error)
+
+
+# The GlanceSync object of each worker of parallel_sync. The workers are
+# forked, so the object (and its authenticated sessions) is inherited from
+# the parent, not pickled.
+_worker_glancesync = None
+
+
+def _init_worker(glancesync, workers=1):
+    """Initializer of the workers of parallel_sync. The global and target
+    bandwidth limits are divided between the workers."""
+    global _worker_glancesync
+    _worker_glancesync = glancesync
+    glancesync.throttle.set_share(workers)
+    # Only the parent process handles Ctrl-C
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    logger = glancesync.log
+    # Remove old handlers
+    for h in list(logger.handlers):
+        logger.removeHandler(h)
+    logger.setLevel(logging.INFO)
+    logger.propagate = 0
+
+
+def _sync_region_worker(task):
+    """Synchronise a region inside a worker of parallel_sync.
+
+    :param task: a tuple (region, path of the log file)
+    :return: a dictionary with the result (see parallel_sync)
+    """
+    (region, path) = task
+    logger = _worker_glancesync.log
+    handler = logging.FileHandler(path)
+    handler.setFormatter(logging.Formatter('%(message)s'))
+    errors = _ErrorCollector()
+    logger.addHandler(handler)
+    logger.addHandler(errors)
+    result = {'region': region, 'status': 'ok', 'bytes': 0}
+    start = time.time()
+    try:
+        result['bytes'] = _worker_glancesync.sync_region(region) or 0
+    except Exception, e:
+        result['status'] = 'error'
+        cause = str(e) or repr(e)
+        if cause not in errors.messages:
+            errors.messages.append(cause)
+    finally:
+        logger.removeHandler(handler)
+        logger.removeHandler(errors)
+        handler.close()
+    result['duration'] = time.time() - start
+    result['errors'] = errors.messages
+    return result
+
+
+class _RegionTask(object):
+    """A region processed by Sync._run_regions in its own thread"""
+
+    def __init__(self, region):
+        self.region = region
+        self.result = None
+        self.error = None
+        self.start_time = None
+        self.started = threading.Event()
+        self.finished = threading.Event()
+        self._slots = None
+        self._lock = threading.Lock()
+
+    def start(self, function, slots):
+        """Start the thread. The slot of slots is released when the function
+        finishes or when the task is released, whatever happens first."""
+        self._slots = slots
+        self.start_time = time.time()
+        thread = threading.Thread(target=self._run, args=(function,))
+        thread.daemon = True
+        thread.start()
+        self.started.set()
+
+    def _run(self, function):
+        try:
+            self.result = function(self.region)
+        except Exception, e:
+            self.error = e
+        self.finished.set()
+        self.release()
+
+    def release(self):
+        """Release the slot if it has not been released yet.
+
+        :return: True if the task has not finished
+        """
+        with self._lock:
+            if self._slots is not None:
+                self._slots.release()
+                self._slots = None
+            return not self.finished.is_set()
+
+
+class _ErrorCollector(logging.Handler):
+    """logging handler that keeps the error messages of a region"""
+
+    def __init__(self):
+        logging.Handler.__init__(self, logging.ERROR)
+        self.messages = list()
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+
+def create_parser():
+    """create the parser of the command line arguments of the tool.
+
+    :return: an argparse.ArgumentParser
+    """
     description = 'A tool to sync images from a master region to other '\
                   'regions'
     parser = argparse.ArgumentParser(description=description)
@@ -222,12 +605,24 @@ if __name__ == '__main__':
     parser.add_argument('--parallel', action='store_true',
                         help='sync several regions in parallel')
 
+    parser.add_argument('--fanout', action='store_true',
+                        help='sync all the regions at the same time, reading '
+                        'each image only once')
+
     parser.add_argument(
         '--config', nargs='+', help='override configuration options. (e.g. ' +
         "main.master_region=Valladolid metadata_condition='image.name=name1')")
 
+    parser.add_argument('--scheduled', action='store_true',
+                        help='sync all the regions at the same time, '
+                        'scheduling the uploads of all the regions together')
+
     group = parser.add_mutually_exclusive_group()
 
+    group.add_argument('--watch', action='store_true',
+                       help='do not exit: sync the regions again each time '
+                       'the master region changes')
+
     group.add_argument('--dry-run', action='store_true',
                        help='do not upload actually the images')
 
@@ -241,6 +636,20 @@ if __name__ == '__main__':
         '--make-backup', action='store_true',
         help="do no sync, make a backup of the regions' metadata")
 
+    group.add_argument(
+        '--make-plan', metavar='PATH',
+        help='do not sync, save the operations pending in each region')
+
+    group.add_argument(
+        '--execute-plan', metavar='PATH',
+        help='sync executing the plans saved with --make-plan')
+
+    return parser
+
+
+if __name__ == '__main__':
+    # Parse cmdline
+    parser = create_parser()
     meta = parser.parse_args()
     options = dict()
 
@@ -254,14 +663,28 @@ if __name__ == '__main__':
 
     # Run cmd
     sync = Sync(meta.regions, options)
+    if sync.glancesync.throttle.path:
+        signal.signal(signal.SIGHUP, lambda signum, frame:
+                      sync.glancesync.throttle.request_reload())
 
     if meta.show_status:
         sync.report_status()
+    elif meta.watch:
+        signal.signal(signal.SIGTERM, lambda signum, frame: sync.stop())
+        sync.watch()
+    elif meta.fanout:
+        sync.fanout_sync(meta.dry_run)
+    elif meta.scheduled:
+        sync.scheduled_sync(meta.dry_run)
     elif meta.parallel:
         sync.parallel_sync()
     elif meta.show_regions:
         sync.show_regions()
     elif meta.make_backup:
         sync.make_backup()
+    elif meta.make_plan:
+        sync.make_plans(meta.make_plan)
+    elif meta.execute_plan:
+        sync.execute_plans(meta.execute_plan)
     else:
         sync.sequential_sync(meta.dry_run)
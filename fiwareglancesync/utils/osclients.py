@@ -423,7 +423,7 @@ class OpenStackClients(object):
             session=self.get_session(), region_name=self.region,
             service_type='volume')
 
-    def get_glanceclient(self):
+    def get_glanceclient(self, timeout=None, version='1'):
         """Get a glance client. A client is different for each region
         (although all clients share the same session and it is possible to have
          simultaneously clients to several regions).
@@ -435,6 +435,8 @@ class OpenStackClients(object):
          Be aware that calling the method set_credential invalidate the old
          session if already existed and therefore can affect the old clients.
 
+        :param timeout: optional timeout (seconds) of the socket operations.
+        :param version: the version of the glance API ('1' or '2').
         :return: a glance client valid for a region.
         """
         self._require_module('glance')
@@ -442,8 +444,11 @@ class OpenStackClients(object):
         token = session.get_token()
         endpoint = session.get_endpoint(service_type='image',
                                         region_name=self.region)
+        kwargs = dict()
+        if timeout is not None:
+            kwargs['timeout'] = timeout
         return self._modules_imported['glance'].Client(
-            version='1', endpoint=endpoint, token=token)
+            version=version, endpoint=endpoint, token=token, **kwargs)
 
     def get_swiftclient(self):
         self._require_module('swift')
@@ -68,6 +68,7 @@ class Image:
     ERROR_AMI = 'error_ami'
     PENDING_METADATA = 'pending_metadata'
     PENDING_UPLOAD = 'pending_upload'
+    PENDING_REUSE = 'pending_reuse'
     PENDING_REPLACE = 'pending_replace'
     PENDING_RENAME = 'pending_rename'
     PENDING_AMI = 'pending_ami'
@@ -75,7 +76,8 @@ class Image:
     # GlanceSync synchronization status
     glancestatus = {'ok', 'ok_stalled_checksum',
                     'error_checksum', 'error_ami',
-                    'pending_metadata', 'pending_upload', 'pending_replace', 'pending_rename', 'pending_ami'}
+                    'pending_metadata', 'pending_upload', 'pending_reuse', 'pending_replace', 'pending_rename',
+                    'pending_ami'}
 
     def __init__(self, identifier, name, status, message):
         """
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+# -- encoding: utf-8 --
+#
+# Copyright 2015-2016 Telefónica Investigación y Desarrollo, S.A.U
+#
+# This file is part of FI-WARE project.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+#
+# You may obtain a copy of the License at:
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# For those usages not covered by the Apache version 2.0 License please
+# contact with opensource@tid.es
+#
+"""Benchmark of the evaluation of metadata_condition.
+
+It filters a master catalogue with the condition of several targets, several
+runs, as images_to_sync_dict did before caching its result, comparing the
+eval of the code object with the compiled MetadataCondition (see
+glancesync_condition). The best of --repeat executions is shown.
+
+Usage: python -m tests.benchmark.bench_condition [--images N] [--targets N]
+"""
+
+import argparse
+import time
+
+from fiwareglancesync.glancesync_condition import compile_condition
+from fiwareglancesync.glancesync_image import GlanceSyncImage
+
+condition = "image.is_public and 'type' in image.user_properties and " \
+    "image.user_properties['type'] in ('baseimage', 'ngimages') and " \
+    "image.user_properties.get('nid', 0) > 10"
+
+
+def make_images(count):
+    """return a list of master images with several properties"""
+    images = list()
+    for i in range(count):
+        properties = {'type': ('baseimage', 'ngimages', 'other')[i % 3],
+                      'nid': i % 50, 'sdc_aware': 'true'}
+        images.append(GlanceSyncImage(
+            'image' + str(i), str(i), 'Valladolid', 'tenant1id', i % 4 != 0,
+            str(i).zfill(32), 1024 * i, 'active', properties))
+    return images
+
+
+def measure(images, targets, runs, compiled):
+    """filter the images once per target and run; return the seconds"""
+    metadata_set = set(['type', 'nid'])
+    if compiled:
+        conditions = list(compile_condition(condition)
+                          for i in range(targets))
+    else:
+        conditions = list(compile(condition, 'metadata_condition', 'eval')
+                          for i in range(targets))
+    start = time.time()
+    for run in range(runs):
+        for target_condition in conditions:
+            len(list(image for image in images if image.is_synchronisable(
+                metadata_set, set(), target_condition)))
+    return time.time() - start
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='condition benchmark')
+    parser.add_argument('--images', type=int, default=5000)
+    parser.add_argument('--targets', type=int, default=5)
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--repeat', type=int, default=3)
+    meta = parser.parse_args()
+
+    images = make_images(meta.images)
+    print('{0:<12}{1:>12}'.format('engine', 'time (s)'))
+    for (name, compiled) in (('eval', False), ('compiled', True)):
+        best = min(measure(images, meta.targets, meta.runs, compiled)
+                   for i in range(meta.repeat))
+        print('{0:<12}{1:>12.3f}'.format(name, best))
@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+# -- encoding: utf-8 --
+#
+# Copyright 2015-2016 Telefónica Investigación y Desarrollo, S.A.U
+#
+# This file is part of FI-WARE project.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+#
+# You may obtain a copy of the License at:
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# For those usages not covered by the Apache version 2.0 License please
+# contact with opensource@tid.es
+#
+"""Benchmark of the memory used by the images of many regions.
+
+Each region is listed as the facade does it: the JSON returned by glance is
+decoded (so every image has its own strings and raw dictionary) and a
+GlanceSyncImage is built for each image. The compact GlanceSyncImage is
+compared with the previous representation (an object with __dict__ that keeps
+the whole glance dictionary in raw). Every variant runs in its own process
+and the increase of its maximum resident set size is shown.
+
+Usage: python -m tests.benchmark.bench_image_memory [--regions N] [--images N]
+"""
+
+import argparse
+import copy
+import json
+import resource
+import subprocess
+import sys
+
+from fiwareglancesync.glancesync_image import GlanceSyncImage
+
+
+class LegacyImage(object):
+    """The fields of GlanceSyncImage before it was made compact"""
+
+    def __init__(self, name, id, region, owner=None, is_public=True,
+                 checksum=None, size=0, status=None, user_properties=None,
+                 raw=None):
+        self.name = name
+        self.id = id
+        self.region = region
+        self.is_public = is_public
+        self.checksum = checksum
+        self.raw = raw
+        self.size = int(size)
+        self.status = status
+        self.owner = owner
+        if user_properties is not None:
+            self.user_properties = copy.copy(user_properties)
+        else:
+            self.user_properties = dict()
+
+
+def glance_page(region, count):
+    """return the JSON of a list of images, as returned by glance"""
+    images = list()
+    for i in range(count):
+        properties = {'type': ('baseimage', 'ngimages', 'other')[i % 3],
+                      'nid': str(i % 50), 'sdc_aware': 'true',
+                      'nid_version': '1'}
+        images.append({
+            'id': '{0:08d}-aaaa-bbbb-cccc-{1:012d}'.format(region, i),
+            'name': 'image' + str(i), 'owner': '0' * 32, 'is_public': True,
+            'checksum': '{0:032x}'.format(i), 'size': 1024 * i,
+            'status': 'active', 'properties': properties,
+            'disk_format': 'qcow2', 'container_format': 'bare',
+            'protected': False, 'min_ram': 0, 'min_disk': 0,
+            'deleted': False, 'deleted_at': None,
+            'created_at': '2016-01-01T00:00:00.000000',
+            'updated_at': '2016-01-02T00:00:00.000000',
+            'virtual_size': None, 'location': None})
+    return json.dumps({'images': images})
+
+
+def load(cls, regions, count):
+    """build the images of all the regions; return them"""
+    result = list()
+    for region in range(regions):
+        page = glance_page(region, count)
+        for image in json.loads(page)['images']:
+            result.append(cls(
+                image['name'], image['id'], 'Region' + str(region),
+                image['owner'], image['is_public'], image['checksum'],
+                image['size'], image['status'], image['properties'], image))
+    return result
+
+
+def measure(variant, regions, count):
+    """run the variant in this process; return the increase of the maximum
+    resident set size, in MB"""
+    cls = GlanceSyncImage if variant == 'compact' else LegacyImage
+    # the JSON of a region is not part of the measure
+    json.loads(glance_page(0, count))
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    images = load(cls, regions, count)
+    after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    assert len(images) == regions * count
+    return (after - before) / 1024.0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='image memory benchmark')
+    parser.add_argument('--regions', type=int, default=100)
+    parser.add_argument('--images', type=int, default=5000)
+    parser.add_argument('--variant', choices=('legacy', 'compact'))
+    meta = parser.parse_args()
+
+    if meta.variant:
+        print(measure(meta.variant, meta.regions, meta.images))
+        sys.exit(0)
+
+    print('{0:<12}{1:>12}'.format('variant', 'memory (MB)'))
+    for variant in ('legacy', 'compact'):
+        output = subprocess.check_output([
+            sys.executable, '-m', 'tests.benchmark.bench_image_memory',
+            '--regions', str(meta.regions), '--images', str(meta.images),
+            '--variant', variant])
+        print('{0:<12}{1:>12.1f}'.format(variant, float(output)))
@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+# -- encoding: utf-8 --
+#
+# Copyright 2015-2016 Telefónica Investigación y Desarrollo, S.A.U
+#
+# This file is part of FI-WARE project.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+#
+# You may obtain a copy of the License at:
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# For those usages not covered by the Apache version 2.0 License please
+# contact with opensource@tid.es
+#
+"""Benchmark of the reading of the master images during the uploads.
+
+An image file is sent to a local HTTP sink (a server that discards the body)
+the way the glance client sends it: reads of 64 KB written to the socket, with
+a Content-Length obtained with seek and tell. It compares the previous reader
+(the file opened in text mode, with the MD5 computed by a wrapper) with
+ImageFile, with and without dropping the pages from the page cache. It shows
+the throughput of each variant, in MB/s, and the percentage of the file that
+remains in the page cache after sending it (measured with mincore). Run it
+with --size greater than the free memory to include the disk; otherwise the
+file is read from the cache, except with ImageFile, that drops it.
+
+Usage: python -m tests.benchmark.bench_image_source [--size MB] [--repeat N]
+"""
+
+import argparse
+import BaseHTTPServer
+import ctypes
+import ctypes.util
+import httplib
+import mmap
+import os
+import tempfile
+import threading
+import time
+
+from fiwareglancesync.glancesync_serversfacade import _ChecksumReader
+from fiwareglancesync.glancesync_source import ImageFile
+
+_chunk_size = 64 * 1024
+
+
+class SinkHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Read the body of the request and discard it"""
+
+    def do_PUT(self):
+        pending = int(self.headers['Content-Length'])
+        while pending:
+            pending -= len(self.rfile.read(min(pending, 1024 * 1024)))
+        self.send_response(201)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+def start_sink():
+    """start the HTTP sink in a thread; return its port"""
+    server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), SinkHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server.server_address[1]
+
+
+def send(port, data):
+    """send data to the sink as the glance client does"""
+    data.seek(0, os.SEEK_END)
+    size = data.tell()
+    data.seek(0)
+    connection = httplib.HTTPConnection('127.0.0.1', port)
+    connection.putrequest('PUT', '/v1/images')
+    connection.putheader('Content-Length', str(size))
+    connection.endheaders()
+    while True:
+        chunk = data.read(_chunk_size)
+        if not chunk:
+            break
+        connection.send(chunk)
+    response = connection.getresponse()
+    response.read()
+    connection.close()
+    return size
+
+
+def text_file(path):
+    """the previous reader"""
+    return _ChecksumReader(open(path, 'r'))
+
+
+def image_file(path):
+    """the new reader"""
+    return ImageFile(path)
+
+
+def image_file_cached(path):
+    """the new reader, keeping the pages in the cache"""
+    return ImageFile(path, drop_cache=False)
+
+
+def cached(path):
+    """return the percentage of the pages of the file in the page cache"""
+    libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    libc.mmap.restype = ctypes.c_void_p
+    libc.mmap.argtypes = [ctypes.c_void_p, ctypes.c_size_t, ctypes.c_int,
+                          ctypes.c_int, ctypes.c_int, ctypes.c_int64]
+    libc.mincore.argtypes = [ctypes.c_void_p, ctypes.c_size_t,
+                             ctypes.c_void_p]
+    libc.munmap.argtypes = [ctypes.c_void_p, ctypes.c_size_t]
+    size = os.path.getsize(path)
+    pages = -(-size // mmap.PAGESIZE)
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        address = libc.mmap(None, size, mmap.PROT_READ, mmap.MAP_SHARED, fd,
+                            0)
+        vector = (ctypes.c_ubyte * pages)()
+        libc.mincore(address, size, vector)
+        libc.munmap(address, size)
+    finally:
+        os.close(fd)
+    return 100.0 * sum(page & 1 for page in vector) / pages
+
+
+def make_file(size):
+    """create a file of size MB; return its path"""
+    (fd, path) = tempfile.mkstemp(prefix='bench_image_source')
+    block = os.urandom(1024 * 1024)
+    with os.fdopen(fd, 'wb') as file_obj:
+        for i in range(size):
+            file_obj.write(block)
+        # the dirty pages cannot be dropped from the cache
+        file_obj.flush()
+        os.fsync(fd)
+    return path
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='image source benchmark')
+    parser.add_argument('--size', type=int, default=1024,
+                        help='size of the image (MB)')
+    parser.add_argument('--repeat', type=int, default=3)
+    meta = parser.parse_args()
+
+    port = start_sink()
+    path = make_file(meta.size)
+    try:
+        print('{0:<20}{1:>12}{2:>12}'.format('variant', 'MB/s', 'cached %'))
+        for (name, reader) in (('text file + md5', text_file),
+                               ('ImageFile', image_file),
+                               ('ImageFile (cached)', image_file_cached)):
+            best = 0
+            for i in range(meta.repeat):
+                data = reader(path)
+                start = time.time()
+                size = send(port, data)
+                elapsed = time.time() - start
+                data.md5.hexdigest()
+                data.close()
+                best = max(best, size / elapsed / 1048576)
+            print('{0:<20}{1:>12.1f}{2:>12.1f}'.format(
+                name, best, cached(path)))
+    finally:
+        os.unlink(path)
@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+# -- encoding: utf-8 --
+#
+# Copyright 2015-2016 Telefónica Investigación y Desarrollo, S.A.U
+#
+# This file is part of FI-WARE project.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+#
+# You may obtain a copy of the License at:
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# For those usages not covered by the Apache version 2.0 License please
+# contact with opensource@tid.es
+#
+"""Benchmark of the startup latency of the sync tool in each mode.
+
+It uses the mock facade with a simulated latency for each call to the glance
+servers (the listing of a region is the dominant cost of the startup) and
+compares the lazy construction of GlanceSync with an eager one, where the
+facades and the master images are obtained in the constructor.
+
+Usage: python -m tests.benchmark.bench_startup [--images N] [--latency S]
+"""
+
+import argparse
+import logging
+import os
+import shutil
+import sys
+import time
+import StringIO
+import tempfile
+
+from fiwareglancesync.glancesync_image import GlanceSyncImage
+from fiwareglancesync.glancesync_serverfacade_mock import ServersFacade
+from fiwareglancesync.sync import Sync
+
+config = """
+[main]
+master_region = Valladolid
+preferable_order = Burgos
+[master]
+credential = user,ZmFrZXBhc3N3b3JkLG9mY291cnNl,\\
+  http://server:4730/v2.0,tenant1
+metadata_set = nid, type
+"""
+
+
+def populate(images, regions):
+    """add the images to the mock: all of them in the master region and
+    the half in the other regions"""
+    ServersFacade.clear_mock()
+    for i in range(images):
+        image = GlanceSyncImage(
+            'image' + str(i), str(i), 'Valladolid', 'tenant1id', True,
+            str(i).zfill(32), 1024 * i, 'active', {'type': 'base'})
+        ServersFacade.add_image_to_mock(image)
+    for region in regions:
+        ServersFacade.add_emptyregion_to_mock(region)
+        for i in range(0, images, 2):
+            image = GlanceSyncImage(
+                'image' + str(i), region + str(i), region, 'tenant1id', True,
+                str(i).zfill(32), 1024 * i, 'active', {'type': 'base'})
+            ServersFacade.add_image_to_mock(image)
+
+
+def add_latency(latency):
+    """simulate the latency of the calls to glance"""
+    iter_imagelist = ServersFacade.iter_imagelist
+
+    def slow_iter_imagelist(self, *args, **kwargs):
+        time.sleep(latency)
+        return iter_imagelist(self, *args, **kwargs)
+
+    def slow_get_tenant_id(self):
+        time.sleep(latency)
+        return 'tenant1id'
+    ServersFacade.iter_imagelist = slow_iter_imagelist
+    ServersFacade.get_tenant_id = slow_get_tenant_id
+
+
+def make_sync(regions, eager):
+    """create the Sync object; if eager, obtain everything in advance"""
+    os.environ['GLANCESYNC_CONFIG'] = config_path
+    sync = Sync(regions)
+    logging.getLogger('GlanceSync-Client').setLevel(logging.WARNING)
+    if eager:
+        for target in sync.glancesync.targets.values():
+            target['facade'].get_tenant_id()
+        sync.glancesync.master_region_dict
+    return sync
+
+
+def show_regions(regions, eager):
+    make_sync(list(), eager).show_regions()
+
+
+def show_status(regions, eager):
+    make_sync(regions[:1], eager).report_status()
+
+
+def dry_run(regions, eager):
+    make_sync(regions[:1], eager).sequential_sync(dry_run=True)
+
+
+def make_backup(regions, eager):
+    sync = make_sync(regions[:1], eager)
+    directory = tempfile.mkdtemp()
+    cwd = os.getcwd()
+    os.chdir(directory)
+    try:
+        sync.make_backup()
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(directory)
+
+
+modes = [('--show-regions', show_regions), ('--show-status', show_status),
+         ('--dry-run', dry_run), ('--make-backup', make_backup)]
+
+
+def measure(function, regions, eager, repeat):
+    """return the best time of several executions, without output"""
+    best = None
+    for i in range(repeat):
+        stdout = sys.stdout
+        sys.stdout = StringIO.StringIO()
+        try:
+            start = time.time()
+            function(regions, eager)
+            elapsed = time.time() - start
+        finally:
+            sys.stdout = stdout
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='startup benchmark')
+    parser.add_argument('--images', type=int, default=2000)
+    parser.add_argument('--latency', type=float, default=0.2,
+                        help='simulated latency of each call to glance (s)')
+    parser.add_argument('--repeat', type=int, default=3)
+    meta = parser.parse_args()
+
+    os.environ['GLANCESYNC_USE_MOCK'] = 'True'
+    (fd, config_path) = tempfile.mkstemp(suffix='.conf')
+    with os.fdopen(fd, 'w') as f:
+        f.write(config)
+    regions = ['Burgos', 'Madrid']
+    populate(meta.images, regions)
+    add_latency(meta.latency)
+    print('{0:<16}{1:>12}{2:>12}'.format('mode', 'eager (s)', 'lazy (s)'))
+    for (name, function) in modes:
+        eager = measure(function, regions, True, meta.repeat)
+        lazy = measure(function, regions, False, meta.repeat)
+        print('{0:<16}{1:>12.3f}{2:>12.3f}'.format(name, eager, lazy))
+    os.unlink(config_path)
@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+# -- encoding: utf-8 --
+#
+# Copyright 2015-2016 Telefónica Investigación y Desarrollo, S.A.U
+#
+# This file is part of FI-WARE project.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+#
+# You may obtain a copy of the License at:
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# For those usages not covered by the Apache version 2.0 License please
+# contact with opensource@tid.es
+#
+"""Benchmark of the preparation of the images to upload.
+
+A batch of master images is uploaded to a region of the mock facade, as
+GlanceSync.__upload_image does it, comparing the previous preparation (a
+deepcopy of the image, including the whole glance dictionary, and the removal
+of the properties not in metadata_set) with the upload descriptor built from
+the metadata projection of the target. It shows the time of the batch and the
+number of objects allocated per upload (containers tracked by the garbage
+collector that are still alive after the batch).
+
+Usage: python -m tests.benchmark.bench_upload [--images N] [--repeat N]
+"""
+
+import argparse
+import copy
+import gc
+import json
+import time
+
+from fiwareglancesync.glancesync_image import GlanceSyncImage
+from fiwareglancesync.glancesync_region import GlanceSyncRegion
+from fiwareglancesync.glancesync_serverfacade_mock import ServersFacade
+from tests.benchmark.bench_image_memory import LegacyImage, glance_page
+
+
+def make_images(cls, count):
+    """return the master images, decoded from the JSON of glance"""
+    return list(cls(image['name'], image['id'], 'Valladolid', image['owner'],
+                    image['is_public'], image['checksum'], image['size'],
+                    image['status'], image['properties'], image)
+                for image in json.loads(glance_page(0, count))['images'])
+
+
+def deepcopy_image(image, regionobj):
+    """the preparation of the image before the upload descriptor"""
+    new_image = copy.deepcopy(image)
+    metadata_set = set(regionobj.target['metadata_set'])
+    properties = set(new_image.user_properties.keys())
+    if len(metadata_set) > 0:
+        diff = properties - metadata_set - set(['kernel_id', 'ramdisk_id'])
+        for p in diff:
+            del new_image.user_properties[p]
+    return new_image
+
+
+def descriptor_image(image, regionobj):
+    """the preparation of the image with the upload descriptor"""
+    return image.upload_descriptor(regionobj.metadata_projection())
+
+
+def measure(images, prepare):
+    """upload the images; return the seconds and the objects per upload"""
+    targets = {'master': {'tenant': 'tenant1', 'metadata_set': set(
+        ['type', 'nid', 'nid_version'])}}
+    regionobj = GlanceSyncRegion('Burgos', targets)
+    facade = ServersFacade(targets['master'])
+    ServersFacade.clear_mock()
+    ServersFacade.add_emptyregion_to_mock('Burgos')
+    uploaded = list()
+    gc.collect()
+    gc.disable()
+    before = len(gc.get_objects())
+    start = time.time()
+    for image in images:
+        new_image = prepare(image, regionobj)
+        facade.upload_image(regionobj, new_image)
+        uploaded.append(new_image)
+    elapsed = time.time() - start
+    objects = len(gc.get_objects()) - before
+    gc.enable()
+    ServersFacade.clear_mock()
+    return (elapsed, float(objects) / len(images))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='upload benchmark')
+    parser.add_argument('--images', type=int, default=20000)
+    parser.add_argument('--repeat', type=int, default=3)
+    meta = parser.parse_args()
+
+    print('{0:<12}{1:>12}{2:>16}'.format('variant', 'time (s)',
+                                         'objects/upload'))
+    for (name, cls, prepare) in (
+            ('deepcopy', LegacyImage, deepcopy_image),
+            ('descriptor', GlanceSyncImage, descriptor_image)):
+        images = make_images(cls, meta.images)
+        results = list(measure(images, prepare) for i in range(meta.repeat))
+        print('{0:<12}{1:>12.3f}{2:>16.1f}'.format(
+            name, min(result[0] for result in results), results[0][1]))
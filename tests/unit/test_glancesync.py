@@ -30,9 +30,14 @@ import os
 import glob
 import tempfile
 import logging
+import time
+
+from mock import patch, MagicMock
 
 from fiwareglancesync.glancesync_image import GlanceSyncImage
 from fiwareglancesync.glancesync import GlanceSync
+from fiwareglancesync.glancesync_plan import SyncPlan
+from fiwareglancesync.glancesync_state import SyncStateStore
 from fiwareglancesync.glancesync_serverfacade_mock import ServersFacade
 from tests.unit.resources.config import RESOURCESPATH
 from tests.unit.test_getnid import get_path
@@ -78,14 +83,14 @@ def create_images(region, count, prefix, tenant):
 
 def dup_images(images, region, prefix, tenant):
     """Helper function to create a list of images from another one of a
-    different region. The images are also added to mock"""
+    different region. The images are also added to mock. The owner is not
+    changed (tenant is unused)."""
     count = 1
     new_images = list()
     for image in images:
         new_image = copy.deepcopy(image)
         new_image.region = region
         new_image.id = prefix + str(count).zfill(2)
-        new_image.tenant = tenant
         new_images.append(new_image)
         ServersFacade.add_image_to_mock(new_image)
         count += 1
@@ -309,6 +314,49 @@ class TestGlanceSyncBasicOperation(unittest.TestCase):
         self.assertEquals(len(result), 20)
         self.assertEquals(result, expected)
 
+    def test_iter_images_region(self):
+        """test iter_images_region with filters"""
+        glancesync = GlanceSync(self.config)
+        result = glancesync.iter_images_region(
+            'other:Madrid', filters={'name': 'image05'})
+        self.assertEquals(list(image.id for image in result), ['205'])
+
+    def test_master_snapshot(self):
+        """test that the master images are reused by other objects until
+        the master region is refreshed"""
+        options = {'main.master_snapshot_ttl': '600'}
+        glancesync = GlanceSync(self.config, options)
+        self.assertNotIn('image21', glancesync.master_region_dict)
+        new_image = GlanceSyncImage('image21', '21', 'Valladolid', None,
+                                    True, 'abc', 1024, 'active')
+        ServersFacade.add_image_to_mock(new_image)
+        self.config.seek(0)
+        other = GlanceSync(self.config, options)
+        try:
+            self.assertNotIn('image21', other.master_region_dict)
+            self.assertEquals(other.master_fingerprint,
+                              glancesync.master_fingerprint)
+            self.assertTrue(other.refresh_master())
+            self.assertIn('image21', other.master_region_dict)
+            self.assertFalse(other.refresh_master())
+        finally:
+            other.master_snapshot.invalidate()
+
+    def test_lazy_construction(self):
+        """the facades and the master images are obtained on first use"""
+        glancesync = GlanceSync(self.config)
+        facade = glancesync.targets['master']['facade']
+        self.assertIsNone(facade._facade)
+        self.assertIsNone(glancesync._master_region_dict)
+        self.assertEquals(facade.images_dir, glancesync.images_dir)
+        glancesync.get_regions()
+        self.assertIsNotNone(facade._facade)
+        self.assertEquals(facade._facade.images_dir, glancesync.images_dir)
+        self.assertIsNone(glancesync._master_region_dict)
+        self.assertIsNone(glancesync.targets['other']['facade']._facade)
+        glancesync.master_region_dict
+        self.assertIsNotNone(glancesync._master_region_dict)
+
     def test_backup(self):
         """test method get_backup"""
         glancesync = GlanceSync(self.config)
@@ -322,7 +370,7 @@ class TestGlanceSyncBasicOperation(unittest.TestCase):
             ['backup_Valladolid.csv', 'backup_Burgos.csv',
              'backup_other:Madrid.csv', 'backup_other:Region2.csv'])
         found_names = set()
-        for name in glob.glob(self.tmpdir + '/*.csv'):
+        for name in glob.glob(self.tmpdir + '/*'):
             found_names.add(os.path.basename(name))
         self.assertItemsEqual(expected_names, found_names)
 
@@ -384,11 +432,15 @@ class TestGlanceSync_Sync(unittest.TestCase):
             result = result.replace('\r\n', ';')
             self.assertEquals(expected, result)
 
-    def test_sync(self):
-        """test sync_region call and compare the expected results"""
+    def sync_regions(self):
+        """synchronise all the regions of the test"""
         for region in self.regions:
             self.glancesync.sync_region(region)
 
+    def test_sync(self):
+        """test sync_region call and compare the expected results"""
+        self.sync_regions()
+
         result = copy.deepcopy(ServersFacade.images)
         ServersFacade.clear_mock()
         ServersFacade.add_images_from_csv_to_mock(self.path_test + '.result')
@@ -410,8 +462,7 @@ class TestGlanceSync_Sync(unittest.TestCase):
     def test_check_status_post(self):
         """run sync_region and then export_sync_region_status. Finally, check
          these last results"""
-        for region in self.regions:
-            self.glancesync.sync_region(region)
+        self.sync_regions()
 
         path_status = self.path_test + '.status_post'
         for region in self.regions:
@@ -446,6 +497,334 @@ class TestGlanceSync_Mixed(TestGlanceSync_Sync):
         self.path_test = os.path.join(tmp, 'mixed')
         self.regions = ['Valladolid', 'master:Burgos', 'other:Madrid']
 
+    def test_sync_image_source_master(self):
+        """the images that are not in images_dir are downloaded from the
+        master region with the download_image of the facade"""
+        master = self.glancesync.master_region
+        for image in self.glancesync.master_region_dict.values():
+            ServersFacade.contents[(master, image.id)] = \
+                'content of ' + image.name
+        for target in self.glancesync.targets.values():
+            target['image_source'] = 'master'
+        images_dir = self.glancesync.images_dir
+        self.glancesync.images_dir = tempfile.mkdtemp()
+        for target in self.glancesync.targets.values():
+            target['facade'].images_dir = self.glancesync.images_dir
+        try:
+            self.sync_regions()
+        finally:
+            os.rmdir(self.glancesync.images_dir)
+            self.glancesync.images_dir = images_dir
+        uploaded = list()
+        for ((region, id), content) in ServersFacade.contents.items():
+            if region != master:
+                image = ServersFacade.images[region][id]
+                self.assertEquals(content, 'content of ' + image.name)
+                uploaded.append(region)
+        self.assertEquals(set(uploaded), set(['Burgos', 'other:Madrid']))
+
+
+class TestGlanceSync_Fanout(TestGlanceSync_Mixed):
+    """Test the synchronisation of several regions at the same time, reading
+    each image only once"""
+    def setUp(self):
+        super(TestGlanceSync_Fanout, self).setUp()
+        self.glancesync.images_dir = tempfile.mkdtemp()
+        for image in self.glancesync.master_region_dict.values():
+            with open(os.path.join(self.glancesync.images_dir, image.id),
+                      'w') as f:
+                f.write(image.id * 100)
+
+    def tearDown(self):
+        super(TestGlanceSync_Fanout, self).tearDown()
+        for name in glob.glob(self.glancesync.images_dir + '/*'):
+            os.unlink(name)
+        os.rmdir(self.glancesync.images_dir)
+
+    def sync_regions(self):
+        """synchronise all the regions at the same time"""
+        failed = self.glancesync.sync_regions_fanout(self.regions)
+        self.assertEquals(failed, list())
+
+    def test_sync_missing_file(self):
+        """if the image file does not exist, the regions fail"""
+        for name in glob.glob(self.glancesync.images_dir + '/*'):
+            os.unlink(name)
+        failed = self.glancesync.sync_regions_fanout(self.regions)
+        self.assertEquals(set(failed), set(['master:Burgos', 'other:Madrid']))
+
+    def test_sync_missing_file_master(self):
+        """if the image file does not exist, the regions of the targets
+        with image_source master upload it without the file"""
+        for name in glob.glob(self.glancesync.images_dir + '/*'):
+            os.unlink(name)
+        self.glancesync.targets['other']['image_source'] = 'master'
+        failed = self.glancesync.sync_regions_fanout(self.regions)
+        self.assertEquals(failed, ['master:Burgos'])
+
+    def test_sync_slow_region(self):
+        """a slow region does not delay the uploads of the other regions"""
+        upload = ServersFacade.upload_image
+        finished = list()
+
+        def slow_upload(facade, regionobj, image, data=None):
+            if regionobj.region == 'Madrid':
+                time.sleep(0.2)
+            result = upload(facade, regionobj, image, data)
+            finished.append(regionobj.region)
+            return result
+
+        self.glancesync.fanout_stall_timeout = 60
+        with patch.object(ServersFacade, 'upload_image', slow_upload):
+            failed = self.glancesync.sync_regions_fanout(self.regions)
+        self.assertEquals(failed, list())
+        self.assertTrue(finished.count('Madrid') > 1)
+        # the other regions have finished before the first image of Madrid
+        first = finished.index('Madrid')
+        self.assertTrue(first > 0)
+        self.assertEquals(set(finished[first:]), set(['Madrid']))
+
+    def test_sync_missing_file_cache(self):
+        """with the image cache, each image is saved in the cache once and
+        all the regions read it from there"""
+        for name in glob.glob(self.glancesync.images_dir + '/*'):
+            os.unlink(name)
+        for target in self.glancesync.targets.values():
+            target['image_source'] = 'master'
+        (fd, path) = tempfile.mkstemp()
+        os.write(fd, 'content')
+        os.close(fd)
+        self.glancesync.image_cache = MagicMock()
+        try:
+            with patch.object(self.glancesync, '_cache_master',
+                              return_value=path) as cache_master:
+                failed = self.glancesync.sync_regions_fanout(self.regions)
+        finally:
+            os.unlink(path)
+        self.assertEquals(failed, list())
+        names = list(args[0][0].name for args in cache_master.call_args_list)
+        self.assertTrue(names)
+        self.assertEquals(len(names), len(set(names)))
+
+
+class TestGlanceSync_Scheduled(TestGlanceSync_Mixed):
+    """Test the synchronisation of several regions at the same time, using a
+    global scheduler of the uploads"""
+    def setUp(self):
+        super(TestGlanceSync_Scheduled, self).setUp()
+        self.glancesync.max_transfers = 4
+        self.glancesync.transfer_policy = 'most_waiting'
+        for target in self.glancesync.targets.values():
+            target['max_concurrent_uploads'] = 2
+
+    def sync_regions(self):
+        """synchronise all the regions at the same time"""
+        failed = self.glancesync.sync_regions_scheduled(self.regions)
+        self.assertEquals(failed, list())
+
+
+class TestGlanceSync_Incremental(TestGlanceSync_Mixed):
+    """Test the synchronisation using the state saved in the previous runs"""
+    def setUp(self):
+        super(TestGlanceSync_Incremental, self).setUp()
+        (fd, self.state_file) = tempfile.mkstemp(suffix='.sqlite')
+        os.close(fd)
+        self.glancesync.sync_state = SyncStateStore(self.state_file)
+        self.glancesync.verify_every = 3
+
+    def tearDown(self):
+        super(TestGlanceSync_Incremental, self).tearDown()
+        os.unlink(self.state_file)
+
+    def sync_regions(self):
+        """synchronise all the regions twice: the second time the regions
+        are skipped"""
+        for region in self.regions:
+            self.glancesync.sync_region(region)
+        for region in self.regions:
+            self.glancesync.sync_region(region)
+            regionstr = region.replace('master:', '')
+            self.assertEquals(
+                self.glancesync.sync_state.get_region(regionstr).runs, 1)
+
+    def test_partial_sync(self):
+        """only the changed master images are checked in the region, until
+        the region must be verified again"""
+        calls = list()
+        iter_images_region = self.glancesync.iter_images_region
+
+        def iter_images(regionstr, only_tenant_images=False, filters=None):
+            calls.append(filters)
+            return iter_images_region(regionstr, only_tenant_images, filters)
+
+        self.glancesync.iter_images_region = iter_images
+        self.glancesync.sync_region('master:Burgos')
+        self.assertEquals(calls, [None])
+        saved = self.glancesync.sync_state.get_images('Burgos')
+        self.assertEquals(set(saved), set(self.glancesync.master_region_dict))
+        self.assertEquals(saved['image01'][1], '101')
+
+        # nothing has changed: the region is not listed
+        self.glancesync.sync_region('master:Burgos')
+        self.assertEquals(calls, [None])
+
+        # a new image: only that image is checked and uploaded
+        new_image = GlanceSyncImage(
+            'image21', '021', 'Valladolid', 'tenant1id', True, 'abc', 1024,
+            'active', {'type': 'baseimage'})
+        ServersFacade.add_image_to_mock(new_image)
+        self.assertTrue(self.glancesync.refresh_master())
+        self.glancesync.sync_region('master:Burgos')
+        self.assertEquals(calls, [None, {'name': 'image21'}])
+        self.assertIn('1$image21', ServersFacade.images['Burgos'])
+        saved = self.glancesync.sync_state.get_images('Burgos')
+        self.assertEquals(saved['image21'][1:], ('1$image21', 'abc'))
+        self.assertEquals(
+            self.glancesync.sync_state.get_region('Burgos').runs, 2)
+
+        # after verify_every runs, the whole region is checked again
+        self.glancesync.sync_region('master:Burgos')
+        self.assertEquals(calls, [None, {'name': 'image21'}, None])
+        self.assertEquals(
+            self.glancesync.sync_state.get_region('Burgos').runs, 0)
+
+    def test_partial_sync_reuse(self):
+        """with reuse_images, the images with the checksum of a changed
+        master image are found without verifying the whole region"""
+        self.glancesync.targets['master']['reuse_images'] = True
+        self.glancesync.sync_region('master:Burgos')
+        new_image = GlanceSyncImage(
+            'image21', '021', 'Valladolid', 'tenant1id', True, 'abc', 1024,
+            'active', {'type': 'baseimage'})
+        ServersFacade.add_image_to_mock(new_image)
+        ServersFacade.add_image_to_mock(GlanceSyncImage(
+            'image21_copy', '199', 'Burgos', 'tenant1id', False, 'abc', 1024,
+            'active', {}))
+        self.assertTrue(self.glancesync.refresh_master())
+        self.glancesync.sync_region('master:Burgos')
+        self.assertEquals(
+            self.glancesync.sync_state.get_region('Burgos').runs, 1)
+        images = ServersFacade.images['Burgos']
+        self.assertNotIn('1$image21', images)
+        self.assertEquals(images['199'].name, 'image21')
+        saved = self.glancesync.sync_state.get_images('Burgos')
+        self.assertEquals(saved['image21'][1:], ('199', 'abc'))
+
+    def test_plan_master_changed(self):
+        """the state is not saved when the master images have changed
+        between planning and executing the plan"""
+        plan = self.glancesync.plan_region('master:Burgos')
+        new_image = GlanceSyncImage(
+            'image21', '021', 'Valladolid', 'tenant1id', True, 'abc', 1024,
+            'active', {'type': 'baseimage'})
+        ServersFacade.add_image_to_mock(new_image)
+        self.assertTrue(self.glancesync.refresh_master())
+        self.glancesync.execute_plan(plan)
+        self.assertNotIn('1$image21', ServersFacade.images['Burgos'])
+        self.assertIsNone(self.glancesync.sync_state.get_region('Burgos'))
+
+        # the next run checks the whole region and uploads the new image
+        self.glancesync.sync_region('master:Burgos')
+        self.assertIn('1$image21', ServersFacade.images['Burgos'])
+        saved = self.glancesync.sync_state.get_images('Burgos')
+        self.assertEquals(set(saved), set(self.glancesync.master_region_dict))
+
+
+def sync_regions_with_plans(test):
+    """Synchronise the regions of a test calculating the plans first; the
+    plans are saved as JSON and loaded again before executing them"""
+    (plans, failed) = test.glancesync.plan_regions(test.regions, 2)
+    test.assertEquals(failed, list())
+    for region in test.regions:
+        plan = SyncPlan.from_json(plans[region].to_json())
+        test.glancesync.execute_plan(plan)
+
+
+class TestGlanceSync_Plan(TestGlanceSync_Mixed):
+    """Test the synchronisation executing the plans of the regions"""
+    def sync_regions(self):
+        """synchronise the regions using plans"""
+        sync_regions_with_plans(self)
+
+    def test_plan(self):
+        """the plan has the pending operations, and nothing is modified"""
+        old = copy.deepcopy(ServersFacade.images)
+        plan = self.glancesync.plan_region('master:Burgos')
+        self.assertEquals(old, ServersFacade.images)
+        self.assertFalse(plan.is_synchronised())
+        pending = list(image for (status, image) in plan.tuples
+                       if status == 'pending_upload')
+        self.assertEquals(plan.pending_bytes(),
+                          sum(image.size for image in pending))
+        self.assertEquals(plan.summary()['pending_upload'], len(pending))
+
+    def test_outdated_plan(self):
+        """a plan is not executed if a master image has changed"""
+        plan = self.glancesync.plan_region('master:Burgos')
+        name = plan.tuples[0][1].name
+        self.glancesync.master_region_dict[name] = copy.deepcopy(
+            self.glancesync.master_region_dict[name])
+        self.glancesync.master_region_dict[name].checksum = 'other'
+        old = copy.deepcopy(ServersFacade.images)
+        self.assertRaises(Exception, self.glancesync.execute_plan, plan)
+        self.assertEquals(old, ServersFacade.images)
+
+    def test_reuse(self):
+        """an image with the checksum of a master image is renamed instead
+        of uploading the master image"""
+        master_image = self.glancesync.master_region_dict['image02']
+        ServersFacade.add_image_to_mock(GlanceSyncImage(
+            'ubuntu_copy', '199', 'Burgos', 'tenant1id', False,
+            master_image.checksum, master_image.size, 'active', {}))
+        self.glancesync.targets['master']['reuse_images'] = True
+        plan = self.glancesync.plan_region('master:Burgos')
+        self.assertIn(('pending_reuse', master_image), plan.tuples)
+        self.assertEquals(plan.region_images['image02'].id, '199')
+        self.assertEquals(plan.pending_bytes(), sum(
+            image.size for (status, image) in plan.tuples
+            if status == 'pending_upload'))
+
+        self.glancesync.execute_plan(SyncPlan.from_json(plan.to_json()))
+        images = ServersFacade.images['Burgos']
+        self.assertNotIn('1$image02', images)
+        self.assertEquals(images['199'].name, 'image02')
+        self.assertTrue(images['199'].is_public)
+        self.assertEquals(images['199'].user_properties,
+                          master_image.user_properties)
+        self.assertTrue(self.glancesync.plan_region(
+            'master:Burgos').is_synchronised())
+
+    def test_reuse_obsolete(self):
+        """an image that is marked as obsolete is not reused, although it has
+        the checksum of a master image"""
+        master_image = self.glancesync.master_region_dict['image02']
+        obsolete = GlanceSyncImage(
+            'ubuntu_old_obsolete', '99', 'Master', 'tenant1id', False,
+            master_image.checksum, master_image.size, 'active', {})
+        self.glancesync.master_region_dict[obsolete.name] = obsolete
+        ServersFacade.add_image_to_mock(GlanceSyncImage(
+            'ubuntu_old', '199', 'Burgos', 'tenant1id', False,
+            master_image.checksum, master_image.size, 'active', {}))
+        self.glancesync.targets['master']['reuse_images'] = True
+        self.glancesync.targets['master']['support_obsolete_images'] = True
+        plan = self.glancesync.plan_region('master:Burgos')
+        self.assertEquals(list(image.id for image in plan.obsolete), ['199'])
+        self.assertIn(('pending_upload', master_image), plan.tuples)
+
+        self.glancesync.execute_plan(plan)
+        images = ServersFacade.images['Burgos']
+        self.assertEquals(images['199'].name, 'ubuntu_old_obsolete')
+        self.assertEquals(images['1$image02'].name, 'image02')
+
+    def test_reuse_disabled(self):
+        """by default, the images with other name are not reused"""
+        master_image = self.glancesync.master_region_dict['image02']
+        ServersFacade.add_image_to_mock(GlanceSyncImage(
+            'ubuntu_copy', '199', 'Burgos', 'tenant1id', False,
+            master_image.checksum, master_image.size, 'active', {}))
+        plan = self.glancesync.plan_region('master:Burgos')
+        self.assertIn(('pending_upload', master_image), plan.tuples)
+
 
 class TestGlanceSync_Metadata(TestGlanceSync_Sync):
     """Test a environment where some images at the destination region has
@@ -498,6 +877,22 @@ class TestGlanceSync_AMI(TestGlanceSync_Sync):
         self.regions = ['master:Burgos']
 
 
+class TestGlanceSync_AMIConcurrent(TestGlanceSync_AMI):
+    """Test a environment with AMI images, uploading several images at the
+    same time to the region"""
+    def setUp(self):
+        super(TestGlanceSync_AMIConcurrent, self).setUp()
+        self.glancesync.targets['master']['max_concurrent_uploads'] = 4
+
+
+class TestGlanceSync_AMIPlan(TestGlanceSync_AMI):
+    """Test a environment with AMI images, executing the plan of the
+    region"""
+    def sync_regions(self):
+        """synchronise the regions using plans"""
+        sync_regions_with_plans(self)
+
+
 class TestGlanceSync_Obsolete(TestGlanceSync_Sync):
     """Test obsolete images support"""
     def config(self):
@@ -507,6 +902,13 @@ class TestGlanceSync_Obsolete(TestGlanceSync_Sync):
         self.regions = ['other:Burgos', 'target2:Madrid']
 
 
+class TestGlanceSync_ObsoletePlan(TestGlanceSync_Obsolete):
+    """Test obsolete images support, executing the plans of the regions"""
+    def sync_regions(self):
+        """synchronise the regions using plans"""
+        sync_regions_with_plans(self)
+
+
 class TestGlanceSync_MasterFiltered(TestGlanceSync_Sync):
     """Test that master images with duplicated name, status != active, and
     owner differnt than the tenant, are ignored"""
@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+# -- encoding: utf-8 --
+#
+# Copyright 2015-2016 Telefónica Investigación y Desarrollo, S.A.U
+#
+# This file is part of FI-WARE project.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+#
+# You may obtain a copy of the License at:
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# For those usages not covered by the Apache version 2.0 License please
+# contact with opensource@tid.es
+#
+import hashlib
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from StringIO import StringIO
+
+from fiwareglancesync.glancesync_cache import BlobCache, CacheFill
+from fiwareglancesync.glancesync_source import ImageFile
+
+
+class TestBlobCache(unittest.TestCase):
+    """Test the cache of the master images"""
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.cache = BlobCache(os.path.join(self.dir, 'cache'), 25000)
+        self.content = ''.join(chr(i % 251) for i in range(10000))
+        self.checksum = hashlib.md5(self.content).hexdigest()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def entries(self):
+        return sorted(name for name in os.listdir(self.cache.directory)
+                      if '.' not in name and name != 'README')
+
+    def add(self, content):
+        checksum = hashlib.md5(content).hexdigest()
+        fill = self.cache.fill(checksum, StringIO(content))
+        with fill:
+            fill.read()
+            fill.read()
+        return checksum
+
+    def test_miss(self):
+        """an image not in the cache is a miss"""
+        self.assertIsNone(self.cache.lookup(self.checksum))
+        self.assertIsNone(self.cache.open(self.checksum))
+        self.assertEquals(self.cache.statistics()['misses'], 2)
+
+    def test_fill(self):
+        """the content is saved while it is read; then it is a hit"""
+        fill = self.cache.fill(self.checksum, StringIO(self.content))
+        self.assertTrue(isinstance(fill, CacheFill))
+        with fill:
+            self.assertEquals(''.join(fill), self.content)
+            self.assertEquals(fill.md5.hexdigest(), self.checksum)
+        self.assertEquals(self.entries(), [self.checksum])
+        source = self.cache.open(self.checksum)
+        self.assertTrue(isinstance(source, ImageFile))
+        with source:
+            self.assertEquals(source.read(), self.content)
+        self.assertEquals(self.cache.statistics(),
+                          {'hits': 1, 'misses': 0, 'fills': 1,
+                           'evictions': 0})
+
+    def test_fill_bad_checksum(self):
+        """the content is not saved if its MD5 is not the checksum"""
+        fill = self.cache.fill('0' * 32, StringIO(self.content))
+        with fill:
+            self.assertEquals(fill.read(), self.content)
+            self.assertEquals(fill.read(), '')
+        self.assertEquals(os.listdir(self.cache.directory),
+                          ['0' * 32 + '.lock'])
+        self.assertEquals(self.cache.fills, 0)
+
+    def test_fill_incomplete(self):
+        """the content is not saved if it is closed before the end"""
+        fill = self.cache.fill(self.checksum, StringIO(self.content))
+        fill.read(100)
+        fill.close()
+        self.assertEquals(self.entries(), [])
+        self.assertIsNone(self.cache.lookup(self.checksum))
+        # the entry is not locked anymore
+        fill = self.cache.fill(self.checksum, StringIO(self.content))
+        self.assertTrue(isinstance(fill, CacheFill))
+        fill.close()
+
+    def test_fill_busy(self):
+        """only one object fills an entry at a time"""
+        fill = self.cache.fill(self.checksum, StringIO(self.content))
+        data = StringIO(self.content)
+        self.assertTrue(self.cache.fill(self.checksum, data) is data)
+        fill.close()
+
+    def test_fill_too_big(self):
+        """the images bigger than the cache are not saved"""
+        data = StringIO(self.content)
+        self.assertTrue(self.cache.fill(self.checksum, data, 30000) is data)
+
+    def test_eviction(self):
+        """the least recently used entries are removed when the cache is
+        full"""
+        first = self.add('a' * 10000)
+        second = self.add('b' * 10000)
+        past = time.time() - 100
+        os.utime(self.cache._path(first), (past, past - 10))
+        os.utime(self.cache._path(second), (past, past))
+        # first is used now
+        self.assertIsNotNone(self.cache.lookup(first))
+        self.add(self.content)
+        self.assertEquals(self.entries(), sorted([first, self.checksum]))
+        self.assertEquals(self.cache.evictions, 1)
+        # the lock file of the evicted entry is kept
+        self.assertTrue(os.path.exists(self.cache._path(second) + '.lock'))
+
+    def test_eviction_foreign(self):
+        """the files in the directory that are not entries are not counted
+        nor removed"""
+        foreign = os.path.join(self.cache.directory, 'README')
+        with open(foreign, 'w') as f:
+            f.write('x' * 30000)
+        past = time.time() - 1000
+        os.utime(foreign, (past, past))
+        first = self.add('a' * 10000)
+        self.add(self.content)
+        self.assertTrue(os.path.exists(foreign))
+        self.assertEquals(self.entries(), sorted([first, self.checksum]))
+        self.assertEquals(self.cache.evictions, 0)
+
+    def test_store(self):
+        """store only downloads the content on a miss"""
+        downloads = list()
+
+        def download():
+            downloads.append(1)
+            return StringIO(self.content)
+
+        path = self.cache.store(self.checksum, download, 10000)
+        self.assertEquals(path, self.cache._path(self.checksum))
+        with open(path) as f:
+            self.assertEquals(f.read(), self.content)
+        self.assertEquals(self.cache.store(self.checksum, download), path)
+        self.assertEquals(len(downloads), 1)
+
+    def test_eviction_locked(self):
+        """an entry evicted while other object waits for its lock is not
+        filled twice at the same time"""
+        first = self.add('a' * 10000)
+        past = time.time() - 100
+        os.utime(self.cache._path(first), (past, past))
+        lock = self.cache._acquire(first, False)
+        self.assertIsNotNone(lock)
+        self.add('b' * 10000)
+        self.add('c' * 10000)
+        self.assertNotIn(first, self.entries())
+        # the lock is still held
+        data = StringIO('a' * 10000)
+        self.assertTrue(self.cache.fill(first, data) is data)
+        lock.close()
+        fill = self.cache.fill(first, data)
+        self.assertTrue(isinstance(fill, CacheFill))
+        fill.close()
+
+    def test_store_bad_checksum(self):
+        """store returns None when the content cannot be cached"""
+        content = StringIO(self.content)
+        self.assertIsNone(self.cache.store('0' * 32, lambda: content))
+        self.assertIsNone(self.cache.store(self.checksum, None, 30000))
+        self.assertEquals(self.entries(), [])
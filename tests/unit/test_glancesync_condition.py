@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+# -- encoding: utf-8 --
+#
+# Copyright 2015-2016 Telefónica Investigación y Desarrollo, S.A.U
+#
+# This file is part of FI-WARE project.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+#
+# You may obtain a copy of the License at:
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# For those usages not covered by the Apache version 2.0 License please
+# contact with opensource@tid.es
+#
+import unittest
+
+from fiwareglancesync.glancesync_condition import compile_condition
+from fiwareglancesync.glancesync_image import GlanceSyncImage
+
+
+class TestMetadataCondition(unittest.TestCase):
+    """Test the compiled metadata_condition"""
+
+    def setUp(self):
+        self.images = [
+            GlanceSyncImage('base_ubuntu', '01', 'Valladolid', 'tenant1id',
+                            True, 'aaa', 1024, 'active',
+                            {'type': 'baseimage', 'nid': 30}),
+            GlanceSyncImage('image02', '02', 'Valladolid', 'tenant1id',
+                            False, 'bbb', 2048, 'active', {'type': 'ngimages'}),
+            GlanceSyncImage('image03', '03', 'Valladolid', None, True, 'ccc',
+                            4096, 'active')]
+        self.metadata_set = set(['type', 'nid'])
+
+    def check(self, source):
+        """the compiled condition returns the same than eval"""
+        condition = compile_condition(source)
+        code = compile(source, 'metadata_condition', 'eval')
+        for image in self.images:
+            expected = eval(code, {'image': image,
+                                   'metadata_set': self.metadata_set})
+            self.assertEquals(condition(image, self.metadata_set), expected)
+
+    def test_same_as_eval(self):
+        """check several expressions"""
+        self.check('image.is_public')
+        self.check('not image.is_public')
+        self.check("image.is_public and 'type' in image.user_properties and "
+                   "image.user_properties['type'] == 'baseimage'")
+        self.check("image.user_properties.get('nid', 0) > 20 or "
+                   "image.size >= 4096")
+        self.check("image.name.startswith('base_') and image.owner is not "
+                   "None")
+        self.check("image.status in ('active', 'queued') and "
+                   "len(image.user_properties) > 1")
+        self.check("'nid' in metadata_set and 1 < image.size < 3000")
+        self.check("image.user_properties.get('type') in "
+                   "{'baseimage', 'ngimages'}")
+        self.check("False")
+        # the default condition, documented in glancesync.conf
+        self.check("image.is_public and (not metadata_set or "
+                   "metadata_set.intersection(image.user_properties))")
+        self.check("image.user_properties.has_key('nid') and "
+                   "{'nid'}.issubset(metadata_set)")
+        self.check("image.size > 1024 * 1 + 1 and image.size / 2 - 1 < 2047")
+        self.check("-image.size < -2000 or image.size % 3 == 1")
+        self.check("any(key.startswith('n') for key in image.user_properties)")
+        self.check("all(len(key) > 2 for key in metadata_set if key)")
+        self.check("any(value == 30 for (key, value) in "
+                   "image.user_properties.items())")
+
+    def test_regex(self):
+        """match and search use regular expressions"""
+        condition = compile_condition("search('^base_', image.name)")
+        self.assertEquals(list(condition.evaluate_many(self.images)),
+                          [True, False, False])
+        condition = compile_condition("match('image0[23]', image.name)")
+        self.assertEquals(list(condition.evaluate_many(self.images)),
+                          [False, True, True])
+
+    def test_not_allowed(self):
+        """the expressions out of the safe subset are rejected"""
+        for source in ("__import__('os').system('ls')", "open('/etc/passwd')",
+                       'image.__class__', 'image', 'image.raw',
+                       "image.user_properties.clear()", 'lambda: 1',
+                       "image.name[1:]", "[x for x in metadata_set]",
+                       "image.is_public and", "str(image, x=1)",
+                       "2 ** 10", "any(x for image in metadata_set)",
+                       "any(x.__class__ for x in metadata_set)",
+                       "any(x for x.y in metadata_set)", "x + 1"):
+            self.assertRaises(ValueError, compile_condition, source)
+
+    def test_arithmetic_numbers(self):
+        """the arithmetic operators only accept numbers"""
+        condition = compile_condition("image.name * 1000 == ''")
+        self.assertRaises(TypeError, condition, self.images[0])
+        condition = compile_condition("'%s' % image.name == ''")
+        self.assertRaises(TypeError, condition, self.images[0])
+
+    def test_no_builtins(self):
+        """the compiled function has no access to the builtins"""
+        condition = compile_condition('image.is_public')
+        self.assertEquals(condition._function.func_globals['__builtins__'],
+                          dict())
+
+    def test_cache(self):
+        """the result is evaluated again only when the image changes"""
+        condition = compile_condition("image.user_properties.get('nid') > 20")
+        function = condition._function
+        evaluated = list()
+
+        def count(image, metadata_set):
+            evaluated.append(image.id)
+            return function(image, metadata_set)
+
+        condition._function = count
+        image = self.images[0]
+        self.assertTrue(condition(image, self.metadata_set))
+        self.assertTrue(condition(image.clone(), self.metadata_set))
+        self.assertEquals(evaluated, ['01'])
+        image.user_properties = {'nid': 10}
+        self.assertFalse(condition(image, self.metadata_set))
+        condition(image, set())
+        image.checksum = 'other'
+        condition(image, set())
+        self.assertEquals(evaluated, ['01'] * 4)
+        # the values that are not hashable are not cached
+        image.user_properties = {'nid': [30]}
+        condition(image, set())
+        condition(image, set())
+        self.assertEquals(evaluated, ['01'] * 6)
+
+    def test_equality(self):
+        """conditions are equal if only the spaces are different"""
+        self.assertEquals(compile_condition('image.is_public  and True'),
+                          compile_condition('image.is_public and  True'))
+        self.assertNotEquals(compile_condition('image.is_public'),
+                             compile_condition('not image.is_public'))
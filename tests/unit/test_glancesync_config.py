@@ -31,6 +31,7 @@ import copy
 
 from fiwareglancesync.settings import glancesync_config
 from fiwareglancesync.settings.glancesync_config import GlanceSyncConfig
+from fiwareglancesync.glancesync_condition import compile_condition
 
 
 configuration_content = """
@@ -55,6 +56,13 @@ preferable_order = Trento, Lannion, Waterford, Berlin, Prague
 # sequential.
 max_children = 1
 
+max_transfers = 8
+transfer_policy = most_waiting
+max_bandwidth = 10240
+drop_images_cache = False
+image_cache_dir = /var/cache/glancesync/images
+image_cache_size = 2048
+
 [DEFAULT]
 
 # Values in this section are default values for the other sections.
@@ -110,7 +118,14 @@ keystone_url = http://server:4730/v2.0
 only_tenant_images = False
 
 list_images_timeout = 20
+list_images_page_size = 50
 use_keystone_v3 = True
+max_concurrent_uploads = 4
+max_target_transfers = 6
+glance_api_version = 2
+upload_retries = 4
+max_region_bandwidth = 512
+image_source = master
 
 [experimental]
 credential = user2,\
@@ -182,7 +197,7 @@ class TestGlanceSyncStream(unittest.TestCase):
         self.assertEquals(master['metadata_set'],
                           set(['nid', 'type', 'sdc_aware', 'nid_version']))
         self.assertEquals(master['metadata_condition'],
-                          compile(condition, 'metadata_condition', 'eval'))
+                          compile_condition(condition))
         self.assertEquals(master['user'], 'user1')
         self.assertEquals(master['password'], 'fakepassword,ofcourse')
         self.assertEquals(master['keystone_url'], 'http://server:4730/v2.0')
@@ -206,8 +221,50 @@ class TestGlanceSyncStream(unittest.TestCase):
         self.assertEquals(experimental['ignore_regions'], set(['Spain']))
         self.assertEquals(experimental['tenant_id'], 'tenant2_id')
         self.assertEquals(master['list_images_timeout'], 20)
+        self.assertEquals(master['list_images_page_size'], 50)
+        self.assertEquals(experimental['list_images_page_size'], 100)
         self.assertTrue(master['use_keystone_v3'])
         self.assertFalse(experimental['use_keystone_v3'])
+        self.assertEquals(master['max_concurrent_uploads'], 4)
+        self.assertEquals(experimental['max_concurrent_uploads'], 1)
+        self.assertEquals(master['max_target_transfers'], 6)
+        self.assertEquals(experimental['max_target_transfers'], 0)
+        self.assertEquals(master['glance_api_version'], '2')
+        self.assertEquals(experimental['glance_api_version'], '1')
+        self.assertEquals(master['upload_retries'], 4)
+        self.assertEquals(experimental['upload_retries'], 2)
+        self.assertEquals(experimental['upload_retry_delay'], 5)
+        self.assertEquals(config.max_bandwidth, 10240)
+        self.assertIsNone(config.bandwidth_file)
+        self.assertFalse(config.drop_images_cache)
+        self.assertEquals(config.image_cache_dir,
+                          '/var/cache/glancesync/images')
+        self.assertEquals(config.image_cache_size, 2048)
+        self.assertEquals(master['max_region_bandwidth'], 512)
+        self.assertEquals(master['max_target_bandwidth'], 0)
+        self.assertEquals(experimental['max_region_bandwidth'], 0)
+        self.assertEquals(master['image_source'], 'master')
+        self.assertEquals(experimental['image_source'], 'local')
+        self.assertEquals(config.max_transfers, 8)
+        self.assertEquals(config.transfer_policy, 'most_waiting')
+
+    def test_image_source(self):
+        """image_source must be local or master"""
+        override = {'master.image_source': 'remote'}
+        self.assertRaises(Exception, GlanceSyncConfig, stream=self.stream,
+                          override_d=override)
+
+    def test_transfer_policy(self):
+        """transfer_policy must be smallest, largest or most_waiting"""
+        override = {'main.transfer_policy': 'biggest'}
+        self.assertRaises(Exception, GlanceSyncConfig, stream=self.stream,
+                          override_d=override)
+
+    def test_glance_api_version(self):
+        """only the versions 1 and 2 of the glance API are supported"""
+        override = {'master.glance_api_version': '3'}
+        self.assertRaises(Exception, GlanceSyncConfig, stream=self.stream,
+                          override_d=override)
 
     def test_override(self):
         """check overriding options passing a dictionary to constructor"""
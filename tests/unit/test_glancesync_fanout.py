@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+# -- encoding: utf-8 --
+#
+# Copyright 2015-2016 Telefónica Investigación y Desarrollo, S.A.U
+#
+# This file is part of FI-WARE project.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+#
+# You may obtain a copy of the License at:
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# For those usages not covered by the Apache version 2.0 License please
+# contact with opensource@tid.es
+#
+import unittest
+import threading
+import tempfile
+import os
+
+from fiwareglancesync.glancesync_fanout import FanoutReader
+
+
+class TestFanoutReader(unittest.TestCase):
+    """Test the reader that streams a file to several uploads"""
+
+    def setUp(self):
+        (fd, self.path) = tempfile.mkstemp()
+        self.content = ''.join(chr(i % 256) for i in range(10000))
+        with os.fdopen(fd, 'wb') as f:
+            f.write(self.content)
+
+    def tearDown(self):
+        os.unlink(self.path)
+
+    def _consume(self, stream, results, size=100):
+        parts = list()
+        while True:
+            data = stream.read(size)
+            if not data:
+                break
+            parts.append(data)
+        results[stream.name] = ''.join(parts)
+
+    def test_all_destinations(self):
+        """every destination receives the full content"""
+        reader = FanoutReader(self.path, ['r1', 'r2', 'r3'], chunk_size=512,
+                              queue_chunks=2)
+        reader.start()
+        results = dict()
+        threads = list()
+        for (name, size) in (('r1', 100), ('r2', 1000), ('r3', -1)):
+            thread = threading.Thread(target=self._consume, args=(
+                reader.streams[name], results, size))
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+        reader.join()
+        for name in ('r1', 'r2', 'r3'):
+            self.assertEquals(results[name], self.content)
+        self.assertEquals(reader.bytes_read, len(self.content))
+
+    def test_stalled_destination(self):
+        """a destination that does not read is detached, but it gets the full
+        content when it reads later"""
+        reader = FanoutReader(self.path, ['fast', 'slow'], chunk_size=512,
+                              queue_chunks=1, stall_timeout=0.1)
+        reader.start()
+        results = dict()
+        self._consume(reader.streams['fast'], results)
+        reader.join()
+        self.assertFalse(reader.streams['slow'].attached)
+        self._consume(reader.streams['slow'], results)
+        self.assertEquals(results['fast'], self.content)
+        self.assertEquals(results['slow'], self.content)
+
+    def test_not_ready_destination(self):
+        """a destination that is not ready is detached without waiting
+        stall_timeout"""
+        reader = FanoutReader(self.path, ['fast', 'late'], chunk_size=512,
+                              queue_chunks=1, stall_timeout=60,
+                              ready=['fast'])
+        self.assertFalse(reader.streams['late'].ready)
+        reader.start()
+        results = dict()
+        self._consume(reader.streams['fast'], results)
+        reader.join()
+        self.assertFalse(reader.streams['late'].attached)
+        self._consume(reader.streams['late'], results)
+        self.assertEquals(results['fast'], self.content)
+        self.assertEquals(results['late'], self.content)
+
+    def test_closed_destination(self):
+        """a closed destination does not block the other ones"""
+        reader = FanoutReader(self.path, ['r1', 'r2'], chunk_size=512,
+                              queue_chunks=1)
+        reader.streams['r2'].close()
+        reader.start()
+        results = dict()
+        self._consume(reader.streams['r1'], results)
+        reader.join()
+        self.assertEquals(results['r1'], self.content)
+
+    def test_missing_file(self):
+        """start fails if the file does not exist"""
+        reader = FanoutReader(self.path + '.missing', ['r1'])
+        self.assertRaises(IOError, reader.start)
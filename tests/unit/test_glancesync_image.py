@@ -24,7 +24,8 @@
 #
 import unittest
 import copy
-from fiwareglancesync.glancesync_image import GlanceSyncImage
+import pickle
+from fiwareglancesync.glancesync_image import GlanceSyncImage, raw_fields
 
 
 class TestGlanceSyncImageRegion(unittest.TestCase):
@@ -85,6 +86,57 @@ class TestGlanceSyncImageRegion(unittest.TestCase):
         self.assertNotEquals(self.image1, self.image2)
         self.assertEquals(self.image1, copy.deepcopy(self.image1))
 
+    def test_clone(self):
+        """the clone shares user_properties until one of the images
+        modifies them; reading them does not copy them"""
+        clone = self.image1.clone()
+        self.assertEquals(self.image1, clone)
+        self.assertEquals(clone.user_properties['p1'], 'v1')
+        self.assertIs(clone.user_properties, self.image1.user_properties)
+        clone.modifiable_properties()['p1'] = 'other'
+        self.assertEquals(self.image1.user_properties['p1'], 'v1')
+        self.assertIsNot(clone.user_properties, self.image1.user_properties)
+        deep = copy.deepcopy(self.image1)
+        self.assertIsNot(deep.user_properties, self.image1.user_properties)
+        clone.name = 'other'
+        self.assertEquals(self.image1.name, self.name)
+
+    def test_upload_descriptor(self):
+        """the descriptor has only the projected properties, in its own
+        dictionary"""
+        descriptor = self.image1.upload_descriptor(frozenset(['p1', 'p3']))
+        self.assertEquals(descriptor.user_properties, {'p1': 'v1', 'p3': 'v3'})
+        self.assertEquals(descriptor.name, self.name)
+        descriptor = self.image1.upload_descriptor()
+        self.assertEquals(descriptor, self.image1)
+        descriptor.user_properties['p1'] = 'other'
+        self.assertEquals(self.image1.user_properties['p1'], 'v1')
+        self.assertFalse(self.image1._shared)
+
+    def test_raw(self):
+        """only the fields in raw_fields of raw are kept, and the strings
+        are shared between images"""
+        raw = {'disk_format': 'qcow2', 'container_format': 'bare',
+               'protected': False, 'min_ram': 0, 'min_disk': 0,
+               'deleted': False, 'created_at': '2016-01-01T00:00:00'}
+        image = GlanceSyncImage(
+            self.name, self.id1, self.region, self.owner, True, self.checksum,
+            self.size, self.status, {''.join(['ty', 'pe']): 'base'}, raw)
+        self.assertEquals(sorted(image.raw), sorted(raw_fields[:5]))
+        other = GlanceSyncImage(
+            self.name, self.id2, self.region, self.owner, True, self.checksum,
+            self.size, self.status, {'type': 'base'}, raw)
+        self.assertIs(image.user_properties.keys()[0],
+                      other.user_properties.keys()[0])
+
+    def test_pickle(self):
+        """the images can be pickled (e.g. by the persistence of the mock)
+        with any protocol"""
+        for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+            self.assertEquals(
+                self.image1,
+                pickle.loads(pickle.dumps(self.image1, protocol)))
+
     def test_to_field_list(self):
         """Test method to_field_list, without filter"""
         result = [
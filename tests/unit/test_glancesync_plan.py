@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+# -- encoding: utf-8 --
+#
+# Copyright 2015-2016 Telefónica Investigación y Desarrollo, S.A.U
+#
+# This file is part of FI-WARE project.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+#
+# You may obtain a copy of the License at:
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# For those usages not covered by the Apache version 2.0 License please
+# contact with opensource@tid.es
+#
+import unittest
+
+from fiwareglancesync.glancesync_plan import SyncPlan
+from fiwareglancesync.glancesync_image import GlanceSyncImage
+
+
+class TestSyncPlan(unittest.TestCase):
+    """Test the plan of a region"""
+
+    def setUp(self):
+        self.plan = SyncPlan('master:Burgos', 'fp', 1000)
+        image1 = GlanceSyncImage('image1', '01', 'Valladolid', 'tenant1id',
+                                 True, 'aaa', 1024)
+        image2 = GlanceSyncImage('image2', '02', 'Valladolid', 'tenant1id',
+                                 True, 'bbb', 2048)
+        image3 = GlanceSyncImage('image3', '03', 'Valladolid', 'tenant1id',
+                                 True, 'ccc', 4096)
+        self.plan.tuples = [('ok', image1), ('pending_metadata', image2),
+                            ('pending_replace', image3)]
+        self.plan.region_images = dict(
+            (name, GlanceSyncImage(name, '1' + name[-1], 'Burgos',
+                                   'tenant1id', True, 'xxx', 100,
+                                   'active', {'type': 'base'},
+                                   {'disk_format': 'qcow2'}))
+            for name in ('image2', 'image3'))
+        self.plan.obsolete = [
+            GlanceSyncImage('image4_obsolete', '14', 'Burgos', 'tenant1id',
+                            False, 'ddd', 10, 'active')]
+
+    def test_summary(self):
+        """check the counters of the plan"""
+        self.assertEquals(self.plan.pending_bytes(), 4096)
+        self.assertEquals(self.plan.count('pending_metadata'), 1)
+        self.assertFalse(self.plan.is_synchronised())
+        self.assertEquals(self.plan.summary(),
+                          {'ok': 1, 'pending_metadata': 1,
+                           'pending_replace': 1, 'obsolete': 1,
+                           'pending_bytes': 4096})
+        self.assertTrue(SyncPlan('master:Burgos').is_synchronised())
+
+    def test_json(self):
+        """a plan loaded from JSON is the same"""
+        plan = SyncPlan.from_json(self.plan.to_json())
+        self.assertEquals(plan.region, 'master:Burgos')
+        self.assertEquals(plan.master_fingerprint, 'fp')
+        self.assertEquals(plan.created, 1000)
+        self.assertIsNone(plan.reconciled)
+        self.assertEquals(plan.region_images, self.plan.region_images)
+        self.assertEquals(plan.obsolete, self.plan.obsolete)
+        self.assertEquals(
+            list((status, image.name, image.id, image.checksum, image.size)
+                 for (status, image) in plan.tuples),
+            list((status, image.name, image.id, image.checksum, image.size)
+                 for (status, image) in self.plan.tuples))
+        self.plan.reconciled = set(['image2'])
+        plan = SyncPlan.from_json(self.plan.to_json())
+        self.assertEquals(plan.reconciled, set(['image2']))
@@ -28,7 +28,8 @@ import copy
 import StringIO
 import logging
 
-from fiwareglancesync.glancesync_region import GlanceSyncRegion
+from fiwareglancesync.glancesync_region import GlanceSyncRegion,\
+    RegionImageIndex
 from fiwareglancesync.glancesync_image import GlanceSyncImage
 
 
@@ -216,6 +217,33 @@ class TestGlanceSyncRegion(unittest.TestCase):
         self.assertEquals(expected, set(new_dict.keys()))
         self.assertNoWarnings()
 
+    def test_images_to_sync_dict_cached(self):
+        """the result is shared by the regions of the target while the
+        master dictionary and the options are the same"""
+        new_dict = self.region.images_to_sync_dict(self.master_region_dict)
+        other_region = GlanceSyncRegion('Valladolid', self.targets)
+        self.assertIs(new_dict,
+                      other_region.images_to_sync_dict(
+                          self.master_region_dict))
+        self.assertIs(new_dict, other_region.images_to_sync_dict(new_dict))
+        self.assertIsNot(new_dict, other_region.images_to_sync_dict(
+            dict(self.master_region_dict)))
+        new_dict = self.region.images_to_sync_dict(self.master_region_dict)
+        self.targets['master']['forcesyncs'] = set(['004'])
+        new_dict2 = self.region.images_to_sync_dict(self.master_region_dict)
+        self.assertIsNot(new_dict, new_dict2)
+        self.assertIn('image04', new_dict2)
+
+    def test_metadata_projection(self):
+        """the projection includes kernel_id and ramdisk_id, and it is
+        recalculated when metadata_set changes"""
+        self.assertEquals(self.region.metadata_projection(),
+                          frozenset(['key1', 'kernel_id', 'ramdisk_id']))
+        self.assertIs(self.region.metadata_projection(),
+                      self.region.metadata_projection())
+        self.targets['master']['metadata_set'] = set()
+        self.assertIsNone(self.region.metadata_projection())
+
     def test_local_images_filtered(self):
         """test method region_filtered"""
         region_filtered = self.region.local_images_filtered(
@@ -297,6 +325,43 @@ class TestGlanceSyncRegion(unittest.TestCase):
         expected_as_list = list(x[1].name + '_' + x[0] for x in expected)
         self.assertEqual(expected_as_list, result_as_list)
 
+    def test_images_to_reuse(self):
+        """an image with other name and the same checksum is reused only
+        if it is owned by the tenant and reuse_images is True"""
+        self.master_region_dict['image01'].checksum = 'checksum01'
+        missing = self.region_dict.pop('image01')
+        missing.name = 'image01_copy'
+        missing.checksum = 'checksum01'
+        other = self.dup_image(missing, 'Burgos', 50, '1')
+        other.owner = 'othertenant'
+        images = [other] + self.region_dict.values() + [missing]
+        master = self.region.images_to_sync_dict(self.master_region_dict)
+        present = self.region.local_images_filtered(master, images)
+        index = RegionImageIndex(images)
+        self.assertEquals(index.by_checksum['checksum01'], [other, missing])
+        self.assertEquals(index.by_name['image01_copy'], [other, missing])
+        self.assertEquals(index.by_id['150'], other)
+        self.assertEquals(
+            self.region.images_to_reuse(master, index, present), dict())
+        self.targets['master']['reuse_images'] = True
+        self.assertEquals(
+            self.region.images_to_reuse(master, index, present),
+            {'image01': missing})
+        self.assertEquals(self.region.images_to_reuse(
+            master, index, present, set([missing.id])), dict())
+
+    def test_image_list_to_sync_reuse(self):
+        """the images to reuse are pending_reuse and the AMI images that
+        depend on them pending_ami"""
+        missing = self.region_dict.pop('image01')
+        result = self.region.image_list_to_sync(
+            self.master_region_dict, self.region_dict.values(),
+            {'image01': missing})
+        result_as_list = list(x[1].name + '_' + x[0] for x in result)
+        self.assertEqual(['image00_ok', 'image01_pending_reuse', 'image02_ok',
+                          'image03_pending_ami', 'image09_pending_metadata'],
+                         result_as_list)
+
     def test_image_list_to_sync_missing(self):
         """ Check with one image missing; this implies also metadata missing
         of image03, because its kernel_id points to the missing image.
@@ -24,7 +24,11 @@
 #
 
 from os import environ as env
+import hashlib
+import json
 import os
+import shutil
+import StringIO
 import tempfile
 import unittest
 import copy
@@ -32,8 +36,11 @@ from mock import patch, MagicMock, call, ANY
 from keystoneclient.auth.identity import v2, v3
 from multiprocessing import TimeoutError
 
-from fiwareglancesync.glancesync_serversfacade import ServersFacade, GlanceFacadeException
+from fiwareglancesync.glancesync_serversfacade import ServersFacade, GlanceFacadeException, ServersFacadeV2
 from fiwareglancesync.glancesync_image import GlanceSyncImage
+from fiwareglancesync.glancesync_cache import BlobCache
+from fiwareglancesync.glancesync_fanout import FanoutReader
+from fiwareglancesync.glancesync_source import StreamReader
 from fiwareglancesync.glancesync_region import GlanceSyncRegion
 
 """This environment variable activates a pair of
@@ -47,11 +54,27 @@ if 'TESTING_FACADE' in env:
     testingFacadeReal = True
 
 
+class FakeSession(object):
+    """session of MyOpenStackClients"""
+    token = 'token1'
+    invalidated = 0
+
+    def get_token(self):
+        """get the current token"""
+        return self.token
+
+    def invalidate(self):
+        """count the times the token is invalidated"""
+        FakeSession.invalidated += 1
+
+
 class MyOpenStackClients(MagicMock):
     """mock to use in the test"""
+    session = FakeSession()
+
     def get_session(self):
-        """get an empy string"""
-        return ""
+        """get a fake session"""
+        return self.session
 
     def get_regions(self, service):
         """get a  list"""
@@ -78,6 +101,7 @@ class TestGlanceServersFacadeM(unittest.TestCase):
         target['keystone_url'] = 'http://127.0.0.1/'
         target['tenant'] = 'faketenant'
         target['use_keystone_v3'] = False
+        target['upload_retry_delay'] = 0
         self.target = target
 
         self.region = 'fakeregion'
@@ -99,6 +123,8 @@ class TestGlanceServersFacadeM(unittest.TestCase):
         image.raw['min_disk'] = '0'
 
         self.image = image
+        client = self.facade.osclients.get_glanceclient.return_value
+        client.images.create.return_value = image
 
     def tearDown(self):
         """delete the tempfile use to test the upload method"""
@@ -106,6 +132,27 @@ class TestGlanceServersFacadeM(unittest.TestCase):
             os.unlink(self.facade.images_dir + '/01')
             os.rmdir(self.facade.images_dir)
 
+    def test_glanceclient_cache(self):
+        """the glance client of a region is reused until the token changes"""
+        osclients = self.facade.osclients
+        osclients.get_glanceclient.side_effect = lambda: MagicMock()
+        try:
+            client1 = self.facade._get_glanceclient('fakeregion')
+            client2 = self.facade._get_glanceclient('fakeregion2')
+            self.assertIs(self.facade._get_glanceclient('fakeregion'),
+                          client1)
+            self.assertIsNot(client1, client2)
+            self.assertEquals(osclients.get_glanceclient.call_count, 2)
+            osclients.set_region.assert_called_with('fakeregion2')
+
+            FakeSession.token = 'token2'
+            client3 = self.facade._get_glanceclient('fakeregion')
+        finally:
+            FakeSession.token = 'token1'
+            osclients.get_glanceclient.side_effect = None
+        self.assertIsNot(client3, client1)
+        self.assertEquals(osclients.get_glanceclient.call_count, 3)
+
     def test_gettenantid(self):
         """call the method and check the return value of the osclients mock"""
         tenant_id = self.facade.get_tenant_id()
@@ -126,33 +173,70 @@ class TestGlanceServersFacadeM(unittest.TestCase):
         ]
         self.assertListEqual(mock_osclients.mock_calls, calls)
 
-    @patch('fiwareglancesync.glancesync_serversfacade.Pool')
-    def test_list(self, mock_pool):
-        """test list method. Check that apply_async method of the pool is
-        invoked passing the glance_client"""
-        # Check call to pool.apply_async(func, (glance_client,))
-        self.facade.get_imagelist(self.region_obj)
-        glance_client = mock_osclients.return_value.get_glanceclient()
-        mock_pool.return_value.apply_async.assert_called_once_with(
-            ANY, (glance_client,))
-
-    @patch('fiwareglancesync.glancesync_serversfacade.Pool')
-    def test_list_ex_timeout(self, mock_pool):
-        """test TimeoutError exception with list operation"""
-        config = {'apply_async.return_value.get.side_effect': TimeoutError()}
-        mock_pool.return_value.configure_mock(**config)
+    def _raw_image(self, name):
+        """return a image as returned by glanceclient"""
+        raw = {'name': name, 'id': name + '_id', 'owner': 'tenantid1',
+               'is_public': True, 'checksum': 'abc', 'size': 1024,
+               'status': 'active', 'properties': {'type': 'base'}}
+        return MagicMock(**{'to_dict.return_value': raw})
+
+    def test_list(self):
+        """test list method. Check that the images are requested by pages,
+        with a client with timeout, and converted to GlanceSyncImage"""
+        glance_client = MagicMock()
+        glance_client.images.list.return_value = iter(
+            [self._raw_image('image1'), self._raw_image('image2')])
+        config = {'get_glanceclient.return_value': glance_client}
+        self.facade.osclients.configure_mock(**config)
+        self.target['list_images_timeout'] = 20
+        images = self.facade.get_imagelist(self.region_obj)
+        self.facade.osclients.get_glanceclient.assert_called_with(timeout=20)
+        glance_client.images.list.assert_called_once_with(page_size=ANY)
+        self.assertEquals(list(image.name for image in images),
+                          ['image1', 'image2'])
+        self.assertEquals(images[0].region, 'fakeregion')
+        self.assertEquals(images[0].user_properties, {'type': 'base'})
+
+    def test_iter_list_filters(self):
+        """test that the page size and the filters are passed to glance"""
+        glance_client = MagicMock()
+        glance_client.images.list.return_value = iter(
+            [self._raw_image('image1')])
+        config = {'get_glanceclient.return_value': glance_client}
+        self.facade.osclients.configure_mock(**config)
+        images = self.facade.iter_imagelist(
+            self.region_obj, page_size=10,
+            filters={'owner': 'tenantid1', 'status': 'active'})
+        self.assertFalse(glance_client.images.list.called)
+        self.assertEquals(list(image.name for image in images), ['image1'])
+        glance_client.images.list.assert_called_once_with(
+            page_size=10, owner='tenantid1', filters={'status': 'active'})
+
+    @patch('fiwareglancesync.glancesync_serversfacade.time')
+    def test_list_ex_timeout(self, mock_time):
+        """test the deadline of the list operation"""
+        mock_time.time.side_effect = [0, 10, 10, 41]
+        glance_client = MagicMock()
+        glance_client.images.list.return_value = iter(
+            [self._raw_image('image1'), self._raw_image('image2')])
+        config = {'get_glanceclient.return_value': glance_client}
+        self.facade.osclients.configure_mock(**config)
         msg = 'fakeregion: Timeout while retrieving image list.'
         with self.assertRaisesRegexp(GlanceFacadeException, msg):
             self.facade.get_imagelist(self.region_obj)
 
-    @patch('fiwareglancesync.glancesync_serversfacade.Pool')
-    def test_list_ex(self, mock_pool):
+    def test_list_ex(self):
         """test an exception with list operation"""
-        config = {'apply_async.return_value.get.side_effect': Exception('not found')}
-        mock_pool.return_value.configure_mock(**config)
+        config = {'get_glanceclient.return_value.images.list.side_effect':
+                  Exception('not found')}
+        self.facade.osclients.configure_mock(**config)
         msg = 'fakeregion: Error retrieving image list. Cause: not found'
-        with self.assertRaisesRegexp(GlanceFacadeException, msg):
-            self.facade.get_imagelist(self.region_obj)
+        try:
+            with self.assertRaisesRegexp(GlanceFacadeException, msg):
+                self.facade.get_imagelist(self.region_obj)
+        finally:
+            self.facade.osclients.get_glanceclient.return_value.images.\
+                list.side_effect = None
 
     def test_upload(self):
         """test the upload method: the id is the passed to the glancesync
@@ -179,8 +263,12 @@ class TestGlanceServersFacadeM(unittest.TestCase):
         file_obj.write('test content')
         file_obj.close()
         msg = 'fakeregion: Upload of imagetest Failed. Cause: not enough space'
-        with self.assertRaisesRegexp(GlanceFacadeException, msg):
-            self.facade.upload_image(self.region_obj, self.image)
+        try:
+            with self.assertRaisesRegexp(GlanceFacadeException, msg):
+                self.facade.upload_image(self.region_obj, self.image)
+        finally:
+            self.facade.osclients.get_glanceclient.return_value.images.\
+                create.side_effect = None
 
     def test_upload_ex2(self):
         """test an exception because the file does not exists"""
@@ -193,26 +281,251 @@ class TestGlanceServersFacadeM(unittest.TestCase):
         with self.assertRaisesRegexp(GlanceFacadeException, msg):
             self.facade.upload_image(self.region_obj, self.image)
 
+    def test_upload_retry_stream(self):
+        """a stream that cannot be rewound is closed, and the content is
+        read again from the image file"""
+        client = self.facade.osclients.get_glanceclient.return_value
+        sent = list()
+
+        def update(id, data):
+            sent.append(data.read(4))
+            if len(sent) == 1:
+                raise Exception('connection reset')
+            sent[-1] += data.read()
+
+        client.images.update.side_effect = update
+        self.facade.images_dir = tempfile.mkdtemp(prefix='imagesdir_tmp')
+        with open(self.facade.images_dir + '/01', 'w') as file_obj:
+            file_obj.write('test content')
+        self.image.checksum = hashlib.md5('test content').hexdigest()
+        reader = FanoutReader(self.facade.images_dir + '/01', ['fakeregion'])
+        stream = reader.streams['fakeregion']
+        reader.start()
+        try:
+            self.facade.upload_image(self.region_obj, self.image, stream)
+        finally:
+            client.images.update.side_effect = None
+            reader.join()
+        self.assertEquals(sent, ['test', 'test content'])
+        self.assertTrue(stream.closed)
+        self.assertFalse(stream.attached)
+
+    def test_upload_retry(self):
+        """the upload is retried sending the content from the beginning,
+        and only the image created by the failed attempt is deleted"""
+        client = self.facade.osclients.get_glanceclient.return_value
+        sent = list()
+
+        def update(id, data):
+            sent.append(data.read(4))
+            if len(sent) == 1:
+                raise Exception('connection reset')
+            sent[-1] += data.read()
+
+        client.images.create.side_effect = [MagicMock(id='00'), self.image]
+        client.images.update.side_effect = update
+        self.target['tenant_id'] = 'tenantid'
+        self.image.checksum = hashlib.md5('test content').hexdigest()
+        data = StringIO.StringIO('test content')
+        try:
+            result = self.facade.upload_image(self.region_obj, self.image,
+                                              data)
+        finally:
+            client.images.create.side_effect = None
+            client.images.update.side_effect = None
+        self.assertEquals(result, '01')
+        self.assertEquals(sent, ['test', 'test content'])
+        self.assertEquals(client.images.update.call_args_list,
+                          [call('00', data=ANY), call('01', data=ANY)])
+        # the other images of the tenant with the same name are not looked
+        # for: they may be uploads in progress of other processes
+        self.assertFalse(client.images.list.called)
+        client.images.get.assert_called_once_with('00')
+
+    def test_upload_retries_exhausted(self):
+        """the upload is tried upload_retries + 1 times"""
+        client = self.facade.osclients.get_glanceclient.return_value
+        client.images.create.side_effect = Exception('connection reset')
+        self.target['upload_retries'] = 1
+        msg = 'fakeregion: Upload of imagetest Failed. Cause: connection reset'
+        try:
+            with self.assertRaisesRegexp(GlanceFacadeException, msg):
+                self.facade.upload_image(self.region_obj, self.image,
+                                         StringIO.StringIO('test content'))
+        finally:
+            client.images.create.side_effect = None
+        self.assertEquals(client.images.create.call_count, 2)
+
+    def test_upload_unauthorized(self):
+        """the token is renewed when the server answers 401"""
+        client = self.facade.osclients.get_glanceclient.return_value
+        error = Exception('Unauthorized')
+        error.code = 401
+        client.images.create.side_effect = [error, self.image]
+        invalidated = FakeSession.invalidated
+        try:
+            self.facade.upload_image(self.region_obj, self.image,
+                                     StringIO.StringIO('test content'))
+        finally:
+            client.images.create.side_effect = None
+        self.assertEquals(FakeSession.invalidated, invalidated + 1)
+
+    def test_upload_master(self):
+        """with image_source master, the image is downloaded from the master
+        region when it is not in images_dir"""
+        client = self.facade.osclients.get_glanceclient.return_value
+        client.images.update.side_effect = lambda id, data: data.read()
+        self.facade.images_dir = tempfile.mkdtemp(prefix='imagesdir_tmp')
+        with open(self.facade.images_dir + '/01', 'w') as file_obj:
+            file_obj.write('test content')
+        self.facade.master_source = MagicMock()
+        self.facade.master_source.return_value = \
+            StreamReader(['master ', 'content'])
+        self.image.checksum = hashlib.md5('master content').hexdigest()
+        self.target['image_source'] = 'master'
+        try:
+            # the local file is preferred
+            msg = 'fakeregion: Upload of imagetest Failed. Cause: the MD5 '
+            with self.assertRaisesRegexp(GlanceFacadeException, msg):
+                self.facade.upload_image(self.region_obj, self.image)
+            self.assertFalse(self.facade.master_source.called)
+            os.rename(self.facade.images_dir + '/01',
+                      self.facade.images_dir + '/02')
+            self.facade.upload_image(self.region_obj, self.image)
+        finally:
+            client.images.update.side_effect = None
+            os.rename(self.facade.images_dir + '/02',
+                      self.facade.images_dir + '/01')
+        self.facade.master_source.assert_called_once_with(self.image)
+
+    def test_upload_master_cache(self):
+        """with an image cache, the image is downloaded from the master
+        region only the first time"""
+        client = self.facade.osclients.get_glanceclient.return_value
+        uploaded = list()
+        client.images.update.side_effect = \
+            lambda id, data: uploaded.append(data.read())
+        self.facade.images_dir = tempfile.mkdtemp(prefix='imagesdir_tmp')
+        cache_dir = tempfile.mkdtemp(prefix='imagecache_tmp')
+        self.facade.image_cache = BlobCache(cache_dir, 1024)
+        self.facade.master_source = MagicMock()
+        self.facade.master_source.return_value = \
+            StreamReader(['master ', 'content'])
+        self.image.checksum = hashlib.md5('master content').hexdigest()
+        self.target['image_source'] = 'master'
+        try:
+            self.facade.upload_image(self.region_obj, self.image)
+            self.facade.upload_image(self.region_obj, self.image)
+        finally:
+            client.images.update.side_effect = None
+            shutil.rmtree(cache_dir)
+            # it is removed by tearDown
+            open(self.facade.images_dir + '/01', 'w').close()
+        self.assertEquals(uploaded, ['master content', 'master content'])
+        self.facade.master_source.assert_called_once_with(self.image)
+        self.assertEquals(self.facade.image_cache.hits, 1)
+        self.assertEquals(self.facade.image_cache.fills, 1)
+
+    def test_download(self):
+        """the content of the image is streamed"""
+        client = self.facade.osclients.get_glanceclient.return_value
+        client.images.data.return_value = iter(['test ', 'content'])
+        reader = self.facade.download_image(self.region_obj, '01', 12)
+        client.images.data.assert_called_once_with('01', do_checksum=False)
+        self.assertEquals(reader.size, 12)
+        self.assertEquals(reader.read(), 'test content')
+
+    def test_download_ex(self):
+        """an error downloading the image"""
+        client = self.facade.osclients.get_glanceclient.return_value
+        client.images.data.side_effect = Exception('not found')
+        msg = 'fakeregion: Download of image 01 Failed. Cause: not found'
+        try:
+            with self.assertRaisesRegexp(GlanceFacadeException, msg):
+                self.facade.download_image(self.region_obj, '01')
+        finally:
+            client.images.data.side_effect = None
+
+    def test_upload_throttle(self):
+        """the content is read within the bandwidth limits"""
+        client = self.facade.osclients.get_glanceclient.return_value
+        client.images.update.side_effect = lambda id, data: data.read()
+        self.target['throttle'] = MagicMock()
+        self.target['throttle'].reader.side_effect = \
+            lambda data, region, target_name: data
+        self.image.checksum = hashlib.md5('test content').hexdigest()
+        try:
+            self.facade.upload_image(self.region_obj, self.image,
+                                     StringIO.StringIO('test content'))
+        finally:
+            client.images.update.side_effect = None
+        self.target['throttle'].reader.assert_called_once_with(
+            ANY, 'fakeregion', 'master')
+
+    def test_upload_checksum(self):
+        """when the MD5 of the content sent is not the checksum of the
+        image, the new image is deleted and the upload is not retried"""
+        client = self.facade.osclients.get_glanceclient.return_value
+        client.images.update.side_effect = lambda id, data: data.read()
+        self.image.checksum = hashlib.md5('other content').hexdigest()
+        msg = 'fakeregion: Upload of imagetest Failed. Cause: the MD5 of ' +\
+            'the content sent'
+        try:
+            with self.assertRaisesRegexp(GlanceFacadeException, msg):
+                self.facade.upload_image(self.region_obj, self.image,
+                                         StringIO.StringIO('test content'))
+        finally:
+            client.images.update.side_effect = None
+        self.assertEquals(client.images.create.call_count, 1)
+        client.images.get.assert_called_once_with('01')
+
     def test_update(self):
         """test update metadata. Check that the last call is the update over
         the image with the expected params"""
         self.image.user_properties['new_property'] = 'new_value'
         self.facade.update_metadata(self.region_obj, self.image)
-        expected_call = call.get_glanceclient().images.get().update(
-            is_public=False, container_format='bare', disk_format='qcow2',
-            name='imagetest', protected=False, purge_props=True,
-            properties={'new_property': 'new_value'})
+        expected_call = call.get_glanceclient().images.update(
+            '01', is_public=False, container_format='bare',
+            disk_format='qcow2', name='imagetest', protected=False,
+            purge_props=True, properties={'new_property': 'new_value'})
         print self.facade.osclients.mock_calls[-1]
         self.assertTrue(self.facade.osclients.mock_calls[-1] == expected_call)
 
+    def test_update_changes(self):
+        """with the previous image, only the changes are sent; all the
+        properties are sent only when some of them is removed"""
+        self.image.user_properties['p1'] = 'v1'
+        self.image.user_properties['p2'] = 'v2'
+        previous = self.image.clone()
+        self.image.modifiable_properties()['p1'] = 'new'
+        self.image.is_public = True
+        self.facade.update_metadata(self.region_obj, self.image, previous)
+        expected_call = call.get_glanceclient().images.update(
+            '01', is_public=True, purge_props=False, properties={'p1': 'new'})
+        self.assertEquals(self.facade.osclients.mock_calls[-1], expected_call)
+
+        previous = self.image.clone()
+        del self.image.modifiable_properties()['p2']
+        self.facade.update_metadata(self.region_obj, self.image, previous)
+        expected_call = call.get_glanceclient().images.update(
+            '01', purge_props=True, properties={'p1': 'new'})
+        self.assertEquals(self.facade.osclients.mock_calls[-1], expected_call)
+
+        # nothing has changed: no request
+        calls = len(self.facade.osclients.mock_calls)
+        self.facade.update_metadata(self.region_obj, self.image,
+                                    self.image.clone())
+        self.assertEquals(len(self.facade.osclients.mock_calls), calls)
+
     def test_update_ex(self):
         """test and exception during the update"""
-        config = {'get_glanceclient.return_value.images.get.return_value.update.side_effect': Exception('bad '
-                                                                                                        'attribute')}
+        config = {'get_glanceclient.return_value.images.update.side_effect': Exception('bad attribute')}
         self.facade.osclients.configure_mock(**config)
         msg = 'fakeregion: Update of imagetest failed. Cause: bad attribute'
         with self.assertRaisesRegexp(GlanceFacadeException, msg):
             self.facade.update_metadata(self.region_obj, self.image)
+        self.facade.osclients.get_glanceclient.return_value.images.update.\
+            side_effect = None
 
     def test_delete(self):
         """test that the delete method of osclients is called"""
@@ -246,6 +559,128 @@ def _unset_environment():
     del env['OS_TENANT_NAME']
 
 
+class TestGlanceServersFacadeV2M(unittest.TestCase):
+    """Test the facade of the version 2 of the glance API using a mock"""
+    @patch('fiwareglancesync.glancesync_serversfacade.OpenStackClients', mock_osclients)
+    def setUp(self):
+        """create self.facade, with a mock of the glance client"""
+        target = dict()
+        target['target_name'] = 'master'
+        target['user'] = 'fakeuser'
+        target['password'] = 'fakepassword'
+        target['keystone_url'] = 'http://127.0.0.1/'
+        target['tenant'] = 'faketenant'
+        target['glance_api_version'] = '2'
+        target['upload_retry_delay'] = 0
+        self.target = target
+        self.region_obj = GlanceSyncRegion('fakeregion', {'master': target})
+
+        mock_osclients.reset_mock()
+        self.facade = ServersFacadeV2(self.target)
+        self.glance_client = MagicMock()
+        self.facade.osclients.get_glanceclient.return_value = \
+            self.glance_client
+
+        image = GlanceSyncImage('imagetest', '01', 'fakeregion', None, False,
+                                'abc', 12, 'active', {'type': 'base', 'nid': 3})
+        image.raw = {'disk_format': 'qcow2', 'container_format': 'bare',
+                     'protected': False, 'min_ram': '0', 'min_disk': '0'}
+        self.image = image
+
+    def tearDown(self):
+        self.facade.osclients.get_glanceclient.return_value = MagicMock()
+
+    def test_list(self):
+        """the user properties are the attributes that are not of the
+        image, and is_public is obtained from the visibility"""
+        self.glance_client.images.list.return_value = iter([{
+            'name': 'image1', 'id': 'image1_id', 'owner': 'tenantid1',
+            'visibility': 'public', 'checksum': 'abc', 'size': 1024,
+            'status': 'active', 'disk_format': 'qcow2', 'tags': [],
+            'container_format': 'bare', 'type': 'base'}])
+        images = list(self.facade.iter_imagelist(
+            self.region_obj, page_size=10,
+            filters={'owner': 'tenantid1', 'is_public': True}))
+        self.facade.osclients.get_glanceclient.assert_called_with(
+            timeout=30, version='2')
+        self.glance_client.images.list.assert_called_once_with(
+            page_size=10, filters={'owner': 'tenantid1',
+                                   'visibility': 'public'})
+        self.assertEquals(len(images), 1)
+        self.assertTrue(images[0].is_public)
+        self.assertEquals(images[0].user_properties, {'type': 'base'})
+        self.assertEquals(images[0].raw['disk_format'], 'qcow2')
+
+    def test_update(self):
+        """only the changes are sent, as a JSON-patch"""
+        previous = self.image.clone()
+        self.image.name = 'other'
+        self.image.is_public = True
+        self.image.modifiable_properties()['nid'] = 4
+        del self.image.modifiable_properties()['type']
+        self.facade.update_metadata(self.region_obj, self.image, previous)
+        self.assertFalse(self.glance_client.images.get.called)
+        (url,), kwargs = self.glance_client.http_client.patch.call_args
+        self.assertEquals(url, '/v2/images/01')
+        self.assertEquals(json.loads(kwargs['data']), [
+            {'op': 'replace', 'path': '/name', 'value': 'other'},
+            {'op': 'replace', 'path': '/visibility', 'value': 'public'},
+            {'op': 'add', 'path': '/nid', 'value': '4'},
+            {'op': 'remove', 'path': '/type'}])
+
+        # without changes, nothing is sent
+        self.glance_client.reset_mock()
+        self.facade.update_metadata(self.region_obj, self.image,
+                                    self.image.clone())
+        self.assertFalse(self.glance_client.http_client.patch.called)
+
+    def test_update_without_previous(self):
+        """without the previous image, it is requested to the server"""
+        self.glance_client.images.get.return_value = {
+            'name': 'imagetest', 'id': '01', 'visibility': 'private',
+            'status': 'active', 'type': 'base', 'nid': '3'}
+        self.facade.update_metadata(self.region_obj, self.image)
+        self.glance_client.images.get.assert_called_once_with('01')
+        (url,), kwargs = self.glance_client.http_client.patch.call_args
+        self.assertEquals(json.loads(kwargs['data']), [
+            {'op': 'add', 'path': '/nid', 'value': '3'}])
+
+    def test_upload(self):
+        """the image is created and then its content is uploaded"""
+        self.glance_client.images.create.return_value = {'id': '02'}
+        self.glance_client.images.upload.side_effect = \
+            lambda id, data, size: data.read()
+        self.image.checksum = hashlib.md5('content').hexdigest()
+        self.assertEquals(
+            self.facade.upload_image(self.region_obj, self.image,
+                                     StringIO.StringIO('content')), '02')
+        self.glance_client.images.create.assert_called_once_with(
+            container_format='bare', disk_format='qcow2', name='imagetest',
+            visibility='private', protected=False, min_ram=0, min_disk=0,
+            type='base', nid='3')
+        self.glance_client.images.upload.assert_called_once_with(
+            '02', ANY, 12)
+
+    def test_upload_ex(self):
+        """an error uploading the content"""
+        self.glance_client.images.create.return_value = {'id': '02'}
+        self.glance_client.images.upload.side_effect = Exception('no space')
+        msg = 'fakeregion: Upload of imagetest Failed. Cause: no space'
+        with self.assertRaisesRegexp(GlanceFacadeException, msg):
+            self.facade.upload_image(self.region_obj, self.image,
+                                     StringIO.StringIO('content'))
+        # the image created in each attempt is deleted
+        self.assertEquals(self.glance_client.images.upload.call_count, 3)
+        self.assertEquals(self.glance_client.images.delete.call_args_list,
+                          [call('02')] * 3)
+
+    def test_delete(self):
+        """the image is deleted with only one request"""
+        self.facade.delete_image(self.region_obj, '01', False)
+        self.glance_client.images.delete.assert_called_once_with('01')
+        self.assertFalse(self.glance_client.images.get.called)
+
+
 @unittest.skipUnless(testingFacadeReal, 'avoid testing against a real server')
 class TestGlanceServersFacade(unittest.TestCase):
     """Test to check the class against a real server"""
@@ -82,6 +82,16 @@ class TestGlanceServersFacadeMock(unittest.TestCase):
         self.assertEquals(len(images_r2), 0)
         self.assertEquals(len(images_r3), 0)
 
+    def test_iter_imagelist_filters(self):
+        """Test method iter_imagelist with filters"""
+        images = self.mock_master.iter_imagelist(
+            self.region1, filters={'name': 'image2', 'status': 'active'})
+        self.assertEquals(list(image.id for image in images),
+                          [self.id_image2])
+        images = self.mock_master.iter_imagelist(
+            self.region1, filters={'status': 'deleted'})
+        self.assertEquals(list(images), [])
+
     def test_get_imagelist_inmutable(self):
         """Test method get_imagelist, but this time also check that the
         returned list obtained calling two times the function are not
@@ -122,6 +132,22 @@ class TestGlanceServersFacadeMock(unittest.TestCase):
         self.assertNotEquals(image_copy, image_updated)
         self.assertEquals(image, image_updated)
 
+    def test_update_metadata_changes(self):
+        """Test method update_metadata with the previous image: only the
+        changes are applied"""
+        image = self.mock_master.get_imagelist(self.region1)[0]
+        previous = image.clone()
+        image.modifiable_properties()['test'] = 1
+        image.name = 'other'
+        self.mock_master.update_metadata(self.region1, image, previous)
+        self.assertEquals(image, self.mock_master.get_imagelist(
+            self.region1)[0])
+        previous = image.clone()
+        del image.modifiable_properties()['test']
+        self.mock_master.update_metadata(self.region1, image, previous)
+        self.assertEquals(image, self.mock_master.get_imagelist(
+            self.region1)[0])
+
     def test_upload_image(self):
         """Test method upload image"""
         image = self.mock_master.get_imagelist(self.region1)[0]
@@ -136,6 +162,30 @@ class TestGlanceServersFacadeMock(unittest.TestCase):
                 break
         self.assertTrue(found)
 
+    def test_download_image(self):
+        """the content of an image is the one uploaded or added"""
+        self.mock_master.add_image_to_mock(
+            self.mock_master.get_imagelist(self.region1)[1], 'test content')
+        self.assertEquals(self.mock_master.download_image(
+            self.region1, self.id_image2, 12).read(), 'test content')
+        self.assertEquals(self.mock_master.download_image(
+            self.region1, self.id_image1).read(), '')
+        self.assertRaises(Exception, self.mock_master.download_image,
+                          self.region2, self.id_image1)
+
+        # upload from the master region, when the file is not in images_dir
+        image = self.mock_master.get_imagelist(self.region1)[1]
+        self.mock_master.images_dir = tempfile.mkdtemp()
+        self.mock_master.master_source = lambda image: \
+            self.mock_master.download_image(self.region1, image.id)
+        self.targets['master']['image_source'] = 'master'
+        try:
+            id = self.mock_master.upload_image(self.region2, image)
+        finally:
+            os.rmdir(self.mock_master.images_dir)
+        self.assertEquals(self.mock_master.download_image(
+            self.region2, id).read(), 'test content')
+
     def test_get_regions(self):
         """Test method get_regions"""
         master_regions = self.mock_master.get_regions()
@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+# -- encoding: utf-8 --
+#
+# Copyright 2015-2016 Telefónica Investigación y Desarrollo, S.A.U
+#
+# This file is part of FI-WARE project.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+#
+# You may obtain a copy of the License at:
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# For those usages not covered by the Apache version 2.0 License please
+# contact with opensource@tid.es
+#
+import unittest
+import tempfile
+import os
+import glob
+
+from mock import patch
+
+from fiwareglancesync import glancesync_snapshot
+from fiwareglancesync.glancesync_snapshot import MasterSnapshot,\
+    fingerprint_images
+from fiwareglancesync.glancesync_image import GlanceSyncImage
+
+
+class TestMasterSnapshot(unittest.TestCase):
+    """Test the snapshot of the master images"""
+
+    def setUp(self):
+        self.target = {'keystone_url': 'http://server:4730/v2.0',
+                       'tenant': 'tenant1'}
+        self.images = [
+            GlanceSyncImage('image1', '01', 'Valladolid', checksum='aaa',
+                            user_properties={'type': 'base'}),
+            GlanceSyncImage('image2', '02', 'Valladolid', checksum='bbb')]
+        self.images_dict = dict((image.name, image) for image in self.images)
+        self.tmpdir = None
+
+    def tearDown(self):
+        glancesync_snapshot._memory.clear()
+        if self.tmpdir:
+            for name in glob.glob(self.tmpdir + '/*'):
+                os.unlink(name)
+            os.rmdir(self.tmpdir)
+
+    def test_fingerprint(self):
+        """the fingerprint does not depend on the order, but on the data"""
+        fingerprint = fingerprint_images(self.images)
+        self.assertEquals(fingerprint,
+                          fingerprint_images(reversed(self.images)))
+        self.images[0].user_properties['type'] = 'other'
+        self.assertNotEquals(fingerprint, fingerprint_images(self.images))
+        self.images[0].raw = {'updated_at': '2016-01-01T00:00:00'}
+        fingerprint = fingerprint_images(self.images)
+        self.images[0].user_properties['type'] = 'base'
+        self.assertEquals(fingerprint, fingerprint_images(self.images))
+        self.images[0].raw = {'updated_at': '2016-01-02T00:00:00'}
+        self.assertNotEquals(fingerprint, fingerprint_images(self.images))
+
+    def test_disabled(self):
+        """with ttl 0 nothing is kept"""
+        snapshot = MasterSnapshot('Valladolid', self.target)
+        snapshot.put('fp', self.images_dict)
+        self.assertIsNone(snapshot.get())
+        self.assertIsNone(snapshot.get_by_fingerprint('fp'))
+
+    @patch('fiwareglancesync.glancesync_snapshot.time')
+    def test_ttl(self, mock_time):
+        """the snapshot expires, but it is reused if the fingerprint is the
+        same"""
+        mock_time.time.return_value = 1000
+        snapshot = MasterSnapshot('Valladolid', self.target, ttl=60)
+        self.assertIsNone(snapshot.get())
+        snapshot.put('fp', self.images_dict)
+        other = MasterSnapshot('Valladolid', self.target, ttl=60)
+        self.assertEquals(other.get(), ('fp', self.images_dict))
+        self.assertIsNone(
+            MasterSnapshot('Burgos', self.target, ttl=60).get())
+
+        mock_time.time.return_value = 1060
+        self.assertIsNone(other.get())
+        self.assertIsNone(other.get_by_fingerprint('other'))
+        self.assertEquals(other.get_by_fingerprint('fp'), self.images_dict)
+        # get_by_fingerprint renews the snapshot
+        self.assertEquals(other.get(), ('fp', self.images_dict))
+        other.invalidate()
+        self.assertIsNone(snapshot.get())
+
+    def test_directory(self):
+        """the snapshot is shared with other processes using a directory"""
+        self.tmpdir = tempfile.mkdtemp()
+        snapshot = MasterSnapshot('Valladolid', self.target, 60, self.tmpdir)
+        snapshot.put('fp', self.images_dict)
+        self.assertEquals(len(os.listdir(self.tmpdir)), 1)
+        # simulate other process
+        glancesync_snapshot._memory.clear()
+        other = MasterSnapshot('Valladolid', self.target, 60, self.tmpdir)
+        (fingerprint, images) = other.get()
+        self.assertEquals(fingerprint, 'fp')
+        self.assertEquals(sorted(images.keys()), ['image1', 'image2'])
+        self.assertEquals(images['image1'].user_properties, {'type': 'base'})
+        other.invalidate()
+        self.assertEquals(os.listdir(self.tmpdir), [])
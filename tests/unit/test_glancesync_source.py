@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+# -- encoding: utf-8 --
+#
+# Copyright 2015-2016 Telefónica Investigación y Desarrollo, S.A.U
+#
+# This file is part of FI-WARE project.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+#
+# You may obtain a copy of the License at:
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# For those usages not covered by the Apache version 2.0 License please
+# contact with opensource@tid.es
+#
+import hashlib
+import os
+import tempfile
+import unittest
+
+from mock import patch, MagicMock
+
+from fiwareglancesync.glancesync_source import ImageFile, StreamReader
+
+
+class TestImageFile(unittest.TestCase):
+    """Test the reader of the master images"""
+
+    def setUp(self):
+        (fd, self.path) = tempfile.mkstemp()
+        self.content = ''.join(chr(i % 251) for i in range(100000))
+        with os.fdopen(fd, 'wb') as f:
+            f.write(self.content)
+
+    def tearDown(self):
+        os.unlink(self.path)
+
+    def test_read(self):
+        """the content is read in chunks of any size and the MD5 is
+        computed"""
+        with ImageFile(self.path, block_size=1) as source:
+            self.assertEquals(source.block_size % 4096, 0)
+            parts = list()
+            for size in (0, 10, 5000, 70000, -1):
+                parts.append(source.read(size))
+            self.assertEquals(source.read(), '')
+            self.assertEquals(''.join(parts), self.content)
+            self.assertEquals(source.md5.hexdigest(),
+                              hashlib.md5(self.content).hexdigest())
+            self.assertEquals(source.bytes_read, 100000)
+            self.assertTrue(source.end_time >= source.start_time)
+        self.assertTrue(source.closed)
+
+    def test_iter(self):
+        """the iterator returns the whole content"""
+        with ImageFile(self.path, block_size=4096) as source:
+            self.assertEquals(''.join(source), self.content)
+
+    def test_seek(self):
+        """the size can be obtained with seek and tell; after seeking, the
+        MD5 starts again"""
+        with ImageFile(self.path) as source:
+            source.read(1000)
+            self.assertEquals(source.tell(), 1000)
+            source.seek(0, os.SEEK_END)
+            self.assertEquals(source.tell(), 100000)
+            source.seek(0)
+            self.assertEquals(source.tell(), 0)
+            self.assertEquals(source.read(), self.content)
+            self.assertEquals(source.md5.hexdigest(),
+                              hashlib.md5(self.content).hexdigest())
+            source.seek(-10, os.SEEK_CUR)
+            self.assertEquals(source.read(), self.content[-10:])
+
+    @patch('fiwareglancesync.glancesync_source._drop_lag', 20000)
+    @patch('fiwareglancesync.glancesync_source.fadvise')
+    def test_drop_cache(self, fadvise):
+        """the kernel is told that the file is read sequentially and,
+        optionally, that the pages read are not needed"""
+        with ImageFile(self.path, block_size=16384) as source:
+            source.read()
+        self.assertEquals(list(call[0][1:] for call in fadvise.call_args_list),
+                          [(0, 0, 2), (0, 29152, 4), (29152, 32768, 4),
+                           (0, 0, 4)])
+        fadvise.reset_mock()
+        with ImageFile(self.path, drop_cache=False) as source:
+            source.read()
+        self.assertEquals(fadvise.call_count, 1)
+        self.assertEquals(fadvise.call_args[0][1:], (0, 0, 2))
+
+    def test_rate(self):
+        """the rate is the bytes read per second"""
+        with ImageFile(self.path) as source:
+            self.assertEquals(source.rate, 0)
+            source.read()
+            source.read()
+            source.start_time = source.end_time - 2
+            self.assertEquals(source.rate, 50000)
+
+
+class TestStreamReader(unittest.TestCase):
+    """Test the reader of a download"""
+
+    def test_read(self):
+        """the chunks are joined and split as requested"""
+        body = MagicMock()
+        body.__iter__.return_value = iter(['abc', '', 'defgh', 'ij'])
+        with StreamReader(body, 10) as reader:
+            self.assertEquals(reader.size, 10)
+            self.assertEquals(reader.read(2), 'ab')
+            self.assertEquals(reader.read(5), 'cdefg')
+            self.assertEquals(reader.read(), 'hij')
+            self.assertEquals(reader.read(), '')
+            self.assertEquals(reader.bytes_read, 10)
+        body.close.assert_called_once_with()
+
+    def test_iter(self):
+        """the iterator returns the whole content"""
+        reader = StreamReader(['abc', 'def'])
+        self.assertEquals(''.join(reader), 'abcdef')
+        self.assertFalse(hasattr(reader, 'seek'))
@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+# -- encoding: utf-8 --
+#
+# Copyright 2015-2016 Telefónica Investigación y Desarrollo, S.A.U
+#
+# This file is part of FI-WARE project.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+#
+# You may obtain a copy of the License at:
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# For those usages not covered by the Apache version 2.0 License please
+# contact with opensource@tid.es
+#
+import unittest
+import tempfile
+import os
+
+from fiwareglancesync.glancesync_state import SyncStateStore,\
+    target_fingerprint
+
+
+class TestSyncStateStore(unittest.TestCase):
+    """Test the saved state of the regions"""
+
+    def setUp(self):
+        (fd, self.path) = tempfile.mkstemp(suffix='.sqlite')
+        os.close(fd)
+        self.store = SyncStateStore(self.path)
+        self.images = {'image1': ('fp1', 'id1', 'aaa'),
+                       'image2': ('fp2', None, 'bbb')}
+
+    def tearDown(self):
+        os.unlink(self.path)
+
+    def test_unknown_region(self):
+        """a region never saved has no state"""
+        self.assertIsNone(self.store.get_region('Burgos'))
+        self.assertEquals(self.store.get_images('Burgos'), dict())
+
+    def test_save_region(self):
+        """the state is saved and it is shared by other objects"""
+        self.store.save_region('Burgos', 'master', 'target', self.images)
+        other = SyncStateStore(self.path)
+        state = other.get_region('Burgos')
+        self.assertEquals(state.master_fingerprint, 'master')
+        self.assertEquals(state.target_fingerprint, 'target')
+        self.assertEquals(state.runs, 0)
+        self.assertEquals(other.get_images('Burgos'), self.images)
+        self.assertIsNone(other.get_region('Madrid'))
+
+    def test_runs(self):
+        """the runs are counted until the region is verified again; the
+        images not in names are removed"""
+        self.store.save_region('Burgos', 'master', 'target', self.images)
+        self.store.save_region(
+            'Burgos', 'master2', 'target', {'image3': ('fp3', 'id3', 'ccc')},
+            names=['image1', 'image3'], verified=False)
+        self.assertEquals(self.store.get_region('Burgos').runs, 1)
+        self.assertEquals(set(self.store.get_images('Burgos')),
+                          set(['image1', 'image3']))
+        self.store.save_region('Burgos', 'master2', 'target', dict(),
+                               names=['image1', 'image3'], verified=False)
+        self.assertEquals(self.store.get_region('Burgos').runs, 2)
+        self.store.save_region('Burgos', 'master2', 'target', self.images)
+        self.assertEquals(self.store.get_region('Burgos').runs, 0)
+        self.assertEquals(self.store.get_images('Burgos'), self.images)
+
+    def test_forget_region(self):
+        """a forgotten region has no state"""
+        self.store.save_region('Burgos', 'master', 'target', self.images)
+        self.store.forget_region('Burgos')
+        self.assertIsNone(self.store.get_region('Burgos'))
+        self.assertEquals(self.store.get_images('Burgos'), dict())
+
+    def test_target_fingerprint(self):
+        """the fingerprint changes with the options that select the
+        images"""
+        target = {'metadata_set': set(['type']), 'forcesyncs': set(),
+                  'replace': set(), 'rename': set(), 'dontupdate': set(),
+                  'only_tenant_images': True,
+                  'support_obsolete_images': True,
+                  'obsolete_syncprops': None, 'tenant': 'tenant1'}
+        fingerprint = target_fingerprint(target)
+        target['tenant'] = 'tenant2'
+        self.assertEquals(fingerprint, target_fingerprint(target))
+        target['metadata_set'].add('nid')
+        self.assertNotEquals(fingerprint, target_fingerprint(target))
+        fingerprint = target_fingerprint(target)
+        target['metadata_condition'] = compile('image.is_public',
+                                               'metadata_condition', 'eval')
+        self.assertNotEquals(fingerprint, target_fingerprint(target))
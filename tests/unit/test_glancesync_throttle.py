@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+# -- encoding: utf-8 --
+#
+# Copyright 2015-2016 Telefónica Investigación y Desarrollo, S.A.U
+#
+# This file is part of FI-WARE project.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+#
+# You may obtain a copy of the License at:
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# For those usages not covered by the Apache version 2.0 License please
+# contact with opensource@tid.es
+#
+import unittest
+import tempfile
+import StringIO
+import os
+
+from mock import patch
+
+from fiwareglancesync.glancesync_throttle import TokenBucket, Throttle
+
+
+class TestTokenBucket(unittest.TestCase):
+    """Test the token bucket"""
+
+    @patch('fiwareglancesync.glancesync_throttle.time')
+    def test_take(self, mock_time):
+        """the wait is the time to pay the debt at rate"""
+        mock_time.time.return_value = 100.0
+        bucket = TokenBucket(1000)
+        self.assertEquals(bucket.take(500), 0.5)
+        mock_time.time.return_value = 101.0
+        # the debt is paid and the bucket has 500 bytes
+        self.assertEquals(bucket.take(500), 0)
+        mock_time.time.return_value = 200.0
+        # the bucket is never more than full
+        self.assertEquals(bucket.take(3000), 2)
+
+    def test_unlimited(self):
+        """a rate of 0 means no limit"""
+        bucket = TokenBucket(0)
+        self.assertEquals(bucket.take(10 ** 9), 0)
+        bucket.set_rate(1000)
+        self.assertTrue(bucket.take(10 ** 9) > 0)
+        bucket.set_rate(0)
+        self.assertEquals(bucket.take(10 ** 9), 0)
+
+
+class TestThrottle(unittest.TestCase):
+    """Test the limits of the uploads"""
+
+    def setUp(self):
+        (fd, self.path) = tempfile.mkstemp()
+        os.close(fd)
+        os.unlink(self.path)
+        self.throttle = Throttle(100, {'master': (50, 10), 'other': (0, 0)},
+                                 self.path)
+
+    def tearDown(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+    def _rates(self, region, target_name):
+        """return the rates of the buckets of a region"""
+        reader = self.throttle.reader(StringIO.StringIO(), region,
+                                      target_name)
+        return list(bucket.rate for bucket in reader._buckets)
+
+    def test_reader(self):
+        """each region has its bucket; the regions of the target share
+        another one and all the regions share the global one"""
+        self.assertEquals(self._rates('Region1', 'master'),
+                          [102400, 51200, 10240])
+        self.assertEquals(self._rates('other:Region2', 'other'),
+                          [102400, 0, 0])
+        reader1 = self.throttle.reader(StringIO.StringIO(), 'Region1',
+                                       'master')
+        reader2 = self.throttle.reader(StringIO.StringIO(), 'Region2',
+                                       'master')
+        self.assertIs(reader1._buckets[0], reader2._buckets[0])
+        self.assertIs(reader1._buckets[1], reader2._buckets[1])
+        self.assertIsNot(reader1._buckets[2], reader2._buckets[2])
+
+    @patch('fiwareglancesync.glancesync_throttle.time')
+    def test_read(self, mock_time):
+        """the reader waits for the most limited bucket"""
+        mock_time.time.return_value = 100.0
+        reader = self.throttle.reader(StringIO.StringIO('a' * 20480),
+                                      'Region1', 'master')
+        self.assertEquals(reader.read(), 'a' * 20480)
+        mock_time.sleep.assert_called_once_with(2.0)
+        self.assertEquals(reader.read(), '')
+        self.assertEquals(mock_time.sleep.call_count, 1)
+
+    def test_reload(self):
+        """the file overrides the limits of the configuration, and these are
+        restored when it is removed"""
+        self._rates('Region1', 'master')
+        with open(self.path, 'w') as file_obj:
+            file_obj.write('[main]\nmax_bandwidth = 0\n[master]\n'
+                           'max_region_bandwidth = 20\n')
+        self.assertTrue(self.throttle.reload())
+        self.assertEquals(self._rates('Region1', 'master'),
+                          [0, 51200, 20480])
+        os.unlink(self.path)
+        self.assertTrue(self.throttle.reload())
+        self.assertEquals(self._rates('Region1', 'master'),
+                          [102400, 51200, 10240])
+
+    def test_reload_error(self):
+        """if the file is wrong, the limits do not change"""
+        with open(self.path, 'w') as file_obj:
+            file_obj.write('[main]\nmax_bandwidth = fast\n')
+        self.assertFalse(self.throttle.reload())
+        self.assertEquals(self.throttle.max_bandwidth, 100)
+
+    def test_check(self):
+        """the file is read again when it is modified or when a reload is
+        requested"""
+        self.throttle.check()
+        self.assertEquals(self.throttle.max_bandwidth, 100)
+        with open(self.path, 'w') as file_obj:
+            file_obj.write('[main]\nmax_bandwidth = 10\n')
+        # it is not checked again until check_interval has passed
+        self.throttle.check()
+        self.assertEquals(self.throttle.max_bandwidth, 100)
+        self.throttle.request_reload()
+        self.throttle.check()
+        self.assertEquals(self.throttle.max_bandwidth, 10)
+
+    def test_share(self):
+        """the global and target limits are divided between the processes,
+        but not the region limits"""
+        self.throttle.set_share(4)
+        self.assertEquals(self._rates('Region1', 'master'),
+                          [25600, 12800, 10240])
+        self.assertEquals(self._rates('Region2', 'master'),
+                          [25600, 12800, 10240])
+        self.throttle.set_share(1)
+        self.assertEquals(self._rates('Region1', 'master'),
+                          [102400, 51200, 10240])
@@ -0,0 +1,226 @@
+#!/usr/bin/env python
+# -- encoding: utf-8 --
+#
+# Copyright 2015-2016 Telefónica Investigación y Desarrollo, S.A.U
+#
+# This file is part of FI-WARE project.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+#
+# You may obtain a copy of the License at:
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# For those usages not covered by the Apache version 2.0 License please
+# contact with opensource@tid.es
+#
+import unittest
+import threading
+import time
+
+from fiwareglancesync.glancesync_upload import UploadScheduler,\
+    UploadSkippedException, ami_dependencies, dependency_order,\
+    TransferScheduler
+from fiwareglancesync.glancesync_image import GlanceSyncImage
+
+
+class TestUploadScheduler(unittest.TestCase):
+    """Test the scheduler used to upload the images of a region"""
+
+    def setUp(self):
+        self.finished = list()
+        self.lock = threading.Lock()
+        self.running = 0
+        self.max_running = 0
+
+    def _job(self, name, duration=0.1, fail=False):
+        """return a job that records when it finishes"""
+        def job():
+            with self.lock:
+                self.running += 1
+                self.max_running = max(self.max_running, self.running)
+            time.sleep(duration)
+            with self.lock:
+                self.running -= 1
+                self.finished.append(name)
+            if fail:
+                raise Exception('failed ' + name)
+        return job
+
+    def test_sequential(self):
+        """with a worker, jobs are run in order"""
+        scheduler = UploadScheduler(1)
+        for name in ('a', 'b', 'c'):
+            scheduler.add_job(name, self._job(name, 0))
+        self.assertEquals(scheduler.run(), dict())
+        self.assertEquals(self.finished, ['a', 'b', 'c'])
+
+    def test_concurrent(self):
+        """independent jobs run at the same time, bounded by max_workers"""
+        scheduler = UploadScheduler(2)
+        for name in ('a', 'b', 'c', 'd'):
+            scheduler.add_job(name, self._job(name))
+        self.assertEquals(scheduler.run(), dict())
+        self.assertEquals(set(self.finished), set(['a', 'b', 'c', 'd']))
+        self.assertEquals(self.max_running, 2)
+
+    def test_dependencies(self):
+        """a job does not start until its dependencies are finished"""
+        scheduler = UploadScheduler(4)
+        scheduler.add_job('ami', self._job('ami', 0), ['kernel', 'ramdisk'])
+        scheduler.add_job('kernel', self._job('kernel', 0.2))
+        scheduler.add_job('ramdisk', self._job('ramdisk', 0.1))
+        scheduler.add_job('other', self._job('other', 0), ['notscheduled'])
+        self.assertEquals(scheduler.run(), dict())
+        self.assertEquals(self.finished[-1], 'ami')
+        self.assertEquals(self.finished[0], 'other')
+
+    def test_failed_dependency(self):
+        """if a dependency fails, the job is skipped"""
+        scheduler = UploadScheduler(2, stop_on_error=False)
+        scheduler.add_job('kernel', self._job('kernel', 0, True))
+        scheduler.add_job('ami', self._job('ami', 0), ['kernel'])
+        scheduler.add_job('other', self._job('other', 0))
+        failed = scheduler.run()
+        self.assertEquals(set(failed.keys()), set(['kernel', 'ami']))
+        self.assertIsInstance(failed['ami'], UploadSkippedException)
+        self.assertIn('other', self.finished)
+
+    def test_stop_on_error(self):
+        """after a failure, the remaining jobs are not started"""
+        scheduler = UploadScheduler(1)
+        scheduler.add_job('a', self._job('a', 0, True))
+        scheduler.add_job('b', self._job('b', 0))
+        failed = scheduler.run()
+        self.assertEquals(self.finished, ['a'])
+        self.assertEquals(str(failed['a']), 'failed a')
+        self.assertIsInstance(failed['b'], UploadSkippedException)
+
+    def test_duplicated(self):
+        """job names must be unique"""
+        scheduler = UploadScheduler(1)
+        scheduler.add_job('a', self._job('a'))
+        self.assertRaises(ValueError, scheduler.add_job, 'a', self._job('a'))
+
+    def test_ami_dependencies(self):
+        """kernel_id and ramdisk_id of a master image are the dependencies"""
+        image = GlanceSyncImage('image', '01', 'Valladolid', user_properties={
+            'kernel_id': 'kernel', 'ramdisk_id': 'ramdisk', 'type': 'ami'})
+        self.assertEquals(ami_dependencies(image), set(['kernel', 'ramdisk']))
+        image = GlanceSyncImage('image', '01', 'Valladolid')
+        self.assertEquals(ami_dependencies(image), set())
+
+    def test_dependency_order(self):
+        """kernel and ramdisk go before the AMI image, otherwise by size"""
+        ami = GlanceSyncImage('ami', '01', 'Valladolid', size=1, user_properties={
+            'kernel_id': 'kernel', 'ramdisk_id': 'ramdisk', 'type': 'ami'})
+        kernel = GlanceSyncImage('kernel', '02', 'Valladolid', size=30)
+        ramdisk = GlanceSyncImage('ramdisk', '03', 'Valladolid', size=20)
+        other = GlanceSyncImage('other', '04', 'Valladolid', size=10)
+        ordered = dependency_order([kernel, other, ami, ramdisk])
+        self.assertEquals([image.name for image in ordered],
+                          ['kernel', 'ramdisk', 'ami', 'other'])
+
+
+class TestTransferScheduler(unittest.TestCase):
+    """Test the scheduler of the uploads of several regions"""
+
+    def setUp(self):
+        self.started = list()
+        self.lock = threading.Lock()
+        self.running = dict()
+        self.max_running = dict()
+
+    def _job(self, region, name, target='t', fail=False, duration=0.05):
+        def job():
+            with self.lock:
+                self.started.append((region, name))
+                for key in ('all', region, target):
+                    self.running[key] = self.running.get(key, 0) + 1
+                    self.max_running[key] = max(self.max_running.get(key, 0),
+                                                self.running[key])
+            time.sleep(duration)
+            with self.lock:
+                for key in ('all', region, target):
+                    self.running[key] -= 1
+            if fail:
+                raise Exception('failed ' + name)
+        return job
+
+    def _add(self, scheduler, jobs):
+        for (region, name, size) in jobs:
+            scheduler.add_job(region, name, self._job(region, name), size)
+
+    def test_policies(self):
+        """with a single worker, the order is determined by the policy"""
+        jobs = [('r1', 'a', 30), ('r1', 'b', 10), ('r2', 'b', 10),
+                ('r2', 'c', 20), ('r3', 'c', 20), ('r3', 'b', 10)]
+        scheduler = TransferScheduler(1, 'smallest')
+        self._add(scheduler, jobs)
+        scheduler.run()
+        self.assertEquals(self.started, [
+            ('r1', 'b'), ('r2', 'b'), ('r3', 'b'), ('r2', 'c'), ('r3', 'c'),
+            ('r1', 'a')])
+
+        self.started = list()
+        scheduler = TransferScheduler(1, 'largest')
+        self._add(scheduler, jobs)
+        scheduler.run()
+        self.assertEquals(self.started[0], ('r1', 'a'))
+        self.assertEquals(self.started[1:3], [('r2', 'c'), ('r3', 'c')])
+
+        self.started = list()
+        jobs = [('r1', 'a', 30), ('r1', 'b', 10), ('r2', 'a', 30),
+                ('r3', 'a', 30)]
+        scheduler = TransferScheduler(1, 'most_waiting')
+        self._add(scheduler, jobs)
+        scheduler.run()
+        # on a tie, the smallest image first
+        self.assertEquals(self.started, [
+            ('r1', 'a'), ('r2', 'a'), ('r1', 'b'), ('r3', 'a')])
+
+    def test_unknown_policy(self):
+        """the policy must be one of the supported"""
+        self.assertRaises(ValueError, TransferScheduler, 1, 'random')
+
+    def test_limits(self):
+        """the global, region and target limits are honoured"""
+        scheduler = TransferScheduler(4)
+        scheduler.set_region_limit('r1', 1)
+        scheduler.set_target_limit('t2', 2)
+        for name in ('a', 'b', 'c'):
+            scheduler.add_job('r1', name, self._job('r1', name, 't1'),
+                              target='t1')
+            for region in ('r2', 'r3'):
+                scheduler.add_job(region, name, self._job(region, name, 't2'),
+                                  target='t2')
+        self.assertEquals(scheduler.run(), dict())
+        self.assertEquals(len(self.started), 9)
+        self.assertEquals(self.max_running['r1'], 1)
+        self.assertEquals(self.max_running['t2'], 2)
+        self.assertEquals(self.max_running['all'], 3)
+
+    def test_dependencies_and_errors(self):
+        """a failed job cancels the rest of its region, but not the other
+        regions; dependencies are per region"""
+        scheduler = TransferScheduler(2)
+        scheduler.add_job('r1', 'kernel', self._job('r1', 'kernel', fail=True),
+                          1)
+        scheduler.add_job('r1', 'ami', self._job('r1', 'ami'), 2, ['kernel'])
+        scheduler.add_job('r1', 'other', self._job('r1', 'other'), 3)
+        scheduler.add_job('r2', 'kernel', self._job('r2', 'kernel'), 1)
+        scheduler.add_job('r2', 'ami', self._job('r2', 'ami'), 2, ['kernel'])
+        failed = scheduler.run()
+        self.assertEquals(set(failed.keys()), set(
+            [('r1', 'kernel'), ('r1', 'ami'), ('r1', 'other')]))
+        self.assertIsInstance(failed[('r1', 'ami')], UploadSkippedException)
+        self.assertLess(self.started.index(('r2', 'kernel')),
+                        self.started.index(('r2', 'ami')))
@@ -23,15 +23,19 @@
 # contact with opensource@tid.es
 #
 
-from mock import patch, call, ANY
+from mock import patch, call, ANY, PropertyMock
 import unittest
 import datetime
 import os
 import logging
 import time
 import re
+import json
+import tempfile
+import StringIO
 
-from fiwareglancesync.sync import Sync
+from fiwareglancesync.sync import Sync, create_parser
+from fiwareglancesync.glancesync_plan import SyncPlan
 
 
 class TestSync(unittest.TestCase):
@@ -42,16 +46,45 @@ class TestSync(unittest.TestCase):
         self.regions = []
         self.sync = Sync(self.regions)
         self.glancesync = glancesync
-        config = {'return_value.master_region': 'MasterRegion'}
+        config = {'return_value.master_region': 'MasterRegion',
+                  'return_value.max_readers': 4,
+                  'return_value.region_timeout': 10}
         self.glancesync.configure_mock(**config)
 
     def test_report_status(self):
         """check that calls to export_sync_region_status are done"""
         self.sync.regions = ['region1', 'region2']
+        # the regions are evaluated concurrently: the child mock is created
+        # before, otherwise each thread may create its own one
+        export = self.glancesync.return_value.export_sync_region_status
         self.sync.report_status()
         calls = [call('region1', ANY), call('region2', ANY)]
-        self.glancesync.return_value.export_sync_region_status.\
-            assert_has_calls(calls)
+        export.assert_has_calls(calls, any_order=True)
+
+    def test_master_before_regions(self):
+        """the master images are obtained before evaluating the regions, and
+        not by each thread"""
+        glancesync = self.glancesync.return_value
+        events = list()
+        master = PropertyMock(side_effect=lambda: events.append('master'))
+        type(glancesync).master_region_dict = master
+        glancesync.export_sync_region_status.side_effect = \
+            lambda region, stream: events.append(region)
+        glancesync.plan_region.side_effect = \
+            lambda region: events.append(region) or SyncPlan(region, 'fp')
+        self.sync.regions = ['region1', 'region2']
+        self.sync.report_status()
+        self.assertEqual(events[0], 'master')
+        self.assertEqual(sorted(events[1:]), ['region1', 'region2'])
+        del events[:]
+        (fd, path) = tempfile.mkstemp(suffix='.json')
+        os.close(fd)
+        try:
+            self.sync.make_plans(path)
+        finally:
+            os.unlink(path)
+        self.assertEqual(events[0], 'master')
+        self.assertEqual(sorted(events[1:]), ['region1', 'region2'])
 
     def test_sequential_sync(self):
         """check that calls to sync_region are done"""
@@ -84,6 +117,98 @@ class TestSync(unittest.TestCase):
         self.glancesync.return_value.backup_glancemetadata_region.\
             assert_called_with('MasterRegion', dir_name)
 
+    def test_watch(self):
+        """check that the regions are synchronised only when the master
+        region changes, and that the failed regions are retried"""
+        fingerprints = iter(['fp1', 'fp1', 'fp2', 'fp2'])
+        glancesync = self.glancesync.return_value
+
+        def refresh_master():
+            fingerprint = next(fingerprints)
+            changed = glancesync.master_fingerprint != fingerprint
+            glancesync.master_fingerprint = fingerprint
+            return changed
+
+        (fd, path) = tempfile.mkstemp(suffix='.json')
+        os.close(fd)
+        config = {'refresh_master.side_effect': refresh_master,
+                  'sync_regions_scheduled.side_effect': [
+                      ['region2'], [], []],
+                  'watch_interval': 0, 'watch_status_file': path,
+                  'master_fingerprint': None}
+        glancesync.configure_mock(**config)
+        self.sync.regions = ['region1', 'region2']
+        try:
+            status = self.sync.watch(iterations=4)
+            saved = json.load(open(path))
+        finally:
+            os.unlink(path)
+        calls = [call(['region1', 'region2']), call(['region2']),
+                 call(['region1', 'region2'])]
+        self.assertEqual(glancesync.sync_regions_scheduled.call_args_list,
+                         calls)
+        self.assertTrue(status['healthy'])
+        self.assertEqual(saved['master_fingerprint'], 'fp2')
+        self.assertEqual(saved['regions']['region2']['status'], 'ok')
+        self.assertEqual(saved['regions']['region2']['lag'], 0)
+
+    @patch('sys.stderr', new_callable=StringIO.StringIO)
+    def test_watch_exclusive(self, stderr):
+        """check that --watch is rejected with the other modes"""
+        parser = create_parser()
+        self.assertTrue(parser.parse_args(['--watch']).watch)
+        for option in (['--dry-run'], ['--show-status'], ['--show-regions'],
+                       ['--make-backup'], ['--make-plan', 'plans'],
+                       ['--execute-plan', 'plans']):
+            self.assertRaises(SystemExit, parser.parse_args,
+                              ['--watch'] + option)
+        self.assertIn('not allowed with argument', stderr.getvalue())
+
+    def test_make_and_execute_plans(self):
+        """check that the plans are saved and executed"""
+        glancesync = self.glancesync.return_value
+
+        def plan_region(region):
+            if region == 'region2':
+                raise Exception('error')
+            return SyncPlan(region, 'fp')
+
+        glancesync.plan_region.side_effect = plan_region
+        self.sync.regions = ['region1', 'region2', 'region3']
+        (fd, path) = tempfile.mkstemp(suffix='.json')
+        os.close(fd)
+        try:
+            self.assertEqual(self.sync.make_plans(path), ['region2'])
+            self.sync.execute_plans(path)
+        finally:
+            os.unlink(path)
+        regions = list(args[0][0].region
+                       for args in glancesync.execute_plan.call_args_list)
+        self.assertEqual(regions, ['region1', 'region3'])
+
+    @patch('sys.stdout', new_callable=StringIO.StringIO)
+    def test_report_status_concurrent(self, stdout):
+        """the regions are evaluated at the same time, but the reports are
+        printed in order; a region that takes too long is reported as
+        failed"""
+        def export(region, stream):
+            time.sleep(delays[region])
+            stream.write(region)
+
+        delays = {'region1': 0.3, 'region2': 0.1, 'region3': 2, 'region4': 0}
+        glancesync = self.glancesync.return_value
+        glancesync.export_sync_region_status.side_effect = export
+        glancesync.region_timeout = 1
+        glancesync.max_readers = 2
+        self.sync.regions = ['region1', 'region2', 'region3', 'region4']
+        start = time.time()
+        self.sync.report_status()
+        self.assertLess(time.time() - start, 1.8)
+        self.assertEqual(stdout.getvalue().split(),
+                         ['region1', 'region2', 'region4'])
+        glancesync.log.error.assert_called_with(
+            'region3: timeout after 1 seconds')
+
 
 class TestSyncConstr(unittest.TestCase):
     """tests to check constructor, the expansion of the target and the
@@ -217,3 +342,32 @@ class TestSyncParallel(unittest.TestCase):
         self.glancesync.configure_mock(**config)
         diff = self._check_sync_invoked(datetime_mock)
         assert(diff > 1)
+
+    @patch('fiwareglancesync.sync.datetime')
+    def test_parallel_sync_results(self, datetime_mock):
+        """test that the result of each region is returned to the parent,
+        including the errors"""
+        def sync_region(region):
+            if region == 'region2':
+                self.log.error('Upload failed')
+                raise Exception('region2 failed')
+            return 1024
+
+        dt = datetime.datetime(2020, 2, 6, 23, 57)
+        datetime_mock.configure_mock(**{'datetime.now.return_value': dt})
+        config = {
+            'return_value.max_children': 2,
+            'return_value.sync_region.side_effect': sync_region
+        }
+        self.glancesync.configure_mock(**config)
+        results = self.sync.parallel_sync()
+        results = dict((result['region'], result) for result in results)
+        self.assertEqual(set(results.keys()), set(['region1', 'region2']))
+        self.assertEqual(results['region1']['status'], 'ok')
+        self.assertEqual(results['region1']['bytes'], 1024)
+        self.assertEqual(results['region1']['errors'], [])
+        self.assertEqual(results['region2']['status'], 'error')
+        self.assertEqual(results['region2']['errors'],
+                         ['Upload failed', 'region2 failed'])
+        data = open(os.path.join(self.dir_name, 'region2.txt')).read()
+        self.assertIn('Upload failed', data)